@@ -0,0 +1,33 @@
+"""add retry fields to embeddings_tasks
+
+Revision ID: 0006_add_embedding_task_retry
+Revises: 0005_add_conversation_name
+Create Date: 2026-10-16 00:00:00.000000
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0006_add_embedding_task_retry"
+down_revision = "0005_add_conversation_name"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "embeddings_tasks",
+        sa.Column("attempts", sa.Integer(), nullable=False, server_default="0"),
+    )
+    op.add_column("embeddings_tasks", sa.Column("next_run_at", sa.DateTime(), nullable=True))
+    op.create_index(
+        "ix_embeddings_tasks_status_next_run_at",
+        "embeddings_tasks",
+        ["status", "next_run_at"],
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_embeddings_tasks_status_next_run_at", table_name="embeddings_tasks")
+    op.drop_column("embeddings_tasks", "next_run_at")
+    op.drop_column("embeddings_tasks", "attempts")
@@ -0,0 +1,25 @@
+"""add documents (status, uploaded_at, id) index
+
+Revision ID: 0007_add_documents_pending_index
+Revises: 0006_add_embedding_task_retry
+Create Date: 2026-10-16 00:00:00.000000
+"""
+
+from alembic import op
+
+revision = "0007_add_documents_pending_index"
+down_revision = "0006_add_embedding_task_retry"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        "ix_documents_status_uploaded_at_id",
+        "documents",
+        ["status", "uploaded_at", "id"],
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_documents_status_uploaded_at_id", table_name="documents")
@@ -0,0 +1,49 @@
+"""add keyset pagination indexes for list endpoints
+
+Revision ID: 0008_add_list_keyset_indexes
+Revises: 0007_add_documents_pending_index
+Create Date: 2026-10-16 00:00:00.000000
+"""
+
+from alembic import op
+
+revision = "0008_add_list_keyset_indexes"
+down_revision = "0007_add_documents_pending_index"
+branch_labels = None
+depends_on = None
+
+_INDEXES = [
+    ("ix_documents_kb_id_uploaded_at_id", "documents", ["kb_id", "uploaded_at", "id"]),
+    ("ix_document_audits_decided_at_id", "document_audits", ["decided_at", "id"]),
+    (
+        "ix_conversations_owner_teacher_id_updated_at",
+        "conversations",
+        ["owner_teacher_id", "updated_at", "id"],
+    ),
+    (
+        "ix_conversations_owner_student_id_updated_at",
+        "conversations",
+        ["owner_student_id", "updated_at", "id"],
+    ),
+    ("ix_search_logs_created_at_id", "search_logs", ["created_at", "id"]),
+    (
+        "ix_search_logs_user_teacher_id_created_at",
+        "search_logs",
+        ["user_teacher_id", "created_at", "id"],
+    ),
+    (
+        "ix_search_logs_user_student_id_created_at",
+        "search_logs",
+        ["user_student_id", "created_at", "id"],
+    ),
+]
+
+
+def upgrade() -> None:
+    for name, table, columns in _INDEXES:
+        op.create_index(name, table, columns)
+
+
+def downgrade() -> None:
+    for name, table, _ in reversed(_INDEXES):
+        op.drop_index(name, table_name=table)
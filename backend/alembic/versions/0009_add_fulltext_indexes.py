@@ -0,0 +1,35 @@
+"""add ngram fulltext indexes for filename/search query filters
+
+Revision ID: 0009_add_fulltext_indexes
+Revises: 0008_add_list_keyset_indexes
+Create Date: 2026-10-16 00:00:00.000000
+"""
+
+from alembic import op
+
+revision = "0009_add_fulltext_indexes"
+down_revision = "0008_add_list_keyset_indexes"
+branch_labels = None
+depends_on = None
+
+_INDEXES = [
+    ("ft_documents_original_name", "documents", "original_name"),
+    ("ft_search_logs_query", "search_logs", "query"),
+]
+
+
+def upgrade() -> None:
+    # 全文索引仅 MySQL 支持，其他数据库保持 LIKE 过滤
+    if op.get_bind().dialect.name != "mysql":
+        return
+    # ngram 分词会丢弃包含停用词（如 a、i）的 token，建索引前关闭本会话的停用词表
+    op.execute("SET SESSION innodb_ft_enable_stopword = OFF")
+    for name, table, column in _INDEXES:
+        op.execute(f"ALTER TABLE {table} ADD FULLTEXT INDEX {name} ({column}) WITH PARSER ngram")
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name != "mysql":
+        return
+    for name, table, _ in reversed(_INDEXES):
+        op.drop_index(name, table_name=table)
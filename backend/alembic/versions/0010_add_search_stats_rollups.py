@@ -0,0 +1,59 @@
+"""add daily search stats rollup tables
+
+Revision ID: 0010_add_search_stats_rollups
+Revises: 0009_add_fulltext_indexes
+Create Date: 2026-10-16 00:00:00.000000
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0010_add_search_stats_rollups"
+down_revision = "0009_add_fulltext_indexes"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "search_stats_daily_users",
+        sa.Column("day", sa.Date(), nullable=False),
+        sa.Column("kb_id", sa.BigInteger(), sa.ForeignKey("knowledge_bases.id"), nullable=False),
+        sa.Column("user_role", sa.String(length=16), nullable=False),
+        sa.Column("user_id", sa.BigInteger(), nullable=False),
+        sa.Column("search_count", sa.Integer(), nullable=False, server_default="0"),
+        sa.PrimaryKeyConstraint("day", "kb_id", "user_role", "user_id"),
+    )
+    op.create_index(
+        "ix_search_stats_daily_users_kb_id_day",
+        "search_stats_daily_users",
+        ["kb_id", "day"],
+    )
+    op.create_index(
+        "ix_search_stats_daily_users_user_day",
+        "search_stats_daily_users",
+        ["user_role", "user_id", "day"],
+    )
+
+    op.create_table(
+        "search_stats_daily_queries",
+        sa.Column("day", sa.Date(), nullable=False),
+        sa.Column("kb_id", sa.BigInteger(), sa.ForeignKey("knowledge_bases.id"), nullable=False),
+        sa.Column("query_hash", sa.String(length=64), nullable=False),
+        sa.Column("query", sa.String(length=512), nullable=False),
+        sa.Column("search_count", sa.Integer(), nullable=False, server_default="0"),
+        sa.PrimaryKeyConstraint("day", "kb_id", "query_hash"),
+    )
+    op.create_index(
+        "ix_search_stats_daily_queries_kb_id_day",
+        "search_stats_daily_queries",
+        ["kb_id", "day"],
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_search_stats_daily_queries_kb_id_day", table_name="search_stats_daily_queries")
+    op.drop_table("search_stats_daily_queries")
+    op.drop_index("ix_search_stats_daily_users_user_day", table_name="search_stats_daily_users")
+    op.drop_index("ix_search_stats_daily_users_kb_id_day", table_name="search_stats_daily_users")
+    op.drop_table("search_stats_daily_users")
@@ -0,0 +1,30 @@
+"""add daily search stats sketches
+
+Revision ID: 0011_add_search_stats_sketches
+Revises: 0010_add_search_stats_rollups
+Create Date: 2026-10-16 00:00:00.000000
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0011_add_search_stats_sketches"
+down_revision = "0010_add_search_stats_rollups"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "search_stats_daily_sketches",
+        sa.Column("day", sa.Date(), nullable=False),
+        sa.Column("kb_id", sa.BigInteger(), sa.ForeignKey("knowledge_bases.id"), nullable=False),
+        sa.Column("teacher_hll", sa.LargeBinary(), nullable=True),
+        sa.Column("student_hll", sa.LargeBinary(), nullable=True),
+        sa.Column("top_queries", sa.JSON(), nullable=True),
+        sa.PrimaryKeyConstraint("day", "kb_id"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("search_stats_daily_sketches")
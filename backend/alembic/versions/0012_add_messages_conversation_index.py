@@ -0,0 +1,25 @@
+"""add (conversation_id, created_at, id) index for message paging
+
+Revision ID: 0012_add_messages_conversation_index
+Revises: 0011_add_search_stats_sketches
+Create Date: 2026-10-16 00:00:00.000000
+"""
+
+from alembic import op
+
+revision = "0012_add_messages_conversation_index"
+down_revision = "0011_add_search_stats_sketches"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        "ix_messages_conversation_id_created_at_id",
+        "messages",
+        ["conversation_id", "created_at", "id"],
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_messages_conversation_id_created_at_id", table_name="messages")
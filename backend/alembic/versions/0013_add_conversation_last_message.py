@@ -0,0 +1,65 @@
+"""add denormalized last message fields to conversations
+
+Revision ID: 0013_add_conversation_last_message
+Revises: 0012_add_messages_conversation_index
+Create Date: 2026-10-16 00:00:00.000000
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0013_add_conversation_last_message"
+down_revision = "0012_add_messages_conversation_index"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column("conversations", sa.Column("last_message_id", sa.BigInteger(), nullable=True))
+    op.add_column(
+        "conversations",
+        sa.Column(
+            "last_message_role",
+            sa.Enum("user", "assistant", "system", name="sender_role"),
+            nullable=True,
+        ),
+    )
+    op.add_column(
+        "conversations", sa.Column("last_message_preview", sa.String(length=255), nullable=True)
+    )
+    op.add_column("conversations", sa.Column("last_message_at", sa.DateTime(), nullable=True))
+
+    # 回填已有对话的最后一条消息
+    op.execute(
+        """
+        UPDATE conversations SET last_message_id = (
+            SELECT m.id FROM messages m
+            WHERE m.conversation_id = conversations.id
+            ORDER BY m.created_at DESC, m.id DESC
+            LIMIT 1
+        )
+        """
+    )
+    op.execute(
+        """
+        UPDATE conversations SET
+            last_message_role = (
+                SELECT m.sender_role FROM messages m WHERE m.id = conversations.last_message_id
+            ),
+            last_message_preview = (
+                SELECT SUBSTRING(m.content, 1, 200) FROM messages m
+                WHERE m.id = conversations.last_message_id
+            ),
+            last_message_at = (
+                SELECT m.created_at FROM messages m WHERE m.id = conversations.last_message_id
+            )
+        WHERE last_message_id IS NOT NULL
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("conversations", "last_message_at")
+    op.drop_column("conversations", "last_message_preview")
+    op.drop_column("conversations", "last_message_role")
+    op.drop_column("conversations", "last_message_id")
@@ -0,0 +1,31 @@
+"""add per-day all knowledge base search stats sketches
+
+Revision ID: 0014_add_search_stats_sketch_totals
+Revises: 0013_add_conversation_last_message
+Create Date: 2026-10-16 00:00:00.000000
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0014_add_search_stats_sketch_totals"
+down_revision = "0013_add_conversation_last_message"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "search_stats_daily_sketch_totals",
+        sa.Column("day", sa.Date(), nullable=False),
+        sa.Column("teacher_hll", sa.LargeBinary(), nullable=True),
+        sa.Column("student_hll", sa.LargeBinary(), nullable=True),
+        sa.Column("top_queries", sa.JSON(), nullable=True),
+        sa.PrimaryKeyConstraint("day"),
+    )
+    # 迁移不依赖应用代码（摘要精度等配置可能随版本变化），已有日期的全站摘要不在此回填，
+    # 升级后执行：python -m app.search_stats backfill --from <最早日期> --to <今天>
+
+
+def downgrade() -> None:
+    op.drop_table("search_stats_daily_sketch_totals")
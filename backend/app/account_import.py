@@ -0,0 +1,121 @@
+"""学生/教师账号批量导入：CSV / XLSX 流式解析。
+
+只负责把上传文件逐行解析为 {字段: 值} 字典（表头支持中英文列名），
+不读取整个文件到内存；校验与写库由调用方按批处理。
+XLSX 依赖 openpyxl（只读模式逐行读取），未安装时仅支持 CSV。
+"""
+
+import codecs
+import csv
+from typing import IO, Dict, Iterator, List, Optional, Tuple
+
+# 表头别名 -> 字段名
+_HEADER_ALIASES = {
+    "student_no": "student_no",
+    "学号": "student_no",
+    "teacher_no": "teacher_no",
+    "工号": "teacher_no",
+    "教师工号": "teacher_no",
+    "name": "name",
+    "姓名": "name",
+    "password": "password",
+    "密码": "password",
+    "class_code": "class_code",
+    "班级编号": "class_code",
+    "班级代码": "class_code",
+    "email": "email",
+    "邮箱": "email",
+    "status": "status",
+    "状态": "status",
+}
+
+# 各角色必需的列
+REQUIRED_COLUMNS = {
+    "student": ("student_no", "name", "password", "class_code"),
+    "teacher": ("teacher_no", "name", "password"),
+}
+
+ParsedRow = Tuple[int, Dict[str, str]]
+
+
+class ImportFormatError(ValueError):
+    """文件格式/表头不合法。"""
+
+
+def _cell(value: object) -> str:
+    if value is None:
+        return ""
+    # Excel 中的纯数字学号会被读成 float，如 20230001.0
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+
+def _map_header(header: List[object], role: str) -> List[Optional[str]]:
+    columns = [_HEADER_ALIASES.get(_cell(name).lower()) for name in header]
+    missing = [name for name in REQUIRED_COLUMNS[role] if name not in columns]
+    if missing:
+        raise ImportFormatError(f"缺少必需列: {', '.join(missing)}")
+    return columns
+
+
+def _iter_table(rows: Iterator[List[object]], role: str) -> Iterator[ParsedRow]:
+    header = next(rows, None)
+    if header is None:
+        raise ImportFormatError("文件为空")
+    columns = _map_header(list(header), role)
+    # 行号从表头所在的第 1 行起算，与表格软件中显示的行号一致
+    for line_no, values in enumerate(rows, start=2):
+        values = list(values)
+        if not any(_cell(value) for value in values):
+            continue
+        yield line_no, {
+            column: _cell(value)
+            for column, value in zip(columns, values)
+            if column is not None
+        }
+
+
+def _iter_csv(file: IO[bytes]) -> Iterator[List[object]]:
+    # utf-8-sig 兼容 Excel 导出 CSV 时写入的 BOM
+    text = codecs.getreader("utf-8-sig")(file)
+    try:
+        yield from csv.reader(text)
+    except UnicodeDecodeError:
+        raise ImportFormatError("CSV 文件需使用 UTF-8 编码")
+
+
+def _iter_xlsx(file: IO[bytes]) -> Iterator[List[object]]:
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise ImportFormatError("服务端未安装 openpyxl，暂不支持 XLSX，请上传 CSV")
+    try:
+        workbook = load_workbook(file, read_only=True, data_only=True)
+    except Exception:
+        raise ImportFormatError("XLSX 文件无法解析")
+    try:
+        for row in workbook.active.iter_rows(values_only=True):
+            yield list(row)
+    finally:
+        workbook.close()
+
+
+def iter_rows(file: IO[bytes], filename: str, role: str) -> Iterator[ParsedRow]:
+    """按文件扩展名选择解析器，逐行产出 (行号, 字段字典)。"""
+    name = (filename or "").lower()
+    if name.endswith(".csv"):
+        return _iter_table(_iter_csv(file), role)
+    if name.endswith(".xlsx"):
+        return _iter_table(_iter_xlsx(file), role)
+    raise ImportFormatError("仅支持 CSV 或 XLSX 文件")
+
+
+def take(rows: Iterator[ParsedRow], size: int) -> List[ParsedRow]:
+    """从迭代器中取出最多 size 行（供线程池分批读取）。"""
+    batch: List[ParsedRow] = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            break
+    return batch
@@ -0,0 +1,140 @@
+"""案例预览 chunk 缓存。
+
+点击查看案例时按 (dataset_id, document_id, chunk_id) 从 RAGFlow 取单个 chunk，
+热门案例会被反复打开。chunk 内容只在文档重新嵌入或删除时变化，这里按该三元组做
+LRU 缓存并限制总内存占用，文档变化时按 (dataset_id, document_id) 整体失效。
+"""
+
+import json
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Set, Tuple
+
+from app.config import get_settings
+
+settings = get_settings()
+
+ChunkKey = Tuple[str, str, str]
+DocumentKey = Tuple[str, str]
+
+
+class ChunkCache:
+    """进程内 LRU，按条目估算字节数控制内存上限。"""
+
+    def __init__(self, max_entries: int, max_bytes: int) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # key -> (估算字节数, chunk)
+        self._entries: "OrderedDict[ChunkKey, Tuple[int, Dict[str, Any]]]" = OrderedDict()
+        self._by_document: Dict[DocumentKey, Set[ChunkKey]] = {}
+        # 文档失效代数：查询开始后若文档被重新嵌入/删除，结果不再写入缓存。
+        # 只记录有查询在途的文档（_inflight 计数），查询全部结束后清除，避免字典只增不减
+        self._generations: Dict[DocumentKey, int] = {}
+        self._inflight: Dict[DocumentKey, int] = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.max_bytes > 0
+
+    def generation(self, dataset_id: str, document_id: str) -> int:
+        return self._generations.get((dataset_id, document_id), 0)
+
+    def begin(self, dataset_id: str, document_id: str) -> int:
+        """登记一次在途查询，返回当前代数；查询结束（无论成败）须调用 end。"""
+        doc_key = (dataset_id, document_id)
+        self._inflight[doc_key] = self._inflight.get(doc_key, 0) + 1
+        return self.generation(dataset_id, document_id)
+
+    def end(self, dataset_id: str, document_id: str) -> None:
+        doc_key = (dataset_id, document_id)
+        remaining = self._inflight.get(doc_key, 0) - 1
+        if remaining > 0:
+            self._inflight[doc_key] = remaining
+        else:
+            self._inflight.pop(doc_key, None)
+            self._generations.pop(doc_key, None)
+
+    def get(self, dataset_id: str, document_id: str, chunk_id: str) -> Optional[Dict[str, Any]]:
+        key = (dataset_id, document_id, chunk_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(
+        self,
+        dataset_id: str,
+        document_id: str,
+        chunk_id: str,
+        chunk: Dict[str, Any],
+        generation: Optional[int] = None,
+    ) -> bool:
+        """写入缓存；generation 与当前代数不一致（期间发生过失效）时放弃写入。"""
+        if not self.enabled:
+            return False
+        if generation is not None and generation != self.generation(dataset_id, document_id):
+            return False
+        size = len(json.dumps(chunk, ensure_ascii=False, default=str).encode("utf-8"))
+        if size > self.max_bytes:
+            return False
+        key = (dataset_id, document_id, chunk_id)
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (size, chunk)
+        self._by_document.setdefault((dataset_id, document_id), set()).add(key)
+        self.total_bytes += size
+        while len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+        return True
+
+    def invalidate_document(self, dataset_id: Optional[str], document_id: Optional[str]) -> None:
+        """文档重新嵌入/删除：清除该文档的全部缓存 chunk。"""
+        if not dataset_id or not document_id:
+            return
+        doc_key = (dataset_id, document_id)
+        if doc_key in self._inflight:
+            self._generations[doc_key] = self.generation(dataset_id, document_id) + 1
+        for key in list(self._by_document.get(doc_key, ())):
+            self._remove(key)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._by_document.clear()
+        self.total_bytes = 0
+
+    def _remove(self, key: ChunkKey) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.total_bytes -= entry[0]
+        doc_key = (key[0], key[1])
+        keys = self._by_document.get(doc_key)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                self._by_document.pop(doc_key, None)
+
+    def metrics(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+        }
+
+
+chunk_cache = ChunkCache(settings.chunk_cache_max_entries, settings.chunk_cache_max_bytes)
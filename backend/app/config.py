@@ -15,11 +15,92 @@ class Settings(BaseSettings):
     minio_secret_key: str
     minio_bucket_pending: str = "pending"
     minio_bucket_kb: str = "knowledge"
+    # 分片上传大小（字节），MinIO 要求不小于 5MB；决定单个上传的内存占用上限
+    upload_part_size: int = 10 * 1024 * 1024
+    # MinIO SDK 调用线程池大小（SDK 为阻塞调用，放到线程池避免卡住事件循环）
+    minio_max_workers: int = 8
 
     ragflow_base_url: AnyUrl = "http://localhost:8080"
     ragflow_api_key: str
     ragflow_host_header: Optional[str] = None
 
+    # RAGFlow 连接池与超时（秒）
+    ragflow_http2: bool = True
+    ragflow_max_connections: int = 100
+    ragflow_max_keepalive_connections: int = 20
+    ragflow_keepalive_expiry: float = 30.0
+    ragflow_connect_timeout: float = 5.0
+    ragflow_pool_timeout: float = 10.0
+    ragflow_timeout_default: float = 30.0
+    ragflow_timeout_upload: float = 60.0
+    ragflow_timeout_parse: float = 60.0
+    ragflow_timeout_completion: float = 60.0
+    ragflow_timeout_retrieval: float = 60.0
+
+    # 调用者身份缓存（秒）；管理员修改账号/班级时主动失效，TTL 兜底多进程一致性
+    principal_cache_ttl: float = 30.0
+    principal_cache_max_entries: int = 10000
+
+    # 文件名/搜索词关键字过滤：MySQL 使用 ngram 全文索引（token 长度需与服务端 ngram_token_size 一致）
+    fulltext_search: bool = True
+    fulltext_ngram_token_size: int = 2
+
+    # 列表接口 count=cached 时总数的缓存时间（秒）
+    list_count_cache_ttl: float = 60.0
+
+    # 检索结果缓存（POST /search），0 表示关闭
+    retrieval_cache_ttl: float = 300.0
+    retrieval_cache_max_entries: int = 2000
+    retrieval_cache_max_bytes: int = 64 * 1024 * 1024
+
+    # 检索命中文档信息缓存（ragflow_document_id -> 本地文档/班级），0 表示关闭；启动时预热
+    doc_hydration_max_entries: int = 50000
+    doc_hydration_warm_on_startup: bool = True
+
+    # 案例预览 chunk 缓存（/cases/preview），0 表示关闭；批量预览单次条数上限与并发数
+    chunk_cache_max_entries: int = 5000
+    chunk_cache_max_bytes: int = 32 * 1024 * 1024
+    chunk_preview_batch_max_items: int = 50
+    chunk_preview_batch_concurrency: int = 8
+
+    # 检索结果预取案例内容（prefetch=true）：默认与最大的单次响应内联字节预算
+    search_prefetch_budget_bytes: int = 512 * 1024
+    search_prefetch_max_budget_bytes: int = 4 * 1024 * 1024
+
+    # 多知识库并发检索：同时检索的知识库数上限与单个知识库的超时（秒）
+    search_fanout_concurrency: int = 4
+    search_fanout_kb_timeout: float = 10.0
+    search_fanout_max_kbs: int = 50
+    # 检索全部可访问知识库且超过 search_fanout_max_kbs 个时，每次 RAGFlow 检索合并的 dataset 数
+    search_fanout_datasets_per_call: int = 20
+
+    # 批量检索（POST /search/batch）：单次最多查询数与并发检索数
+    search_batch_max_queries: int = 200
+    search_batch_concurrency: int = 8
+
+    # 搜索日志批量写入：满 batch_size 条或每隔 flush_interval 秒写一次；缓冲超过 max_pending 时丢弃新日志
+    search_log_batch_size: int = 200
+    search_log_flush_interval: float = 1.0
+    search_log_max_pending: int = 10000
+
+    # 搜索统计概率摘要：HyperLogLog 精度（2^p 字节/摘要）与 Space-Saving 保留的搜索词数
+    search_sketch_hll_precision: int = 11
+    search_sketch_topk_capacity: int = 200
+
+    # 学生/教师账号批量导入：每批校验/插入的行数、单个文件最大行数、错误报告最多返回条数
+    account_import_batch_size: int = 500
+    account_import_max_rows: int = 20000
+    account_import_max_errors: int = 1000
+
+    # 嵌入任务队列
+    embedding_worker_count: int = 2  # 后台 worker 数，0 表示本进程不执行嵌入任务
+    embedding_poll_interval: float = 3.0  # 空闲轮询/解析进度轮询间隔（秒）
+    embedding_parse_timeout: float = 1800.0  # 单个文档解析最长等待（秒）
+    embedding_max_attempts: int = 3  # 暂时性失败的最大执行次数
+    embedding_retry_backoff: float = 10.0  # 重试退避基数（秒），按次数指数增长
+    embedding_batch_concurrency: int = 4  # 批量嵌入时并发上传 RAGFlow 的文档数
+    embedding_batch_max_documents: int = 500  # 单次批量嵌入的文档上限
+
     class Config:
         env_prefix = ""
         case_sensitive = False
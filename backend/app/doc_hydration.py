@@ -0,0 +1,154 @@
+"""检索命中 -> 本地文档信息的映射缓存。
+
+检索结果只带 RAGFlow 文档 id，需要关联本地 Document/KnowledgeBase/Class 才能展示文件名与班级。
+该映射只在嵌入、重命名、删除文档或修改班级时变化，这里常驻一份有上限的 LRU，
+启动时按已绑定 dataset 的知识库预热，相关写操作后主动失效，检索接口因此无需每次查库。
+"""
+
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import models
+from app.config import get_settings
+
+settings = get_settings()
+
+DocInfo = Dict[str, Any]
+
+
+def _query(ragflow_ids: Optional[List[str]] = None, limit: Optional[int] = None):
+    stmt = (
+        select(models.Document, models.KnowledgeBase, models.Class)
+        .join(models.KnowledgeBase, models.Document.kb_id == models.KnowledgeBase.id)
+        .join(models.Class, models.KnowledgeBase.class_id == models.Class.id)
+    )
+    if ragflow_ids is not None:
+        stmt = stmt.where(models.Document.ragflow_document_id.in_(ragflow_ids))
+    else:
+        stmt = stmt.where(
+            models.Document.ragflow_document_id.is_not(None),
+            models.KnowledgeBase.ragflow_dataset_id.is_not(None),
+        ).order_by(models.Document.updated_at.desc())
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    return stmt
+
+
+def _to_info(doc: models.Document, kb: models.KnowledgeBase, cls: models.Class) -> DocInfo:
+    return {
+        "document_id": doc.id,
+        "document_name": doc.original_name,
+        "kb_id": kb.id,
+        "class_id": cls.id,
+        "class_code": cls.class_code,
+        "class_name": cls.class_name,
+    }
+
+
+class DocumentHydrationCache:
+    """ragflow_document_id -> 文档信息的进程内 LRU。"""
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, DocInfo]" = OrderedDict()
+        # 本地文档 id -> ragflow_document_id，用于按文档失效
+        self._by_document: Dict[int, str] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def get_many(self, ragflow_ids: Iterable[str]) -> Tuple[Dict[str, DocInfo], List[str]]:
+        """返回 (已缓存的映射, 未命中的 id 列表)。"""
+        found: Dict[str, DocInfo] = {}
+        missing: List[str] = []
+        for ragflow_id in ragflow_ids:
+            info = self._entries.get(ragflow_id)
+            if info is None:
+                missing.append(ragflow_id)
+                continue
+            self._entries.move_to_end(ragflow_id)
+            found[ragflow_id] = info
+        self.hits += len(found)
+        self.misses += len(missing)
+        return found, missing
+
+    def put_many(self, mapping: Dict[str, DocInfo]) -> None:
+        if not self.enabled:
+            return
+        for ragflow_id, info in mapping.items():
+            previous = self._by_document.get(info["document_id"])
+            if previous and previous != ragflow_id:
+                self._remove(previous)
+            self._entries[ragflow_id] = info
+            self._entries.move_to_end(ragflow_id)
+            self._by_document[info["document_id"]] = ragflow_id
+        while len(self._entries) > self.max_entries:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    async def fetch(self, session: AsyncSession, ragflow_ids: Iterable[str]) -> Dict[str, DocInfo]:
+        """优先读缓存，未命中的 id 用一次三表联查补齐并回填。"""
+        found, missing = self.get_many(set(ragflow_ids))
+        if missing:
+            rows = (await session.execute(_query(missing))).all()
+            loaded = {doc.ragflow_document_id: _to_info(doc, kb, cls) for doc, kb, cls in rows}
+            self.put_many(loaded)
+            found.update(loaded)
+        return found
+
+    async def warm(self, session: AsyncSession) -> int:
+        """预热：加载已绑定 dataset 的知识库中最近更新的文档映射（不超过容量）。"""
+        if not self.enabled:
+            return 0
+        rows = (await session.execute(_query(limit=self.max_entries))).all()
+        # 按更新时间倒序加载，反向写入使最近更新的文档位于 LRU 尾部
+        self.put_many(
+            {doc.ragflow_document_id: _to_info(doc, kb, cls) for doc, kb, cls in reversed(rows)}
+        )
+        return len(rows)
+
+    def discard_document(self, document_id: int) -> None:
+        """文档嵌入/重命名/删除后失效。"""
+        ragflow_id = self._by_document.get(document_id)
+        if ragflow_id:
+            self._remove(ragflow_id)
+
+    def discard_class(self, class_id: int) -> None:
+        """班级编号/名称变化后失效该班级下的全部文档。"""
+        stale: Set[str] = {
+            ragflow_id for ragflow_id, info in self._entries.items() if info["class_id"] == class_id
+        }
+        for ragflow_id in stale:
+            self._remove(ragflow_id)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._by_document.clear()
+
+    def _remove(self, ragflow_id: str) -> None:
+        info = self._entries.pop(ragflow_id, None)
+        if info is not None and self._by_document.get(info["document_id"]) == ragflow_id:
+            self._by_document.pop(info["document_id"], None)
+
+    def metrics(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+        }
+
+
+doc_hydration = DocumentHydrationCache(settings.doc_hydration_max_entries)
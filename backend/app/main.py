@@ -1,28 +1,42 @@
-﻿from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form
-from fastapi.responses import StreamingResponse
+﻿from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form, Request
+from fastapi.responses import Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from sqlalchemy import select, or_, func, delete
+from sqlalchemy import select, and_, or_, func, delete, update, insert
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
-from urllib.parse import urlparse, quote
+from urllib.parse import quote
 from datetime import datetime, timedelta
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, AsyncIterator, BinaryIO, Set, Tuple
+from email.utils import formatdate
+import calendar
+import asyncio
+import base64
+import json
 import uuid
 import mimetypes
 import hashlib
-import io
+import logging
+import time
 
 import httpx
-from minio import Minio
 from minio.error import S3Error
-from minio.commonconfig import CopySource
 
 from app.config import get_settings
-from app.db import get_session
+from app.db import AsyncSessionLocal, get_session
 from app import models
+from app.account_import import ImportFormatError, iter_rows, take
+from app.chunk_cache import chunk_cache
+from app.doc_hydration import doc_hydration
+from app.principals import Principal, invalidate_principal, resolve_principal
+from app.ragflow import ragflow_client
+from app.retrieval_cache import make_key, retrieval_cache
+from app.search_log_writer import search_log_writer
+from app.search_stats import approximate_stats
+from app.storage import storage
 
 settings = get_settings()
+logger = logging.getLogger(__name__)
 app = FastAPI(title="CaseHub API", version="0.1.0")
 
 # 允许前端跨域访问（本地开发/容器访问）
@@ -40,11 +54,95 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+async def _start_ragflow_client() -> None:
+    """启动时创建 RAGFlow 连接池。"""
+    await ragflow_client.start()
+
+
+@app.on_event("startup")
+async def _provision_buckets() -> None:
+    """启动时预建存储桶；MinIO 暂不可用时不阻塞启动，首次访问时再创建。"""
+    for bucket in (settings.minio_bucket_pending, settings.minio_bucket_kb):
+        try:
+            await storage.ensure_bucket(bucket)
+        except Exception as exc:
+            logger.warning("MinIO 预建桶 %s 失败: %s", bucket, exc)
+
+
+@app.on_event("startup")
+async def _start_search_log_writer() -> None:
+    """启动搜索日志批量写入协程。"""
+    search_log_writer.start()
+
+
+@app.on_event("shutdown")
+async def _shutdown() -> None:
+    """按依赖倒序关闭（FastAPI 按注册顺序执行 shutdown，统一在这里控制先后）。
+
+    先停批量嵌入提交与嵌入 worker（执行中的任务还在使用 RAGFlow/MinIO，需在连接池关闭前放回队列），
+    再写完缓冲区中的搜索日志，最后释放 RAGFlow 连接池与对象存储线程池。
+    """
+    # 批量提交协程同样在使用 RAGFlow/MinIO：取消后其 finally 会把任务放回队列
+    for batch in list(_embedding_batches):
+        batch.cancel()
+    await asyncio.gather(*_embedding_batches, return_exceptions=True)
+    await _stop_embedding_workers()
+    await asyncio.gather(*_pending_answer_saves, return_exceptions=True)
+    await search_log_writer.stop()
+    await ragflow_client.close()
+    # 线程池 shutdown(wait=True) 为阻塞调用，放到线程中避免卡住事件循环
+    await asyncio.to_thread(storage.close)
+
+
+@app.on_event("startup")
+async def _warm_doc_hydration() -> None:
+    """预热检索命中文档信息缓存；失败不阻塞启动，检索时按需加载。"""
+    if not settings.doc_hydration_warm_on_startup:
+        return
+    try:
+        async with AsyncSessionLocal() as session:
+            loaded = await doc_hydration.warm(session)
+        logger.info("文档信息缓存预热完成，加载 %s 条", loaded)
+    except Exception as exc:
+        logger.warning("文档信息缓存预热失败: %s", exc)
+
+
 @app.get("/health")
 async def health():
     return {"status": "ok"}
 
 
+@app.get("/metrics/ragflow")
+async def ragflow_metrics():
+    """RAGFlow 连接池指标（在途请求数、饱和度、累计请求/错误等）。"""
+    return ragflow_client.metrics()
+
+
+@app.get("/metrics/retrieval-cache")
+async def retrieval_cache_metrics():
+    """检索结果缓存指标（条目数、占用字节、命中率等）。"""
+    return retrieval_cache.metrics()
+
+
+@app.get("/metrics/chunk-cache")
+async def chunk_cache_metrics():
+    """案例预览 chunk 缓存指标（条目数、占用字节、命中率等）。"""
+    return chunk_cache.metrics()
+
+
+@app.get("/metrics/doc-hydration")
+async def doc_hydration_metrics():
+    """检索命中文档信息缓存指标（条目数、命中率等）。"""
+    return doc_hydration.metrics()
+
+
+@app.get("/metrics/search-logs")
+async def search_log_metrics():
+    """搜索日志写入指标（待写入、已写入、丢弃/失败条数）。"""
+    return search_log_writer.metrics()
+
+
 @app.get("/config")
 async def read_config():
     return {
@@ -162,6 +260,17 @@ class EmbeddingRunRequest(BaseModel):
     chunk_method: Optional[str] = None
 
 
+class EmbeddingBatchRequest(BaseModel):
+    """批量嵌入请求体（按班级/知识库，或显式文档列表）。"""
+
+    teacher_id: int
+    kb_id: Optional[int] = None
+    class_id: Optional[int] = None
+    class_code: Optional[str] = None
+    document_ids: Optional[List[int]] = None
+    chunk_method: Optional[str] = None
+
+
 class SearchRequest(BaseModel):
     """搜索请求体。"""
 
@@ -174,6 +283,39 @@ class SearchRequest(BaseModel):
     top_k: int = 5
     similarity_threshold: Optional[float] = None
     highlight: bool = True
+    # 多知识库检索：传 kb_ids/class_ids，或 all_accessible=true 检索全部可访问的知识库
+    kb_ids: Optional[List[int]] = None
+    class_ids: Optional[List[int]] = None
+    all_accessible: bool = False
+    # 预取案例内容：在预算内把完整 chunk 随结果返回，并写入案例预览缓存
+    prefetch: bool = False
+    prefetch_budget_bytes: Optional[int] = None
+
+
+class BatchSearchRequest(BaseModel):
+    queries: List[str]
+    role: str
+    user_id: int
+    kb_id: Optional[int] = None
+    class_id: Optional[int] = None
+    class_code: Optional[str] = None
+    top_k: int = 5
+    similarity_threshold: Optional[float] = None
+    highlight: bool = True
+
+
+class CasePreviewItem(BaseModel):
+    ragflow_document_id: str
+    chunk_id: str
+
+
+class CasePreviewBatchRequest(BaseModel):
+    role: str
+    user_id: int
+    kb_id: Optional[int] = None
+    class_id: Optional[int] = None
+    class_code: Optional[str] = None
+    items: List[CasePreviewItem]
 
 
 class DocumentSearchRequest(BaseModel):
@@ -296,16 +438,40 @@ def _hash_password(password: str) -> str:
     return hashlib.sha256(password.encode("utf-8")).hexdigest()
 
 
-async def _require_admin(session: AsyncSession, admin_id: int) -> models.Admin:
+_ROLE_LABELS = {"student": "学生", "teacher": "教师", "admin": "管理员"}
+
+
+async def _get_active_principal(session: AsyncSession, role: str, user_id: int) -> Principal:
+    """解析调用者并校验账号启用（走身份缓存，命中时不查库）。"""
+    role = role.lower().strip()
+    if role not in _ROLE_LABELS:
+        raise HTTPException(status_code=400, detail="role 参数不合法")
+    principal = await resolve_principal(session, role, user_id)
+    if not principal or not principal.active:
+        raise HTTPException(status_code=403, detail=f"{_ROLE_LABELS[role]}不存在或已停用")
+    return principal
+
+
+async def get_principal(
+    role: str,
+    user_id: int,
+    session: AsyncSession = Depends(get_session),
+) -> Principal:
+    """FastAPI 依赖：按查询参数 role/user_id 解析当前调用者。"""
+    return await _get_active_principal(session, role, user_id)
+
+
+async def get_admin_principal(
+    admin_id: int,
+    session: AsyncSession = Depends(get_session),
+) -> Principal:
+    """FastAPI 依赖：按查询参数 admin_id 校验管理员。"""
+    return await _get_active_principal(session, "admin", admin_id)
+
+
+async def _require_admin(session: AsyncSession, admin_id: int) -> Principal:
     """校验管理员权限。"""
-    admin = (
-        await session.execute(
-            select(models.Admin).where(models.Admin.id == admin_id)
-        )
-    ).scalar_one_or_none()
-    if not admin or admin.status != 1:
-        raise HTTPException(status_code=403, detail="管理员不存在或已停用")
-    return admin
+    return await _get_active_principal(session, "admin", admin_id)
 
 
 def _normalize_system_prompt(system_prompt: str) -> str:
@@ -368,106 +534,151 @@ async def _login_student(payload: LoginRequest, session: AsyncSession):
     }
 
 
-def _get_minio_client() -> Minio:
-    """创建 MinIO 客户端。"""
-    endpoint = str(settings.minio_endpoint)
-    parsed = urlparse(endpoint)
-    if parsed.scheme:
-        host = parsed.netloc
-        secure = parsed.scheme == "https"
-    else:
-        host = endpoint
-        secure = False
-
-    return Minio(
-        host,
-        access_key=settings.minio_access_key,
-        secret_key=settings.minio_secret_key,
-        secure=secure,
-    )
+async def _ensure_bucket(bucket: str) -> None:
+    """确保桶存在（已确认的桶走进程内缓存，不再访问 MinIO）。"""
+    try:
+        await storage.ensure_bucket(bucket)
+    except S3Error as exc:
+        raise HTTPException(status_code=500, detail=f"MinIO 创建桶失败: {exc.code}")
+
 
+class _HashingReader:
+    """包装上传文件流：MinIO 按分片 read 时顺带累计 SHA256 与字节数。"""
 
-def _ragflow_headers() -> Dict[str, str]:
-    """构造 RAGFlow 请求头（可选指定 Host）。"""
-    headers = {"Authorization": f"Bearer {settings.ragflow_api_key}"}
-    if settings.ragflow_host_header:
-        headers["Host"] = settings.ragflow_host_header
-    return headers
+    def __init__(self, raw: BinaryIO) -> None:
+        self._raw = raw
+        self._sha256 = hashlib.sha256()
+        self.size = 0
 
+    def read(self, size: int = -1) -> bytes:
+        chunk = self._raw.read(size)
+        if chunk:
+            self._sha256.update(chunk)
+            self.size += len(chunk)
+        return chunk
 
-def _ensure_bucket(client: Minio, bucket: str) -> None:
-    """确保桶存在。"""
-    if not client.bucket_exists(bucket):
-        client.make_bucket(bucket)
+    def hexdigest(self) -> str:
+        return self._sha256.hexdigest()
 
 
-def _read_minio_object(client: Minio, bucket: str, object_name: str) -> bytes:
+async def _read_minio_object(bucket: str, object_name: str) -> bytes:
     """从 MinIO 读取对象内容。"""
     try:
-        obj = client.get_object(bucket, object_name)
-        try:
-            return obj.read()
-        finally:
-            obj.close()
-            obj.release_conn()
+        return await storage.read_object(bucket, object_name)
     except S3Error as exc:
         raise HTTPException(status_code=500, detail=f"MinIO 读取失败: {exc.code}")
 
 
-def _safe_remove_minio_object(client: Minio, bucket: str, object_name: str) -> None:
+def _document_etag(doc: models.Document) -> str:
+    """文件 ETag：优先使用内容哈希，缺失时退化为 id + 更新时间。"""
+    if doc.content_hash:
+        return f'"{doc.content_hash}"'
+    stamp = int(doc.updated_at.timestamp()) if doc.updated_at else 0
+    return f'"{doc.id}-{stamp}"'
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """判断 If-None-Match 是否命中当前 ETag（支持多个值与弱校验前缀）。"""
+    if not if_none_match:
+        return False
+    candidates = [item.strip() for item in if_none_match.split(",")]
+    return "*" in candidates or any(
+        item.removeprefix("W/") == etag for item in candidates
+    )
+
+
+def _parse_range_header(range_header: Optional[str], total: int) -> Optional[Tuple[int, int]]:
+    """解析单段 Range 头（bytes=start-end / bytes=start- / bytes=-suffix）。
+
+    返回闭区间 (start, end)；无 Range 或格式不支持时返回 None（按完整内容处理），
+    范围越界时返回 416。
+    """
+    if not range_header:
+        return None
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    start_text, sep, end_text = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if start_text:
+            start = int(start_text)
+            end = int(end_text) if end_text else total - 1
+        else:
+            suffix = int(end_text)
+            if suffix <= 0:
+                raise ValueError
+            start = max(total - suffix, 0)
+            end = total - 1
+    except ValueError:
+        return None
+
+    if start >= total or start > end:
+        raise HTTPException(
+            status_code=416,
+            detail="请求范围无效",
+            headers={"Content-Range": f"bytes */{total}"},
+        )
+    return start, min(end, total - 1)
+
+
+async def _safe_remove_minio_object(bucket: str, object_name: str) -> None:
     """安全删除 MinIO 对象（不存在则忽略）。"""
     try:
-        client.remove_object(bucket, object_name)
+        await storage.remove_object(bucket, object_name)
     except S3Error as exc:
         if exc.code in {"NoSuchKey", "NoSuchObject"}:
             return
         raise HTTPException(status_code=500, detail=f"MinIO 删除失败: {exc.code}")
 
 
-async def _check_document_permission(
-    session: AsyncSession,
-    role: str,
-    user_id: int,
-    cls: models.Class,
-) -> None:
+def _check_document_permission(principal: Principal, cls: models.Class) -> None:
     """校验单个文档的访问权限。"""
-    role = role.lower().strip()
+    if principal.role == "student" and principal.class_id != cls.id:
+        raise HTTPException(status_code=403, detail="无权访问该班级文件")
+    if principal.role == "teacher" and cls.teacher_id != principal.user_id:
+        raise HTTPException(status_code=403, detail="无权访问该班级文件")
 
-    if role == "student":
-        student = (
-            await session.execute(
-                select(models.Student).where(models.Student.id == user_id)
-            )
-        ).scalar_one_or_none()
-        if not student or student.status != 1:
-            raise HTTPException(status_code=403, detail="学生不存在或已停用")
-        if student.class_id != cls.id:
-            raise HTTPException(status_code=403, detail="无权访问该班级文件")
-        return
 
-    if role == "teacher":
-        teacher = (
-            await session.execute(
-                select(models.Teacher).where(models.Teacher.id == user_id)
-            )
-        ).scalar_one_or_none()
-        if not teacher or teacher.status != 1:
-            raise HTTPException(status_code=403, detail="教师不存在或已停用")
-        if cls.teacher_id != teacher.id:
-            raise HTTPException(status_code=403, detail="无权访问该班级文件")
-        return
+# 上传人角色 -> (模型, 编号字段, 文档外键字段)
+_UPLOADER_SOURCES = (
+    ("student", models.Student, models.Student.student_no, "uploader_student_id"),
+    ("teacher", models.Teacher, models.Teacher.teacher_no, "uploader_teacher_id"),
+    ("admin", models.Admin, models.Admin.admin_no, "uploader_admin_id"),
+)
 
-    if role == "admin":
-        admin = (
+
+async def _get_uploaders_info(
+    session: AsyncSession,
+    docs: List[models.Document],
+) -> Dict[int, Optional[Dict[str, Any]]]:
+    """批量获取文档上传人信息，返回 {document_id: uploader}；每种角色最多一次 IN 查询。"""
+    found: Dict[str, Dict[int, Dict[str, Any]]] = {}
+    for role, model, no_column, attr in _UPLOADER_SOURCES:
+        ids = {getattr(doc, attr) for doc in docs if getattr(doc, attr)}
+        if not ids:
+            continue
+        rows = (
             await session.execute(
-                select(models.Admin).where(models.Admin.id == user_id)
+                select(model.id, no_column, model.name).where(model.id.in_(ids))
             )
-        ).scalar_one_or_none()
-        if not admin or admin.status != 1:
-            raise HTTPException(status_code=403, detail="管理员不存在或已停用")
-        return
+        ).all()
+        found[role] = {
+            row[0]: {"role": role, "id": row[0], "no": row[1], "name": row[2]}
+            for row in rows
+        }
 
-    raise HTTPException(status_code=400, detail="role 参数不合法")
+    result: Dict[int, Optional[Dict[str, Any]]] = {}
+    for doc in docs:
+        uploader = None
+        for role, _, _, attr in _UPLOADER_SOURCES:
+            uploader_id = getattr(doc, attr)
+            if uploader_id and uploader_id in found.get(role, {}):
+                uploader = found[role][uploader_id]
+                break
+        result[doc.id] = uploader
+    return result
 
 
 async def _get_uploader_info(
@@ -475,46 +686,26 @@ async def _get_uploader_info(
     doc: models.Document,
 ) -> Optional[Dict[str, Any]]:
     """获取文档上传人信息（角色/编号/姓名）。"""
-    if doc.uploader_student_id:
-        student = (
-            await session.execute(
-                select(models.Student).where(models.Student.id == doc.uploader_student_id)
-            )
-        ).scalar_one_or_none()
-        if student:
-            return {
-                "role": "student",
-                "id": student.id,
-                "no": student.student_no,
-                "name": student.name,
-            }
-    if doc.uploader_teacher_id:
-        teacher = (
-            await session.execute(
-                select(models.Teacher).where(models.Teacher.id == doc.uploader_teacher_id)
-            )
-        ).scalar_one_or_none()
-        if teacher:
-            return {
-                "role": "teacher",
-                "id": teacher.id,
-                "no": teacher.teacher_no,
-                "name": teacher.name,
-            }
-    if doc.uploader_admin_id:
-        admin = (
-            await session.execute(
-                select(models.Admin).where(models.Admin.id == doc.uploader_admin_id)
-            )
-        ).scalar_one_or_none()
-        if admin:
-            return {
-                "role": "admin",
-                "id": admin.id,
-                "no": admin.admin_no,
-                "name": admin.name,
-            }
-    return None
+    return (await _get_uploaders_info(session, [doc])).get(doc.id)
+
+
+# 对话列表中最后一条消息预览的最大字符数
+_LAST_MESSAGE_PREVIEW_CHARS = 200
+
+
+def _set_last_message(conv: models.Conversation, msg: models.Message) -> None:
+    """维护对话上的最后一条消息冗余字段（消息需已 flush 以获得 id）。"""
+    conv.last_message_id = msg.id
+    conv.last_message_role = msg.sender_role
+    conv.last_message_preview = (msg.content or "")[:_LAST_MESSAGE_PREVIEW_CHARS]
+    conv.last_message_at = msg.created_at
+
+
+def _clear_last_message(conv: models.Conversation) -> None:
+    conv.last_message_id = None
+    conv.last_message_role = None
+    conv.last_message_preview = None
+    conv.last_message_at = None
 
 
 async def _get_conversation_for_owner(
@@ -546,8 +737,6 @@ async def _get_conversation_for_owner(
 
 async def _create_ragflow_dataset(payload: CreateClassRequest) -> str:
     """调用 RAGFlow 创建数据集，返回 dataset_id。"""
-    base_url = str(settings.ragflow_base_url).rstrip("/")
-    headers = _ragflow_headers()
     body = {
         "name": payload.class_code,
         "embedding_model": payload.embedding_model,
@@ -558,8 +747,7 @@ async def _create_ragflow_dataset(payload: CreateClassRequest) -> str:
     if payload.description:
         body["description"] = payload.description
 
-    async with httpx.AsyncClient(timeout=30) as client:
-        resp = await client.post(f"{base_url}/api/v1/datasets", json=body, headers=headers)
+    resp = await ragflow_client.request("POST", "/api/v1/datasets", json=body)
 
     if resp.status_code >= 400:
         raise HTTPException(status_code=502, detail=f"RAGFlow 创建失败: HTTP {resp.status_code}")
@@ -581,16 +769,14 @@ async def _create_ragflow_dataset(payload: CreateClassRequest) -> str:
 
 async def _ragflow_upload_document(dataset_id: str, filename: str, data: bytes, content_type: str) -> str:
     """上传文件到 RAGFlow，返回 ragflow_document_id。"""
-    base_url = str(settings.ragflow_base_url).rstrip("/")
-    headers = _ragflow_headers()
     files = {"file": (filename, data, content_type)}
 
-    async with httpx.AsyncClient(timeout=60) as client:
-        resp = await client.post(
-            f"{base_url}/api/v1/datasets/{dataset_id}/documents",
-            headers=headers,
-            files=files,
-        )
+    resp = await ragflow_client.request(
+        "POST",
+        f"/api/v1/datasets/{dataset_id}/documents",
+        endpoint="upload",
+        files=files,
+    )
 
     if resp.status_code >= 400:
         raise HTTPException(status_code=502, detail=f"RAGFlow 上传失败: HTTP {resp.status_code}")
@@ -613,16 +799,14 @@ async def _ragflow_upload_document(dataset_id: str, filename: str, data: bytes,
 
 async def _ragflow_parse_documents(dataset_id: str, document_ids: List[str]) -> None:
     """调用 RAGFlow 进行解析/嵌入。"""
-    base_url = str(settings.ragflow_base_url).rstrip("/")
-    headers = _ragflow_headers()
     body = {"document_ids": document_ids}
 
-    async with httpx.AsyncClient(timeout=60) as client:
-        resp = await client.post(
-            f"{base_url}/api/v1/datasets/{dataset_id}/chunks",
-            headers=headers,
-            json=body,
-        )
+    resp = await ragflow_client.request(
+        "POST",
+        f"/api/v1/datasets/{dataset_id}/chunks",
+        endpoint="parse",
+        json=body,
+    )
 
     if resp.status_code >= 400:
         raise HTTPException(status_code=502, detail=f"RAGFlow 解析失败: HTTP {resp.status_code}")
@@ -633,18 +817,39 @@ async def _ragflow_parse_documents(dataset_id: str, document_ids: List[str]) ->
         raise HTTPException(status_code=502, detail=f"RAGFlow 解析失败: {message}")
 
 
+async def _ragflow_get_document(dataset_id: str, document_id: str) -> Dict[str, Any]:
+    """查询 RAGFlow 文档信息（含解析状态 run/progress/progress_msg）。"""
+    params = {"id": document_id, "page": 1, "page_size": 1}
+
+    resp = await ragflow_client.request(
+        "GET",
+        f"/api/v1/datasets/{dataset_id}/documents",
+        params=params,
+    )
+
+    if resp.status_code >= 400:
+        raise HTTPException(status_code=502, detail=f"RAGFlow 查询文档失败: HTTP {resp.status_code}")
+
+    payload = resp.json()
+    if payload.get("code") != 0:
+        message = payload.get("message", "未知错误")
+        raise HTTPException(status_code=502, detail=f"RAGFlow 查询文档失败: {message}")
+
+    docs = (payload.get("data") or {}).get("docs") or []
+    if not docs:
+        raise HTTPException(status_code=404, detail="RAGFlow 文档不存在")
+    return docs[0]
+
+
 async def _ragflow_update_document_name(dataset_id: str, document_id: str, new_name: str) -> None:
     """同步更新 RAGFlow 文档名称。"""
-    base_url = str(settings.ragflow_base_url).rstrip("/")
-    headers = _ragflow_headers()
     body = {"name": new_name}
 
-    async with httpx.AsyncClient(timeout=30) as client:
-        resp = await client.put(
-            f"{base_url}/api/v1/datasets/{dataset_id}/documents/{document_id}",
-            headers=headers,
-            json=body,
-        )
+    resp = await ragflow_client.request(
+        "PUT",
+        f"/api/v1/datasets/{dataset_id}/documents/{document_id}",
+        json=body,
+    )
 
     if resp.status_code >= 400:
         raise HTTPException(status_code=502, detail=f"RAGFlow 重命名失败: HTTP {resp.status_code}")
@@ -659,18 +864,14 @@ async def _ragflow_delete_documents(dataset_id: str, document_ids: List[str]) ->
     """同步删除 RAGFlow 文档。"""
     if not document_ids:
         return
-    base_url = str(settings.ragflow_base_url).rstrip("/")
-    headers = _ragflow_headers()
     body = {"ids": document_ids}
 
-    async with httpx.AsyncClient(timeout=30) as client:
-        # httpx 旧版本 delete 不支持 json 参数，使用 request 兼容
-        resp = await client.request(
-            "DELETE",
-            f"{base_url}/api/v1/datasets/{dataset_id}/documents",
-            headers=headers,
-            json=body,
-        )
+    # httpx 旧版本 delete 不支持 json 参数，使用 request 兼容
+    resp = await ragflow_client.request(
+        "DELETE",
+        f"/api/v1/datasets/{dataset_id}/documents",
+        json=body,
+    )
 
     if resp.status_code >= 400:
         raise HTTPException(status_code=502, detail=f"RAGFlow 删除失败: HTTP {resp.status_code}")
@@ -683,16 +884,13 @@ async def _ragflow_delete_documents(dataset_id: str, document_ids: List[str]) ->
 
 async def _ragflow_get_chunk(dataset_id: str, document_id: str, chunk_id: str) -> Dict[str, Any]:
     """从 RAGFlow 查询单个 chunk 内容，用于“点击查看案例”。"""
-    base_url = str(settings.ragflow_base_url).rstrip("/")
-    headers = _ragflow_headers()
     params = {"id": chunk_id, "page": 1, "page_size": 1}
 
-    async with httpx.AsyncClient(timeout=30) as client:
-        resp = await client.get(
-            f"{base_url}/api/v1/datasets/{dataset_id}/documents/{document_id}/chunks",
-            headers=headers,
-            params=params,
-        )
+    resp = await ragflow_client.request(
+        "GET",
+        f"/api/v1/datasets/{dataset_id}/documents/{document_id}/chunks",
+        params=params,
+    )
 
     if resp.status_code >= 400:
         raise HTTPException(status_code=502, detail=f"RAGFlow 查询 chunk 失败: HTTP {resp.status_code}")
@@ -721,6 +919,77 @@ async def _ragflow_get_chunk(dataset_id: str, document_id: str, chunk_id: str) -
     return chunk
 
 
+async def _cached_get_chunk(
+    dataset_id: str,
+    document_id: str,
+    chunk_id: str,
+) -> Tuple[Dict[str, Any], bool]:
+    """带缓存的单个 chunk 查询，返回 (chunk, 是否命中缓存)。"""
+    cached = chunk_cache.get(dataset_id, document_id, chunk_id)
+    if cached is not None:
+        return cached, True
+    generation = chunk_cache.begin(dataset_id, document_id)
+    try:
+        chunk = await _ragflow_get_chunk(dataset_id, document_id, chunk_id)
+        chunk_cache.put(dataset_id, document_id, chunk_id, chunk, generation)
+    finally:
+        chunk_cache.end(dataset_id, document_id)
+    return chunk, False
+
+
+async def _ragflow_retrieve(
+    dataset_ids: List[str],
+    question: str,
+    top_k: int,
+    similarity_threshold: Optional[float],
+    highlight: bool,
+) -> List[Dict[str, Any]]:
+    """调用 RAGFlow 检索接口，返回原始 chunks。"""
+    body: Dict[str, Any] = {
+        "question": question,
+        "dataset_ids": dataset_ids,
+        "top_k": top_k,
+        "highlight": highlight,
+    }
+    if similarity_threshold is not None:
+        body["similarity_threshold"] = similarity_threshold
+
+    resp = await ragflow_client.request(
+        "POST",
+        "/api/v1/retrieval",
+        endpoint="retrieval",
+        json=body,
+    )
+
+    if resp.status_code >= 400:
+        raise HTTPException(status_code=502, detail=f"RAGFlow 检索失败: HTTP {resp.status_code}")
+
+    data = resp.json()
+    if data.get("code") != 0:
+        message = data.get("message", "未知错误")
+        raise HTTPException(status_code=502, detail=f"RAGFlow 检索失败: {message}")
+
+    return (data.get("data") or {}).get("chunks", [])
+
+
+async def _cached_retrieve(
+    dataset_id: str,
+    question: str,
+    top_k: int,
+    similarity_threshold: Optional[float],
+    highlight: bool,
+) -> Tuple[List[Dict[str, Any]], bool]:
+    """带缓存的单知识库检索，返回 (chunks, 是否命中缓存)。"""
+    key = make_key(dataset_id, question, top_k, similarity_threshold, highlight)
+    cached = retrieval_cache.get(key)
+    if cached is not None:
+        return cached, True
+    generation = retrieval_cache.generation(dataset_id)
+    chunks = await _ragflow_retrieve([dataset_id], question, top_k, similarity_threshold, highlight)
+    retrieval_cache.put(key, chunks, generation)
+    return chunks, False
+
+
 async def _ragflow_create_chat_assistant(
     name: str,
     dataset_ids: List[str],
@@ -730,8 +999,6 @@ async def _ragflow_create_chat_assistant(
     similarity_threshold: Optional[float] = None,
 ) -> str:
     """创建 RAGFlow 聊天助手，返回 chat_id。"""
-    base_url = str(settings.ragflow_base_url).rstrip("/")
-    headers = _ragflow_headers()
     body: Dict[str, Any] = {
         "name": name,
         "dataset_ids": dataset_ids,
@@ -752,8 +1019,7 @@ async def _ragflow_create_chat_assistant(
             prompt["similarity_threshold"] = similarity_threshold
         body["prompt"] = prompt
 
-    async with httpx.AsyncClient(timeout=30) as client:
-        resp = await client.post(f"{base_url}/api/v1/chats", json=body, headers=headers)
+    resp = await ragflow_client.request("POST", "/api/v1/chats", json=body)
 
     if resp.status_code >= 400:
         raise HTTPException(status_code=502, detail=f"RAGFlow 创建聊天助手失败: HTTP {resp.status_code}")
@@ -773,18 +1039,15 @@ async def _ragflow_create_chat_assistant(
 
 async def _ragflow_create_session(chat_id: str, name: str, user_id: Optional[str]) -> str:
     """创建 RAGFlow 会话，返回 session_id。"""
-    base_url = str(settings.ragflow_base_url).rstrip("/")
-    headers = _ragflow_headers()
     body: Dict[str, Any] = {"name": name}
     if user_id:
         body["user_id"] = user_id
 
-    async with httpx.AsyncClient(timeout=30) as client:
-        resp = await client.post(
-            f"{base_url}/api/v1/chats/{chat_id}/sessions",
-            headers=headers,
-            json=body,
-        )
+    resp = await ragflow_client.request(
+        "POST",
+        f"/api/v1/chats/{chat_id}/sessions",
+        json=body,
+    )
 
     if resp.status_code >= 400:
         raise HTTPException(status_code=502, detail=f"RAGFlow 创建会话失败: HTTP {resp.status_code}")
@@ -804,16 +1067,13 @@ async def _ragflow_create_session(chat_id: str, name: str, user_id: Optional[str
 
 async def _ragflow_update_chat_name(chat_id: str, new_name: str) -> None:
     """同步更新 RAGFlow 聊天助手名称。"""
-    base_url = str(settings.ragflow_base_url).rstrip("/")
-    headers = _ragflow_headers()
     body = {"name": new_name}
 
-    async with httpx.AsyncClient(timeout=30) as client:
-        resp = await client.put(
-            f"{base_url}/api/v1/chats/{chat_id}",
-            headers=headers,
-            json=body,
-        )
+    resp = await ragflow_client.request(
+        "PUT",
+        f"/api/v1/chats/{chat_id}",
+        json=body,
+    )
 
     if resp.status_code >= 400:
         raise HTTPException(status_code=502, detail=f"RAGFlow 对话重命名失败: HTTP {resp.status_code}")
@@ -826,16 +1086,13 @@ async def _ragflow_update_chat_name(chat_id: str, new_name: str) -> None:
 
 async def _ragflow_update_session_name(chat_id: str, session_id: str, new_name: str) -> None:
     """同步更新 RAGFlow 会话名称。"""
-    base_url = str(settings.ragflow_base_url).rstrip("/")
-    headers = _ragflow_headers()
     body = {"name": new_name}
 
-    async with httpx.AsyncClient(timeout=30) as client:
-        resp = await client.put(
-            f"{base_url}/api/v1/chats/{chat_id}/sessions/{session_id}",
-            headers=headers,
-            json=body,
-        )
+    resp = await ragflow_client.request(
+        "PUT",
+        f"/api/v1/chats/{chat_id}/sessions/{session_id}",
+        json=body,
+    )
 
     if resp.status_code >= 400:
         raise HTTPException(status_code=502, detail=f"RAGFlow 会话重命名失败: HTTP {resp.status_code}")
@@ -850,15 +1107,12 @@ async def _ragflow_update_chat_settings(chat_id: str, body: Dict[str, Any]) -> N
     """同步更新 RAGFlow 聊天助手配置。"""
     if not body:
         return
-    base_url = str(settings.ragflow_base_url).rstrip("/")
-    headers = _ragflow_headers()
-
-    async with httpx.AsyncClient(timeout=30) as client:
-        resp = await client.put(
-            f"{base_url}/api/v1/chats/{chat_id}",
-            headers=headers,
-            json=body,
-        )
+
+    resp = await ragflow_client.request(
+        "PUT",
+        f"/api/v1/chats/{chat_id}",
+        json=body,
+    )
 
     if resp.status_code >= 400:
         raise HTTPException(status_code=502, detail=f"RAGFlow 更新对话设置失败: HTTP {resp.status_code}")
@@ -873,17 +1127,13 @@ async def _ragflow_delete_chats(chat_ids: List[str]) -> None:
     """同步删除 RAGFlow 聊天助手。"""
     if not chat_ids:
         return
-    base_url = str(settings.ragflow_base_url).rstrip("/")
-    headers = _ragflow_headers()
     body = {"ids": chat_ids}
 
-    async with httpx.AsyncClient(timeout=30) as client:
-        resp = await client.request(
-            "DELETE",
-            f"{base_url}/api/v1/chats",
-            headers=headers,
-            json=body,
-        )
+    resp = await ragflow_client.request(
+        "DELETE",
+        "/api/v1/chats",
+        json=body,
+    )
 
     if resp.status_code >= 400:
         raise HTTPException(status_code=502, detail=f"RAGFlow 删除对话失败: HTTP {resp.status_code}")
@@ -898,17 +1148,13 @@ async def _ragflow_delete_sessions(chat_id: str, session_ids: List[str]) -> None
     """同步删除 RAGFlow 会话。"""
     if not session_ids:
         return
-    base_url = str(settings.ragflow_base_url).rstrip("/")
-    headers = _ragflow_headers()
     body = {"ids": session_ids}
 
-    async with httpx.AsyncClient(timeout=30) as client:
-        resp = await client.request(
-            "DELETE",
-            f"{base_url}/api/v1/chats/{chat_id}/sessions",
-            headers=headers,
-            json=body,
-        )
+    resp = await ragflow_client.request(
+        "DELETE",
+        f"/api/v1/chats/{chat_id}/sessions",
+        json=body,
+    )
 
     if resp.status_code >= 400:
         raise HTTPException(status_code=502, detail=f"RAGFlow 删除会话失败: HTTP {resp.status_code}")
@@ -928,25 +1174,14 @@ async def _ragflow_chat_completion(
     metadata_condition: Optional[dict] = None,
 ) -> Dict[str, Any]:
     """调用 RAGFlow 会话对话接口。"""
-    base_url = str(settings.ragflow_base_url).rstrip("/")
-    headers = _ragflow_headers()
-    body: Dict[str, Any] = {
-        "question": question,
-        "stream": stream,
-    }
-    if session_id:
-        body["session_id"] = session_id
-    elif user_id:
-        body["user_id"] = user_id
-    if metadata_condition:
-        body["metadata_condition"] = metadata_condition
+    body = _build_completion_body(question, session_id, user_id, stream, metadata_condition)
 
-    async with httpx.AsyncClient(timeout=60) as client:
-        resp = await client.post(
-            f"{base_url}/api/v1/chats/{chat_id}/completions",
-            headers=headers,
-            json=body,
-        )
+    resp = await ragflow_client.request(
+        "POST",
+        f"/api/v1/chats/{chat_id}/completions",
+        endpoint="completion",
+        json=body,
+    )
 
     if resp.status_code >= 400:
         raise HTTPException(status_code=502, detail=f"RAGFlow 对话失败: HTTP {resp.status_code}")
@@ -960,35 +1195,124 @@ async def _ragflow_chat_completion(
     return {"data": data, "raw": payload}
 
 
-async def _resolve_kb(
-    session: AsyncSession,
-    role: str,
-    uploader_id: int,
-    class_id: Optional[int],
-    class_code: Optional[str],
-    kb_id: Optional[int],
-) -> models.KnowledgeBase:
-    """根据角色和传参定位知识库。"""
-    if kb_id:
-        kb = (
-            await session.execute(
-                select(models.KnowledgeBase).where(models.KnowledgeBase.id == kb_id)
-            )
-        ).scalar_one_or_none()
-        if kb:
-            return kb
+def _build_completion_body(
+    question: str,
+    session_id: Optional[str],
+    user_id: Optional[str],
+    stream: bool,
+    metadata_condition: Optional[dict],
+) -> Dict[str, Any]:
+    """构造会话对话请求体。"""
+    body: Dict[str, Any] = {
+        "question": question,
+        "stream": stream,
+    }
+    if session_id:
+        body["session_id"] = session_id
+    elif user_id:
+        body["user_id"] = user_id
+    if metadata_condition:
+        body["metadata_condition"] = metadata_condition
+    return body
 
-    if role == "student":
-        student = (
-            await session.execute(
-                select(models.Student).where(models.Student.id == uploader_id)
-            )
-        ).scalar_one_or_none()
-        if not student:
-            raise HTTPException(status_code=404, detail="学生不存在")
-        kb = (
-            await session.execute(
-                select(models.KnowledgeBase).where(
+
+async def _ragflow_chat_completion_stream(
+    chat_id: str,
+    question: str,
+    session_id: Optional[str],
+    user_id: Optional[str],
+    metadata_condition: Optional[dict] = None,
+) -> AsyncIterator[Dict[str, Any]]:
+    """流式调用 RAGFlow 会话对话接口，逐条产出 SSE 事件的 JSON 负载。
+
+    RAGFlow 每条事件的 answer 为累计文本，最后一条为 data: true（结束标记，不产出）。
+    """
+    body = _build_completion_body(question, session_id, user_id, True, metadata_condition)
+
+    async with ragflow_client.stream(
+        "POST",
+        f"/api/v1/chats/{chat_id}/completions",
+        endpoint="completion",
+        json=body,
+    ) as resp:
+        if resp.status_code >= 400:
+            raise HTTPException(status_code=502, detail=f"RAGFlow 对话失败: HTTP {resp.status_code}")
+
+        async for line in resp.aiter_lines():
+            line = line.strip()
+            if line.startswith("data:"):
+                line = line[len("data:"):].strip()
+            # 失败时 RAGFlow 直接返回普通 JSON（无 data: 前缀）
+            if not line.startswith("{"):
+                continue
+            try:
+                payload = json.loads(line)
+            except ValueError:
+                continue
+            if payload.get("code") != 0:
+                message = payload.get("message", "未知错误")
+                raise HTTPException(status_code=502, detail=f"RAGFlow 对话失败: {message}")
+            if not isinstance(payload.get("data"), dict):
+                return
+            yield payload
+
+
+def _extract_completion_answer(data: Any) -> str:
+    """尽量从 RAGFlow 对话结果中提取回答文本。"""
+    answer = ""
+    if isinstance(data, dict):
+        for key in ("answer", "content", "result", "response", "text"):
+            if data.get(key):
+                answer = data.get(key)
+                break
+        if not answer and isinstance(data.get("choices"), list):
+            choice = data["choices"][0] if data["choices"] else None
+            if isinstance(choice, dict):
+                msg = choice.get("message") or choice.get("delta") or {}
+                if isinstance(msg, dict) and msg.get("content"):
+                    answer = msg.get("content")
+    return answer
+
+
+def _extract_completion_reference(data: Any) -> Optional[Any]:
+    """从 RAGFlow 对话结果中提取引用信息。"""
+    reference = None
+    if isinstance(data, dict):
+        if data.get("reference") or data.get("references"):
+            reference = data.get("reference") or data.get("references")
+        elif data.get("chunks") or data.get("doc_aggs"):
+            reference = {
+                "chunks": data.get("chunks"),
+                "doc_aggs": data.get("doc_aggs"),
+            }
+    return reference
+
+
+async def _resolve_kb(
+    session: AsyncSession,
+    role: str,
+    uploader_id: int,
+    class_id: Optional[int],
+    class_code: Optional[str],
+    kb_id: Optional[int],
+) -> models.KnowledgeBase:
+    """根据角色和传参定位知识库。"""
+    if kb_id:
+        kb = (
+            await session.execute(
+                select(models.KnowledgeBase).where(models.KnowledgeBase.id == kb_id)
+            )
+        ).scalar_one_or_none()
+        if kb:
+            return kb
+
+    if role == "student":
+        student = await resolve_principal(session, "student", uploader_id)
+        if not student:
+            raise HTTPException(status_code=404, detail="学生不存在")
+        kb = (
+            await session.execute(
+                select(models.KnowledgeBase).where(
                     models.KnowledgeBase.class_id == student.class_id
                 )
             )
@@ -1043,13 +1367,7 @@ async def _resolve_kb_for_search(
 
     # 学生：只能访问自己班级
     if role == "student":
-        student = (
-            await session.execute(
-                select(models.Student).where(models.Student.id == user_id)
-            )
-        ).scalar_one_or_none()
-        if not student or student.status != 1:
-            raise HTTPException(status_code=403, detail="学生不存在或已停用")
+        student = await _get_active_principal(session, "student", user_id)
 
         if kb_id is not None:
             kb = (
@@ -1079,13 +1397,7 @@ async def _resolve_kb_for_search(
 
     # 教师：如果只有一个班级可自动选择；多个班级则必须选择
     if role == "teacher":
-        teacher = (
-            await session.execute(
-                select(models.Teacher).where(models.Teacher.id == user_id)
-            )
-        ).scalar_one_or_none()
-        if not teacher or teacher.status != 1:
-            raise HTTPException(status_code=403, detail="教师不存在或已停用")
+        teacher = await _get_active_principal(session, "teacher", user_id)
 
         if kb_id is not None:
             kb = (
@@ -1095,32 +1407,22 @@ async def _resolve_kb_for_search(
             ).scalar_one_or_none()
             if not kb:
                 raise HTTPException(status_code=404, detail="知识库不存在")
-            cls = (
-                await session.execute(
-                    select(models.Class).where(models.Class.id == kb.class_id)
-                )
-            ).scalar_one_or_none()
-            if not cls or cls.teacher_id != teacher.id:
+            if kb.class_id not in teacher.class_ids:
                 raise HTTPException(status_code=403, detail="无权访问该知识库")
             return kb
 
         if class_id is None:
-            classes = (
-                await session.execute(
-                    select(models.Class).where(models.Class.teacher_id == teacher.id)
-                )
-            ).scalars().all()
-            if len(classes) == 1:
-                class_id = classes[0].id
+            if len(teacher.class_ids) == 1:
+                class_id = next(iter(teacher.class_ids))
             else:
                 raise HTTPException(status_code=400, detail="请先选择班级")
 
-        cls = (
-            await session.execute(select(models.Class).where(models.Class.id == class_id))
-        ).scalar_one_or_none()
-        if not cls:
-            raise HTTPException(status_code=404, detail="班级不存在")
-        if cls.teacher_id != teacher.id:
+        if class_id not in teacher.class_ids:
+            cls = (
+                await session.execute(select(models.Class).where(models.Class.id == class_id))
+            ).scalar_one_or_none()
+            if not cls:
+                raise HTTPException(status_code=404, detail="班级不存在")
             raise HTTPException(status_code=403, detail="无权访问该班级")
 
         kb = (
@@ -1187,13 +1489,7 @@ async def _resolve_document_scope(
 
     # 学生：只能查看自己班级
     if role == "student":
-        student = (
-            await session.execute(
-                select(models.Student).where(models.Student.id == user_id)
-            )
-        ).scalar_one_or_none()
-        if not student or student.status != 1:
-            raise HTTPException(status_code=403, detail="学生不存在或已停用")
+        student = await _get_active_principal(session, "student", user_id)
 
         if class_id is not None and class_id != student.class_id:
             raise HTTPException(status_code=403, detail="无权访问该班级")
@@ -1214,13 +1510,7 @@ async def _resolve_document_scope(
 
     # 教师：若有多个班级，必须选择
     if role == "teacher":
-        teacher = (
-            await session.execute(
-                select(models.Teacher).where(models.Teacher.id == user_id)
-            )
-        ).scalar_one_or_none()
-        if not teacher or teacher.status != 1:
-            raise HTTPException(status_code=403, detail="教师不存在或已停用")
+        teacher = await _get_active_principal(session, "teacher", user_id)
 
         if kb_id is not None:
             kb = (
@@ -1230,37 +1520,27 @@ async def _resolve_document_scope(
             ).scalar_one_or_none()
             if not kb:
                 raise HTTPException(status_code=404, detail="知识库不存在")
-            cls = (
-                await session.execute(
-                    select(models.Class).where(models.Class.id == kb.class_id)
-                )
-            ).scalar_one_or_none()
-            if not cls or cls.teacher_id != teacher.id:
+            if kb.class_id not in teacher.class_ids:
                 raise HTTPException(status_code=403, detail="无权访问该知识库")
             return {"kb_id": kb.id, "class_id": None}
 
         if class_id is None:
-            classes = (
-                await session.execute(
-                    select(models.Class).where(models.Class.teacher_id == teacher.id)
-                )
-            ).scalars().all()
-            if len(classes) == 1:
-                class_id = classes[0].id
+            if len(teacher.class_ids) == 1:
+                class_id = next(iter(teacher.class_ids))
             else:
                 raise HTTPException(status_code=400, detail="请先选择班级")
 
-        cls = (
-            await session.execute(
-                select(models.Class).where(models.Class.id == class_id)
-            )
-        ).scalar_one_or_none()
-        if not cls:
-            raise HTTPException(status_code=404, detail="班级不存在")
-        if cls.teacher_id != teacher.id:
+        if class_id not in teacher.class_ids:
+            cls = (
+                await session.execute(
+                    select(models.Class).where(models.Class.id == class_id)
+                )
+            ).scalar_one_or_none()
+            if not cls:
+                raise HTTPException(status_code=404, detail="班级不存在")
             raise HTTPException(status_code=403, detail="无权访问该班级")
 
-        return {"kb_id": None, "class_id": cls.id}
+        return {"kb_id": None, "class_id": class_id}
 
     # 管理员：可查看任意班级/知识库
     if role == "admin":
@@ -1376,6 +1656,140 @@ def _parse_date(value: Optional[str], field_name: str) -> Optional[datetime]:
         raise HTTPException(status_code=400, detail=f"{field_name} 格式错误")
 
 
+def _encode_cursor(*values: Any) -> str:
+    """把排序键编码为不透明的游标字符串（datetime 转 ISO 格式）。"""
+    raw = json.dumps(
+        [v.isoformat() if isinstance(v, datetime) else v for v in values],
+        separators=(",", ":"),
+    )
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor: str, size: int) -> List[Any]:
+    """解析 _encode_cursor 生成的游标，返回排序键列表。"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="cursor 参数不合法")
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(status_code=400, detail="cursor 参数不合法")
+    return values
+
+
+def _cursor_datetime(value: Any) -> datetime:
+    """游标中的时间字段还原为 datetime。"""
+    try:
+        return datetime.fromisoformat(value)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="cursor 参数不合法")
+
+
+def _cursor_id(value: Any) -> int:
+    """游标中的 id 字段必须为整数（bool 是 int 的子类，需单独排除）。"""
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise HTTPException(status_code=400, detail="cursor 参数不合法")
+    return value
+
+
+# 仅 MySQL 建有 ngram FULLTEXT 索引（见迁移 0009），其他数据库（如 SQLite）退回 LIKE
+_FULLTEXT_ENABLED = settings.fulltext_search and settings.db_url.lower().startswith("mysql")
+
+
+def _text_contains(column: Any, keyword: str) -> Any:
+    """关键字包含过滤。
+
+    MySQL 上先用 MATCH ... AGAINST 走全文索引缩小范围，再用 LIKE 保证与原先一致的子串语义；
+    关键字短于 ngram 长度时全文索引无法命中，直接使用 LIKE。
+    """
+    like = column.like(f"%{keyword}%")
+    phrase = keyword.replace('"', " ").strip()
+    if not _FULLTEXT_ENABLED or len(phrase) < settings.fulltext_ngram_token_size:
+        return like
+    return and_(column.match(f'"{phrase}"'), like)
+
+
+# 列表总数缓存：{语句+参数: (过期时间, 总数)}，count=cached 时使用
+_count_cache: Dict[str, Tuple[float, int]] = {}
+
+
+async def _count_rows(session: AsyncSession, stmt: Any, mode: str) -> Optional[int]:
+    """统计列表总数：exact 实时计算，cached 允许使用短期缓存的近似值，none 不统计。"""
+    if mode == "none":
+        return None
+    total_stmt = select(func.count()).select_from(stmt.subquery())
+    if mode == "exact":
+        return (await session.execute(total_stmt)).scalar_one()
+
+    compiled = total_stmt.compile()
+    key = f"{compiled}|{sorted(compiled.params.items(), key=lambda item: item[0])!r}"
+    now = time.monotonic()
+    cached = _count_cache.get(key)
+    if cached and cached[0] > now:
+        return cached[1]
+    total = (await session.execute(total_stmt)).scalar_one()
+    if len(_count_cache) >= 1000:
+        _count_cache.clear()
+    _count_cache[key] = (now + settings.list_count_cache_ttl, total)
+    return total
+
+
+async def _paginate(
+    session: AsyncSession,
+    stmt: Any,
+    sort_column: Any,
+    id_column: Any,
+    page: int,
+    page_size: int,
+    pagination: str,
+    cursor: Optional[str],
+    count: Optional[str],
+) -> Tuple[List[Any], Dict[str, Any]]:
+    """按 (sort_column desc, id desc) 分页，返回 (rows, 分页元信息)。
+
+    - pagination=page：传统 page/page_size（OFFSET），默认统计精确总数
+    - pagination=cursor：基于排序键 + id 的游标分页，默认不统计总数，
+      返回 next_cursor（为空表示没有下一页）
+    - count：exact / cached / none，覆盖默认的总数统计方式
+    """
+    if pagination not in {"page", "cursor"}:
+        raise HTTPException(status_code=400, detail="pagination 参数不合法")
+    if page < 1 or page_size < 1 or page_size > 100:
+        raise HTTPException(status_code=400, detail="分页参数不合法")
+    count = count or ("exact" if pagination == "page" else "none")
+    if count not in {"exact", "cached", "none"}:
+        raise HTTPException(status_code=400, detail="count 参数不合法")
+
+    total = await _count_rows(session, stmt, count)
+    ordered = stmt.order_by(sort_column.desc(), id_column.desc())
+
+    if pagination == "page":
+        rows = (
+            await session.execute(ordered.offset((page - 1) * page_size).limit(page_size))
+        ).all()
+        return rows, {"page": page, "page_size": page_size, "total": total}
+
+    if cursor:
+        cursor_value, cursor_id = _decode_cursor(cursor, 2)
+        cursor_value = _cursor_datetime(cursor_value)
+        cursor_id = _cursor_id(cursor_id)
+        ordered = ordered.where(
+            or_(
+                sort_column < cursor_value,
+                and_(sort_column == cursor_value, id_column < cursor_id),
+            )
+        )
+    # 多取一条判断是否还有下一页
+    rows = (await session.execute(ordered.limit(page_size + 1))).all()
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        # 从最后一行中取出排序列所属实体，作为下一页的起点
+        last = next(item for item in rows[-1] if isinstance(item, sort_column.class_))
+        next_cursor = _encode_cursor(getattr(last, sort_column.key), getattr(last, id_column.key))
+    return rows, {"page_size": page_size, "next_cursor": next_cursor, "total": total}
+
+
 async def _resolve_class_id(
     session: AsyncSession,
     class_id: Optional[int],
@@ -1488,12 +1902,11 @@ async def student_register(
 
 @app.get("/admin/teachers")
 async def list_teachers(
-    admin_id: int,
     keyword: Optional[str] = None,
+    admin: Principal = Depends(get_admin_principal),
     session: AsyncSession = Depends(get_session),
 ):
     """管理员查看教师列表。"""
-    await _require_admin(session, admin_id)
     stmt = select(models.Teacher)
     if keyword:
         kw = keyword.strip()
@@ -1517,6 +1930,179 @@ async def list_teachers(
     ]
 
 
+# 批量导入：各角色的账号编号字段、模型与字段长度限制
+_IMPORT_ACCOUNT_FIELDS = {
+    "student": ("student_no", models.Student, "学号"),
+    "teacher": ("teacher_no", models.Teacher, "工号"),
+}
+_IMPORT_MAX_LENGTHS = {"student_no": 32, "teacher_no": 32, "name": 64, "email": 128}
+
+
+def _validate_import_row(
+    role: str,
+    fields: Dict[str, str],
+    class_ids: Dict[str, int],
+) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """校验单行并转换为插入用的字典，返回 (行数据, 错误信息)。"""
+    account_field, _, account_label = _IMPORT_ACCOUNT_FIELDS[role]
+    account_no = fields.get(account_field, "")
+    name = fields.get("name", "")
+    password = fields.get("password", "")
+    if not account_no or not name or not password:
+        return None, f"{account_label}、姓名、密码不能为空"
+    for field, max_length in _IMPORT_MAX_LENGTHS.items():
+        if len(fields.get(field) or "") > max_length:
+            return None, f"{field} 超过 {max_length} 个字符"
+
+    status_text = fields.get("status") or "1"
+    if status_text not in {"0", "1"}:
+        return None, "状态只能为 0 或 1"
+
+    now = datetime.utcnow()
+    row: Dict[str, Any] = {
+        account_field: account_no,
+        "name": name,
+        "password_hash": _hash_password(password),
+        "email": fields.get("email") or None,
+        "status": int(status_text),
+        "created_at": now,
+        "updated_at": now,
+    }
+    if role == "student":
+        class_code = fields.get("class_code", "")
+        if not class_code:
+            return None, "班级编号不能为空"
+        class_id = class_ids.get(class_code)
+        if class_id is None:
+            return None, f"班级不存在: {class_code}"
+        row["class_id"] = class_id
+    return row, None
+
+
+async def _import_accounts(
+    session: AsyncSession,
+    role: str,
+    file: UploadFile,
+    dry_run: bool,
+) -> Dict[str, Any]:
+    """流式解析上传文件并分批导入账号（整个导入在同一事务内，出错整体回滚）。
+
+    每批：按文件内重复/必填/班级编号校验，一次 IN 查询检查已存在的编号，
+    合法行用一条多行 INSERT 写入；不合法的行跳过并记录到错误报告。
+    编号唯一约束使用大小写不敏感的排序规则，重复判断统一按 casefold 比较。
+    """
+    account_field, model, account_label = _IMPORT_ACCOUNT_FIELDS[role]
+    account_column = getattr(model, account_field)
+
+    # 班级编号 -> id 一次性加载
+    class_ids: Dict[str, int] = {}
+    if role == "student":
+        class_ids = {
+            code: class_id
+            for class_id, code in (
+                await session.execute(select(models.Class.id, models.Class.class_code))
+            ).all()
+        }
+
+    rows = iter_rows(file.file, file.filename or "", role)
+    batch_size = max(1, settings.account_import_batch_size)
+    seen: Set[str] = set()
+    errors: List[Dict[str, Any]] = []
+    total = 0
+    created = 0
+    failed = 0
+
+    def _fail(line_no: int, account_no: Optional[str], message: str) -> None:
+        nonlocal failed
+        failed += 1
+        if len(errors) < settings.account_import_max_errors:
+            errors.append({"row": line_no, account_field: account_no or None, "error": message})
+
+    try:
+        while True:
+            try:
+                # 解析为阻塞操作，放到线程池按批读取
+                batch = await asyncio.to_thread(take, rows, batch_size)
+            except ImportFormatError as exc:
+                raise HTTPException(status_code=400, detail=str(exc))
+            if not batch:
+                break
+            total += len(batch)
+            if total > settings.account_import_max_rows:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"单个文件最多导入 {settings.account_import_max_rows} 行",
+                )
+
+            candidates: List[Tuple[int, Dict[str, Any]]] = []
+            for line_no, fields in batch:
+                row, error = _validate_import_row(role, fields, class_ids)
+                account_no = fields.get(account_field)
+                if error:
+                    _fail(line_no, account_no, error)
+                elif account_no.casefold() in seen:
+                    _fail(line_no, account_no, f"文件内{account_label}重复")
+                else:
+                    seen.add(account_no.casefold())
+                    candidates.append((line_no, row))
+            if not candidates:
+                continue
+
+            existing = {
+                value.casefold()
+                for value in (
+                    await session.execute(
+                        select(account_column).where(
+                            account_column.in_([row[account_field] for _, row in candidates])
+                        )
+                    )
+                ).scalars().all()
+            }
+            values = []
+            for line_no, row in candidates:
+                if row[account_field].casefold() in existing:
+                    _fail(line_no, row[account_field], f"{account_label}已存在")
+                else:
+                    values.append(row)
+            if values and not dry_run:
+                await session.execute(insert(model).values(values))
+            created += len(values)
+
+        if dry_run:
+            await session.rollback()
+        else:
+            await session.commit()
+    except IntegrityError:
+        # 导入期间其他请求写入了相同编号
+        await session.rollback()
+        raise HTTPException(status_code=409, detail=f"{account_label}冲突，请重新导入")
+    except Exception:
+        await session.rollback()
+        raise
+
+    return {
+        "role": role,
+        "dry_run": dry_run,
+        "total": total,
+        "created": created,
+        "failed": failed,
+        "errors": errors,
+        "errors_truncated": failed > len(errors),
+    }
+
+
+@app.post("/admin/teachers/import")
+async def import_teachers(
+    admin_id: int = Form(...),
+    file: UploadFile = File(...),
+    dry_run: bool = Form(False),
+    session: AsyncSession = Depends(get_session),
+):
+    """管理员批量导入教师（CSV/XLSX，列：工号、姓名、密码，可选邮箱、状态）。"""
+    await _require_admin(session, admin_id)
+    return await _import_accounts(session, "teacher", file, dry_run)
+
+
 @app.post("/admin/teachers")
 async def create_teacher(
     payload: AdminCreateTeacherRequest,
@@ -1586,17 +2172,17 @@ async def update_teacher(
 
     teacher.updated_at = datetime.utcnow()
     await session.commit()
+    invalidate_principal("teacher", teacher_id)
     return {"id": teacher.id, "updated": True}
 
 
 @app.delete("/admin/teachers/{teacher_id}")
 async def delete_teacher(
     teacher_id: int,
-    admin_id: int,
+    admin: Principal = Depends(get_admin_principal),
     session: AsyncSession = Depends(get_session),
 ):
     """管理员删除教师（有班级关联时拒绝）。"""
-    await _require_admin(session, admin_id)
     teacher = (
         await session.execute(
             select(models.Teacher).where(models.Teacher.id == teacher_id)
@@ -1615,18 +2201,18 @@ async def delete_teacher(
 
     await session.delete(teacher)
     await session.commit()
+    invalidate_principal("teacher", teacher_id)
     return {"id": teacher_id, "deleted": True}
 
 
 @app.get("/admin/students")
 async def list_students(
-    admin_id: int,
     class_code: Optional[str] = None,
     keyword: Optional[str] = None,
+    admin: Principal = Depends(get_admin_principal),
     session: AsyncSession = Depends(get_session),
 ):
     """管理员查看学生列表。"""
-    await _require_admin(session, admin_id)
     stmt = (
         select(models.Student, models.Class)
         .join(models.Class, models.Student.class_id == models.Class.id)
@@ -1657,6 +2243,18 @@ async def list_students(
     ]
 
 
+@app.post("/admin/students/import")
+async def import_students(
+    admin_id: int = Form(...),
+    file: UploadFile = File(...),
+    dry_run: bool = Form(False),
+    session: AsyncSession = Depends(get_session),
+):
+    """管理员批量导入学生（CSV/XLSX，列：学号、姓名、密码、班级编号，可选邮箱、状态）。"""
+    await _require_admin(session, admin_id)
+    return await _import_accounts(session, "student", file, dry_run)
+
+
 @app.post("/admin/students")
 async def create_student(
     payload: AdminCreateStudentRequest,
@@ -1748,17 +2346,17 @@ async def update_student(
 
     student.updated_at = datetime.utcnow()
     await session.commit()
+    invalidate_principal("student", student_id)
     return {"id": student.id, "updated": True}
 
 
 @app.delete("/admin/students/{student_id}")
 async def delete_student(
     student_id: int,
-    admin_id: int,
+    admin: Principal = Depends(get_admin_principal),
     session: AsyncSession = Depends(get_session),
 ):
     """管理员删除学生。"""
-    await _require_admin(session, admin_id)
     student = (
         await session.execute(
             select(models.Student).where(models.Student.id == student_id)
@@ -1768,6 +2366,7 @@ async def delete_student(
         raise HTTPException(status_code=404, detail="学生不存在")
     await session.delete(student)
     await session.commit()
+    invalidate_principal("student", student_id)
     return {"id": student_id, "deleted": True}
 
 
@@ -1778,12 +2377,11 @@ async def delete_student(
 
 @app.get("/admin/classes")
 async def list_classes_admin(
-    admin_id: int,
     keyword: Optional[str] = None,
+    admin: Principal = Depends(get_admin_principal),
     session: AsyncSession = Depends(get_session),
 ):
     """管理员查看班级列表。"""
-    await _require_admin(session, admin_id)
     stmt = (
         select(models.Class, models.Teacher)
         .join(models.Teacher, models.Class.teacher_id == models.Teacher.id)
@@ -1868,6 +2466,8 @@ async def create_class_admin(
     )
     session.add(kb)
     await session.commit()
+    # 教师所授班级集合变化
+    invalidate_principal("teacher", teacher.id)
 
     return {
         "class_id": new_class.id,
@@ -1896,6 +2496,7 @@ async def update_class_admin(
     ).scalar_one_or_none()
     if not cls:
         raise HTTPException(status_code=404, detail="班级不存在")
+    previous_teacher_id = cls.teacher_id
 
     if payload.class_name is not None:
         cls.class_name = payload.class_name.strip()
@@ -1920,17 +2521,20 @@ async def update_class_admin(
 
     cls.updated_at = datetime.utcnow()
     await session.commit()
+    # 新旧教师的所授班级集合都会变化
+    invalidate_principal("teacher", previous_teacher_id)
+    invalidate_principal("teacher", cls.teacher_id)
+    doc_hydration.discard_class(cls.id)
     return {"class_id": cls.id, "updated": True}
 
 
 @app.delete("/admin/classes/{class_id}")
 async def delete_class_admin(
     class_id: int,
-    admin_id: int,
+    admin: Principal = Depends(get_admin_principal),
     session: AsyncSession = Depends(get_session),
 ):
     """管理员删除班级（有学生或文件时拒绝）。"""
-    await _require_admin(session, admin_id)
     cls = (
         await session.execute(
             select(models.Class).where(models.Class.id == class_id)
@@ -1962,8 +2566,10 @@ async def delete_class_admin(
             raise HTTPException(status_code=400, detail="知识库仍有文件，无法删除")
         await session.delete(kb)
 
+    teacher_id = cls.teacher_id
     await session.delete(cls)
     await session.commit()
+    invalidate_principal("teacher", teacher_id)
     return {"class_id": class_id, "deleted": True}
 
 
@@ -1978,12 +2584,8 @@ async def list_teacher_classes(
     session: AsyncSession = Depends(get_session),
 ):
     """列出教师所授班级，用于“先选班级再搜索”。"""
-    teacher = (
-        await session.execute(
-            select(models.Teacher).where(models.Teacher.id == teacher_id)
-        )
-    ).scalar_one_or_none()
-    if not teacher or teacher.status != 1:
+    teacher = await resolve_principal(session, "teacher", teacher_id)
+    if not teacher or not teacher.active:
         raise HTTPException(status_code=404, detail="教师不存在或已停用")
 
     rows = (
@@ -2059,6 +2661,7 @@ async def create_class(
     await session.commit()
     await session.refresh(new_class)
     await session.refresh(kb)
+    invalidate_principal("teacher", teacher.id)
 
     return {
         "class_id": new_class.id,
@@ -2112,11 +2715,10 @@ async def upload_document(
         if exists and exists.status == models.DocumentStatus.rejected:
             reuse_doc = exists
 
-    client = _get_minio_client()
     pending_bucket = settings.minio_bucket_pending
     kb_bucket = settings.minio_bucket_kb
-    _ensure_bucket(client, pending_bucket)
-    _ensure_bucket(client, kb_bucket)
+    await _ensure_bucket(pending_bucket)
+    await _ensure_bucket(kb_bucket)
 
     # 如果是被拒绝的旧文件，先清理旧对象，避免冗余占用
     if reuse_doc and reuse_doc.storage_path:
@@ -2125,7 +2727,7 @@ async def upload_document(
             if reuse_doc.status in {models.DocumentStatus.pending, models.DocumentStatus.rejected}
             else kb_bucket
         )
-        _safe_remove_minio_object(client, old_bucket, reuse_doc.storage_path)
+        await _safe_remove_minio_object(old_bucket, reuse_doc.storage_path)
 
     status = (
         models.DocumentStatus.pending
@@ -2140,29 +2742,31 @@ async def upload_document(
         ext = f".{ext}" if ext else ""
     object_name = f"{kb.id}/{datetime.utcnow().strftime('%Y%m%d')}/{uuid.uuid4().hex}{ext}"
 
-    # 计算文件内容哈希（用于同内容提醒）
-    data = await file.read()
-    if not data:
+    # 仅探测首字节判断空文件，不整体读入内存
+    if not await file.read(1):
         raise HTTPException(status_code=400, detail="上传文件为空")
-    size_bytes = len(data)
-    content_hash = hashlib.sha256(data).hexdigest()
+    await file.seek(0)
 
     content_type = (
         file.content_type
         or mimetypes.guess_type(file.filename or "")[0]
         or "application/octet-stream"
     )
+    # 分片流式上传：边读边计算哈希（用于同内容提醒），内存占用只与分片大小相关
+    reader = _HashingReader(file.file)
     try:
-        client.put_object(
+        await storage.put_object(
             target_bucket,
             object_name,
-            io.BytesIO(data),
-            length=size_bytes,
-            part_size=10 * 1024 * 1024,
+            reader,
+            length=-1,
+            part_size=settings.upload_part_size,
             content_type=content_type,
         )
     except S3Error as exc:
         raise HTTPException(status_code=500, detail=f"MinIO 上传失败: {exc.code}")
+    size_bytes = reader.size
+    content_hash = reader.hexdigest()
 
     duplicate_stmt = select(models.Document).where(
         models.Document.kb_id == kb.id,
@@ -2212,7 +2816,7 @@ async def upload_document(
         await session.refresh(doc)
     except IntegrityError:
         await session.rollback()
-        _safe_remove_minio_object(client, target_bucket, object_name)
+        await _safe_remove_minio_object(target_bucket, object_name)
         raise HTTPException(status_code=409, detail="同名文件已存在，请更换文件名后再上传")
 
     return {
@@ -2236,6 +2840,9 @@ async def list_documents(
     status: Optional[str] = None,
     page: int = 1,
     page_size: int = 20,
+    pagination: str = "page",
+    cursor: Optional[str] = None,
+    count: Optional[str] = None,
     filename: Optional[str] = None,
     session: AsyncSession = Depends(get_session),
 ):
@@ -2244,9 +2851,6 @@ async def list_documents(
     if role not in {"student", "teacher", "admin"}:
         raise HTTPException(status_code=400, detail="role 参数不合法")
 
-    if page < 1 or page_size < 1 or page_size > 100:
-        raise HTTPException(status_code=400, detail="分页参数不合法")
-
     scope = await _resolve_document_scope(
         session,
         role,
@@ -2286,19 +2890,19 @@ async def list_documents(
 
     keyword = (filename or "").strip()
     if keyword:
-        base_stmt = base_stmt.where(models.Document.original_name.like(f"%{keyword}%"))
-
-    total_stmt = select(func.count()).select_from(base_stmt.subquery())
-    total = (await session.execute(total_stmt)).scalar_one()
+        base_stmt = base_stmt.where(_text_contains(models.Document.original_name, keyword))
 
-    rows = (
-        await session.execute(
-            base_stmt
-            .order_by(models.Document.uploaded_at.desc())
-            .offset((page - 1) * page_size)
-            .limit(page_size)
-        )
-    ).all()
+    rows, page_info = await _paginate(
+        session,
+        base_stmt,
+        models.Document.uploaded_at,
+        models.Document.id,
+        page,
+        page_size,
+        pagination,
+        cursor,
+        count,
+    )
 
     items = [
         {
@@ -2319,9 +2923,7 @@ async def list_documents(
     ]
 
     return {
-        "page": page,
-        "page_size": page_size,
-        "total": total,
+        **page_info,
         "items": items,
     }
 
@@ -2331,12 +2933,11 @@ async def get_document_detail(
     document_id: int,
     role: str,
     user_id: int,
+    principal: Principal = Depends(get_principal),
     session: AsyncSession = Depends(get_session),
 ):
     """文件详情（用于前端详情页/预览准备）。"""
-    role = role.lower().strip()
-    if role not in {"student", "teacher", "admin"}:
-        raise HTTPException(status_code=400, detail="role 参数不合法")
+    role = principal.role
 
     row = (
         await session.execute(
@@ -2350,7 +2951,7 @@ async def get_document_detail(
         raise HTTPException(status_code=404, detail="文档不存在")
 
     doc, kb, cls = row
-    await _check_document_permission(session, role, user_id, cls)
+    _check_document_permission(principal, cls)
 
     # 非管理员不允许查看待审核/已拒绝
     if role != "admin" and doc.status in {
@@ -2359,46 +2960,7 @@ async def get_document_detail(
     }:
         raise HTTPException(status_code=403, detail="无权查看该状态的文件")
 
-    uploader = None
-    if doc.uploader_student_id:
-        student = (
-            await session.execute(
-                select(models.Student).where(models.Student.id == doc.uploader_student_id)
-            )
-        ).scalar_one_or_none()
-        if student:
-            uploader = {
-                "role": "student",
-                "id": student.id,
-                "no": student.student_no,
-                "name": student.name,
-            }
-    elif doc.uploader_teacher_id:
-        teacher = (
-            await session.execute(
-                select(models.Teacher).where(models.Teacher.id == doc.uploader_teacher_id)
-            )
-        ).scalar_one_or_none()
-        if teacher:
-            uploader = {
-                "role": "teacher",
-                "id": teacher.id,
-                "no": teacher.teacher_no,
-                "name": teacher.name,
-            }
-    elif doc.uploader_admin_id:
-        admin = (
-            await session.execute(
-                select(models.Admin).where(models.Admin.id == doc.uploader_admin_id)
-            )
-        ).scalar_one_or_none()
-        if admin:
-            uploader = {
-                "role": "admin",
-                "id": admin.id,
-                "no": admin.admin_no,
-                "name": admin.name,
-            }
+    uploader = await _get_uploader_info(session, doc)
 
     audit_rows = (
         await session.execute(
@@ -2464,15 +3026,18 @@ async def get_document_detail(
 @app.get("/documents/{document_id}/content")
 async def get_document_content(
     document_id: int,
+    request: Request,
     role: str,
     user_id: int,
     download: bool = False,
+    principal: Principal = Depends(get_principal),
     session: AsyncSession = Depends(get_session),
 ):
-    """文件内容下载/预览（前端用于 Excel 预览）。"""
-    role = role.lower().strip()
-    if role not in {"student", "teacher", "admin"}:
-        raise HTTPException(status_code=400, detail="role 参数不合法")
+    """文件内容下载/预览（前端用于 Excel 预览）。
+
+    支持 Range 分段下载（206）与 ETag/Last-Modified 协商缓存（304）。
+    """
+    role = principal.role
 
     row = (
         await session.execute(
@@ -2486,7 +3051,7 @@ async def get_document_content(
         raise HTTPException(status_code=404, detail="文档不存在")
 
     doc, kb, cls = row
-    await _check_document_permission(session, role, user_id, cls)
+    _check_document_permission(principal, cls)
 
     # 非管理员不允许下载待审核/已拒绝文件
     if role != "admin" and doc.status in {
@@ -2498,32 +3063,76 @@ async def get_document_content(
     if not doc.storage_path:
         raise HTTPException(status_code=404, detail="文件存储路径缺失")
 
-    client = _get_minio_client()
     pending_bucket = settings.minio_bucket_pending
     kb_bucket = settings.minio_bucket_kb
-    _ensure_bucket(client, pending_bucket)
-    _ensure_bucket(client, kb_bucket)
+    await _ensure_bucket(pending_bucket)
+    await _ensure_bucket(kb_bucket)
     target_bucket = (
         pending_bucket
         if doc.status in {models.DocumentStatus.pending, models.DocumentStatus.rejected}
         else kb_bucket
     )
 
-    data = _read_minio_object(client, target_bucket, doc.storage_path)
     filename = doc.original_name or doc.filename or f"document-{doc.id}"
     content_type = doc.mime_type or "application/octet-stream"
     disposition = "attachment" if download else "inline"
-    headers = {"Content-Disposition": f"{disposition}; filename*=UTF-8''{quote(filename)}"}
+    headers = {
+        "Content-Disposition": f"{disposition}; filename*=UTF-8''{quote(filename)}",
+        "Accept-Ranges": "bytes",
+        "ETag": _document_etag(doc),
+        "Cache-Control": "private, no-cache",
+    }
+    if doc.updated_at:
+        headers["Last-Modified"] = formatdate(
+            calendar.timegm(doc.updated_at.utctimetuple()), usegmt=True
+        )
 
-    return StreamingResponse(
-        io.BytesIO(data),
-        media_type=content_type,
-        headers=headers,
-    )
+    # 协商缓存：内容未变化时直接返回 304，不访问 MinIO
+    if _etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
 
+    total = doc.size_bytes
+    if total is None:
+        try:
+            total = (await storage.stat_object(target_bucket, doc.storage_path)).size
+        except S3Error as exc:
+            raise HTTPException(status_code=500, detail=f"MinIO 读取失败: {exc.code}")
+
+    # If-Range 与当前 ETag 不一致时忽略 Range，返回完整内容
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if if_range and if_range.strip() != headers["ETag"]:
+        range_header = None
+    byte_range = _parse_range_header(range_header, total)
+
+    if byte_range:
+        start, end = byte_range
+        length = end - start + 1
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{total}"
+    else:
+        start, length = 0, total
+        status_code = 200
+    headers["Content-Length"] = str(length)
 
-@app.post("/documents/search")
-async def search_documents_by_filename(
+    try:
+        obj = await storage.get_object(
+            target_bucket, doc.storage_path, offset=start, length=length
+        )
+    except S3Error as exc:
+        raise HTTPException(status_code=500, detail=f"MinIO 读取失败: {exc.code}")
+
+    # 直接转发 MinIO 响应流，不在内存中拼接整个文件
+    return StreamingResponse(
+        storage.iter_object(obj),
+        status_code=status_code,
+        media_type=content_type,
+        headers=headers,
+    )
+
+
+@app.post("/documents/search")
+async def search_documents_by_filename(
     payload: DocumentSearchRequest,
     session: AsyncSession = Depends(get_session),
 ):
@@ -2561,7 +3170,7 @@ async def search_documents_by_filename(
 
     keyword = payload.filename.strip()
     if keyword:
-        stmt = stmt.where(models.Document.original_name.like(f"%{keyword}%"))
+        stmt = stmt.where(_text_contains(models.Document.original_name, keyword))
 
     rows = (await session.execute(stmt)).all()
 
@@ -2612,24 +3221,12 @@ async def rename_document(
     doc, kb, cls = row
 
     if role == "teacher":
-        teacher = (
-            await session.execute(
-                select(models.Teacher).where(models.Teacher.id == payload.user_id)
-            )
-        ).scalar_one_or_none()
-        if not teacher or teacher.status != 1:
-            raise HTTPException(status_code=403, detail="教师不存在或已停用")
-        if cls.teacher_id != teacher.id:
+        teacher = await _get_active_principal(session, "teacher", payload.user_id)
+        if cls.teacher_id != teacher.user_id:
             raise HTTPException(status_code=403, detail="无权操作该班级文件")
 
     if role == "admin":
-        admin = (
-            await session.execute(
-                select(models.Admin).where(models.Admin.id == payload.user_id)
-            )
-        ).scalar_one_or_none()
-        if not admin or admin.status != 1:
-            raise HTTPException(status_code=403, detail="管理员不存在或已停用")
+        await _require_admin(session, payload.user_id)
 
     # 同步更新 RAGFlow 文档名称（如果存在）
     if payload.sync_ragflow and doc.ragflow_document_id:
@@ -2643,6 +3240,10 @@ async def rename_document(
     doc.updated_at = datetime.utcnow()
     await session.commit()
     await session.refresh(doc)
+    doc_hydration.discard_document(doc.id)
+    if doc.ragflow_document_id:
+        retrieval_cache.invalidate_dataset(kb.ragflow_dataset_id)
+        chunk_cache.invalidate_document(kb.ragflow_dataset_id, doc.ragflow_document_id)
 
     return {
         "document_id": doc.id,
@@ -2681,24 +3282,12 @@ async def delete_document(
     doc, kb, cls = row
 
     if role == "teacher":
-        teacher = (
-            await session.execute(
-                select(models.Teacher).where(models.Teacher.id == payload.user_id)
-            )
-        ).scalar_one_or_none()
-        if not teacher or teacher.status != 1:
-            raise HTTPException(status_code=403, detail="教师不存在或已停用")
-        if cls.teacher_id != teacher.id:
+        teacher = await _get_active_principal(session, "teacher", payload.user_id)
+        if cls.teacher_id != teacher.user_id:
             raise HTTPException(status_code=403, detail="无权删除该班级文件")
 
     if role == "admin":
-        admin = (
-            await session.execute(
-                select(models.Admin).where(models.Admin.id == payload.user_id)
-            )
-        ).scalar_one_or_none()
-        if not admin or admin.status != 1:
-            raise HTTPException(status_code=403, detail="管理员不存在或已停用")
+        await _require_admin(session, payload.user_id)
 
     # 1) 先同步删除 RAGFlow 文档（若有）
     if payload.sync_ragflow and doc.ragflow_document_id:
@@ -2706,17 +3295,16 @@ async def delete_document(
 
     # 2) 删除 MinIO 对象（按状态选择桶）
     if payload.remove_minio and doc.storage_path:
-        client = _get_minio_client()
         pending_bucket = settings.minio_bucket_pending
         kb_bucket = settings.minio_bucket_kb
-        _ensure_bucket(client, pending_bucket)
-        _ensure_bucket(client, kb_bucket)
+        await _ensure_bucket(pending_bucket)
+        await _ensure_bucket(kb_bucket)
         target_bucket = (
             pending_bucket
             if doc.status in {models.DocumentStatus.pending, models.DocumentStatus.rejected}
             else kb_bucket
         )
-        _safe_remove_minio_object(client, target_bucket, doc.storage_path)
+        await _safe_remove_minio_object(target_bucket, doc.storage_path)
 
     # 3) 删除关联记录（避免外键约束）
     await session.execute(
@@ -2730,8 +3318,13 @@ async def delete_document(
     )
 
     # 4) 删除文档记录
+    ragflow_document_id = doc.ragflow_document_id
     await session.delete(doc)
     await session.commit()
+    doc_hydration.discard_document(document_id)
+    if ragflow_document_id:
+        retrieval_cache.invalidate_dataset(kb.ragflow_dataset_id)
+        chunk_cache.invalidate_document(kb.ragflow_dataset_id, ragflow_document_id)
 
     return {
         "document_id": document_id,
@@ -2743,9 +3336,22 @@ async def delete_document(
 async def list_pending_audits(
     class_id: Optional[int] = None,
     class_code: Optional[str] = None,
+    uploader_role: Optional[str] = None,
+    min_age_hours: Optional[float] = None,
+    max_age_hours: Optional[float] = None,
+    cursor: Optional[str] = None,
+    limit: int = 50,
     session: AsyncSession = Depends(get_session),
 ):
-    """查询待审核文件列表。"""
+    """查询待审核文件列表（按上传时间先到先审，基于 (uploaded_at, id) 的游标分页）。
+
+    - uploader_role：只看学生/教师/管理员上传的文件
+    - min_age_hours / max_age_hours：按已等待时长过滤
+    - cursor：上一页返回的 next_cursor，为空表示已到末尾
+    """
+    if limit < 1 or limit > 200:
+        raise HTTPException(status_code=400, detail="limit 参数不合法")
+
     stmt = (
         select(models.Document, models.KnowledgeBase, models.Class)
         .join(models.KnowledgeBase, models.Document.kb_id == models.KnowledgeBase.id)
@@ -2765,10 +3371,50 @@ async def list_pending_audits(
     if class_id is not None:
         stmt = stmt.where(models.Class.id == class_id)
 
-    rows = (await session.execute(stmt)).all()
+    if uploader_role:
+        uploader_columns = {
+            "student": models.Document.uploader_student_id,
+            "teacher": models.Document.uploader_teacher_id,
+            "admin": models.Document.uploader_admin_id,
+        }
+        column = uploader_columns.get(uploader_role.lower().strip())
+        if column is None:
+            raise HTTPException(status_code=400, detail="uploader_role 参数不合法")
+        stmt = stmt.where(column.isnot(None))
+
+    now = datetime.utcnow()
+    if min_age_hours is not None:
+        stmt = stmt.where(models.Document.uploaded_at <= now - timedelta(hours=min_age_hours))
+    if max_age_hours is not None:
+        stmt = stmt.where(models.Document.uploaded_at >= now - timedelta(hours=max_age_hours))
+
+    if cursor:
+        cursor_uploaded_at, cursor_id = _decode_cursor(cursor, 2)
+        cursor_uploaded_at = _cursor_datetime(cursor_uploaded_at)
+        cursor_id = _cursor_id(cursor_id)
+        stmt = stmt.where(
+            or_(
+                models.Document.uploaded_at > cursor_uploaded_at,
+                and_(
+                    models.Document.uploaded_at == cursor_uploaded_at,
+                    models.Document.id > cursor_id,
+                ),
+            )
+        )
+
+    # 多取一条判断是否还有下一页
+    rows = (
+        await session.execute(
+            stmt.order_by(models.Document.uploaded_at, models.Document.id).limit(limit + 1)
+        )
+    ).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    uploaders = await _get_uploaders_info(session, [doc for doc, _, _ in rows])
     results = []
     for doc, kb_row, cls in rows:
-        uploader = await _get_uploader_info(session, doc)
+        uploader = uploaders.get(doc.id)
         results.append(
             {
                 "id": doc.id,
@@ -2784,32 +3430,34 @@ async def list_pending_audits(
                 "uploaded_at": doc.uploaded_at,
             }
         )
-    return results
+
+    next_cursor = None
+    if has_more and rows:
+        last_doc = rows[-1][0]
+        next_cursor = _encode_cursor(last_doc.uploaded_at, last_doc.id)
+
+    return {
+        "limit": limit,
+        "next_cursor": next_cursor,
+        "items": results,
+    }
 
 
 @app.get("/audits")
 async def list_audits(
-    admin_id: int,
     class_id: Optional[int] = None,
     class_code: Optional[str] = None,
     decision: Optional[str] = None,
     page: int = 1,
     page_size: int = 20,
+    pagination: str = "page",
+    cursor: Optional[str] = None,
+    count: Optional[str] = None,
     filename: Optional[str] = None,
+    admin: Principal = Depends(get_admin_principal),
     session: AsyncSession = Depends(get_session),
 ):
     """审核记录列表（仅管理员可查看）。"""
-    if page < 1 or page_size < 1 or page_size > 100:
-        raise HTTPException(status_code=400, detail="分页参数不合法")
-
-    admin = (
-        await session.execute(
-            select(models.Admin).where(models.Admin.id == admin_id)
-        )
-    ).scalar_one_or_none()
-    if not admin or admin.status != 1:
-        raise HTTPException(status_code=403, detail="管理员不存在或已停用")
-
     if class_id is None and class_code is not None:
         cls = (
             await session.execute(
@@ -2849,23 +3497,24 @@ async def list_audits(
 
     keyword = (filename or "").strip()
     if keyword:
-        base_stmt = base_stmt.where(models.Document.original_name.like(f"%{keyword}%"))
+        base_stmt = base_stmt.where(_text_contains(models.Document.original_name, keyword))
 
-    total_stmt = select(func.count()).select_from(base_stmt.subquery())
-    total = (await session.execute(total_stmt)).scalar_one()
-
-    rows = (
-        await session.execute(
-            base_stmt
-            .order_by(models.DocumentAudit.decided_at.desc())
-            .offset((page - 1) * page_size)
-            .limit(page_size)
-        )
-    ).all()
+    rows, page_info = await _paginate(
+        session,
+        base_stmt,
+        models.DocumentAudit.decided_at,
+        models.DocumentAudit.id,
+        page,
+        page_size,
+        pagination,
+        cursor,
+        count,
+    )
 
+    uploaders = await _get_uploaders_info(session, [row[1] for row in rows])
     items = []
     for audit, doc, kb, cls, reviewer in rows:
-        uploader = await _get_uploader_info(session, doc)
+        uploader = uploaders.get(doc.id)
         items.append(
             {
                 "audit_id": audit.id,
@@ -2890,9 +3539,7 @@ async def list_audits(
         )
 
     return {
-        "page": page,
-        "page_size": page_size,
-        "total": total,
+        **page_info,
         "items": items,
     }
 
@@ -2900,18 +3547,10 @@ async def list_audits(
 @app.get("/audits/{audit_id}")
 async def get_audit_detail(
     audit_id: int,
-    admin_id: int,
+    admin: Principal = Depends(get_admin_principal),
     session: AsyncSession = Depends(get_session),
 ):
     """审核记录详情（仅管理员可查看）。"""
-    admin = (
-        await session.execute(
-            select(models.Admin).where(models.Admin.id == admin_id)
-        )
-    ).scalar_one_or_none()
-    if not admin or admin.status != 1:
-        raise HTTPException(status_code=403, detail="管理员不存在或已停用")
-
     row = (
         await session.execute(
             select(
@@ -2933,46 +3572,7 @@ async def get_audit_detail(
 
     audit, doc, kb, cls, reviewer = row
 
-    uploader = None
-    if doc.uploader_student_id:
-        student = (
-            await session.execute(
-                select(models.Student).where(models.Student.id == doc.uploader_student_id)
-            )
-        ).scalar_one_or_none()
-        if student:
-            uploader = {
-                "role": "student",
-                "id": student.id,
-                "no": student.student_no,
-                "name": student.name,
-            }
-    elif doc.uploader_teacher_id:
-        teacher = (
-            await session.execute(
-                select(models.Teacher).where(models.Teacher.id == doc.uploader_teacher_id)
-            )
-        ).scalar_one_or_none()
-        if teacher:
-            uploader = {
-                "role": "teacher",
-                "id": teacher.id,
-                "no": teacher.teacher_no,
-                "name": teacher.name,
-            }
-    elif doc.uploader_admin_id:
-        admin_uploader = (
-            await session.execute(
-                select(models.Admin).where(models.Admin.id == doc.uploader_admin_id)
-            )
-        ).scalar_one_or_none()
-        if admin_uploader:
-            uploader = {
-                "role": "admin",
-                "id": admin_uploader.id,
-                "no": admin_uploader.admin_no,
-                "name": admin_uploader.name,
-            }
+    uploader = await _get_uploader_info(session, doc)
 
     return {
         "audit_id": audit.id,
@@ -3004,13 +3604,7 @@ async def audit_document(
     session: AsyncSession = Depends(get_session),
 ):
     """管理员审核文件（通过/拒绝）。"""
-    admin = (
-        await session.execute(
-            select(models.Admin).where(models.Admin.id == payload.reviewer_admin_id)
-        )
-    ).scalar_one_or_none()
-    if not admin or admin.status != 1:
-        raise HTTPException(status_code=403, detail="管理员不存在或已停用")
+    admin = await _require_admin(session, payload.reviewer_admin_id)
 
     doc = (
         await session.execute(
@@ -3024,18 +3618,16 @@ async def audit_document(
     if decision not in {"approved", "rejected"}:
         raise HTTPException(status_code=400, detail="decision 必须为 approved 或 rejected")
 
-    client = _get_minio_client()
     pending_bucket = settings.minio_bucket_pending
     kb_bucket = settings.minio_bucket_kb
-    _ensure_bucket(client, pending_bucket)
-    _ensure_bucket(client, kb_bucket)
+    await _ensure_bucket(pending_bucket)
+    await _ensure_bucket(kb_bucket)
 
     if decision == "approved":
         # 通过：从待审核桶移动到知识库桶
         try:
-            source = CopySource(pending_bucket, doc.storage_path)
-            client.copy_object(kb_bucket, doc.storage_path, source)
-            client.remove_object(pending_bucket, doc.storage_path)
+            await storage.copy_object(kb_bucket, doc.storage_path, pending_bucket, doc.storage_path)
+            await storage.remove_object(pending_bucket, doc.storage_path)
         except S3Error as exc:
             raise HTTPException(status_code=500, detail=f"MinIO 移动失败: {exc.code}")
         doc.status = models.DocumentStatus.approved
@@ -3046,7 +3638,7 @@ async def audit_document(
 
     audit = models.DocumentAudit(
         document_id=doc.id,
-        reviewer_admin_id=admin.id,
+        reviewer_admin_id=admin.user_id,
         decision=models.AuditDecision.approved if decision == "approved" else models.AuditDecision.rejected,
         reason=payload.reason,
         decided_at=datetime.utcnow(),
@@ -3057,6 +3649,293 @@ async def audit_document(
     return {"id": doc.id, "status": doc.status.value, "decision": decision}
 
 
+# ------------------------------
+# 嵌入任务队列（后台 worker）
+# ------------------------------
+
+# 新任务入队时唤醒空闲 worker；其他进程入队的任务靠定时轮询领取
+_embedding_wakeup = asyncio.Event()
+_embedding_workers: List[asyncio.Task] = []
+
+
+class _EmbeddingFailed(Exception):
+    """RAGFlow 明确返回解析失败/取消/超时，不再重试。"""
+
+
+def _is_transient_error(exc: Exception) -> bool:
+    """网络错误与上游/存储的 5xx 视为暂时性失败，可退避重试。"""
+    if isinstance(exc, httpx.HTTPError):
+        return True
+    if isinstance(exc, HTTPException):
+        return exc.status_code >= 500
+    return False
+
+
+async def _claim_embedding_task(session: AsyncSession) -> Optional[int]:
+    """行锁领取一个到期的排队任务并标记为 running（多 worker/多进程安全）。"""
+    now = datetime.utcnow()
+    task = (
+        await session.execute(
+            select(models.EmbeddingTask)
+            .where(
+                models.EmbeddingTask.status == models.EmbeddingTaskStatus.queued,
+                or_(
+                    models.EmbeddingTask.next_run_at.is_(None),
+                    models.EmbeddingTask.next_run_at <= now,
+                ),
+            )
+            .order_by(models.EmbeddingTask.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        )
+    ).scalar_one_or_none()
+    if not task:
+        await session.rollback()
+        return None
+
+    task.status = models.EmbeddingTaskStatus.running
+    task.attempts = (task.attempts or 0) + 1
+    task.started_at = now
+    task.next_run_at = None
+    await session.commit()
+    return task.id
+
+
+async def _wait_for_ragflow_parse(
+    session: AsyncSession,
+    task: models.EmbeddingTask,
+    dataset_id: str,
+    ragflow_doc_id: str,
+) -> None:
+    """轮询 RAGFlow 解析进度，直到完成/失败/超时，并把进度写入 task.message。"""
+    deadline = time.monotonic() + settings.embedding_parse_timeout
+    while True:
+        info = await _ragflow_get_document(dataset_id, ragflow_doc_id)
+        run = str(info.get("run") or "").upper()
+        progress = float(info.get("progress") or 0)
+        progress_msg = (info.get("progress_msg") or "").strip().splitlines()
+        task.message = f"解析中 {progress * 100:.0f}%" + (
+            f": {progress_msg[-1]}" if progress_msg else ""
+        )
+        await session.commit()
+
+        if run in {"DONE", "3"}:
+            return
+        if run in {"FAIL", "4", "CANCEL", "2"}:
+            raise _EmbeddingFailed(f"RAGFlow 解析失败: {task.message}")
+        if time.monotonic() > deadline:
+            raise _EmbeddingFailed("RAGFlow 解析超时")
+        await asyncio.sleep(settings.embedding_poll_interval)
+
+
+async def _process_embedding_task(task_id: int) -> None:
+    """执行单个嵌入任务：读取 MinIO -> 上传 RAGFlow -> 提交解析 -> 等待解析完成。"""
+    async with AsyncSessionLocal() as session:
+        task = await session.get(models.EmbeddingTask, task_id)
+        if not task:
+            return
+        try:
+            doc = await session.get(models.Document, task.document_id)
+            if not doc:
+                raise _EmbeddingFailed("文档不存在")
+            if doc.status != models.DocumentStatus.approved:
+                raise _EmbeddingFailed("文档未通过审核")
+            kb = await session.get(models.KnowledgeBase, doc.kb_id)
+            if not kb or not kb.ragflow_dataset_id:
+                raise _EmbeddingFailed("知识库未绑定 RAGFlow dataset")
+
+            # 若已存在 ragflow_document_id，直接复用（重试时不重复上传）
+            ragflow_doc_id = doc.ragflow_document_id
+            run = ""
+            if ragflow_doc_id:
+                info = await _ragflow_get_document(kb.ragflow_dataset_id, ragflow_doc_id)
+                run = str(info.get("run") or "").upper()
+            else:
+                kb_bucket = settings.minio_bucket_kb
+                await _ensure_bucket(kb_bucket)
+                data = await _read_minio_object(kb_bucket, doc.storage_path)
+                ragflow_doc_id = await _ragflow_upload_document(
+                    kb.ragflow_dataset_id,
+                    doc.original_name or doc.filename,
+                    data,
+                    doc.mime_type or "application/octet-stream",
+                )
+                doc.ragflow_document_id = ragflow_doc_id
+
+            # RAGFlow 解析没有独立任务 id，以文档 id 作为跟踪标识
+            task.ragflow_task_id = ragflow_doc_id
+            task.message = "已提交解析"
+            await session.commit()
+
+            if run not in {"RUNNING", "1", "DONE", "3"}:
+                await _ragflow_parse_documents(kb.ragflow_dataset_id, [ragflow_doc_id])
+            await _wait_for_ragflow_parse(session, task, kb.ragflow_dataset_id, ragflow_doc_id)
+
+            doc.status = models.DocumentStatus.embedded
+            doc.updated_at = datetime.utcnow()
+            task.status = models.EmbeddingTaskStatus.success
+            task.message = "解析完成"
+            task.finished_at = datetime.utcnow()
+            await session.commit()
+            doc_hydration.discard_document(doc.id)
+            retrieval_cache.invalidate_dataset(kb.ragflow_dataset_id)
+            chunk_cache.invalidate_document(kb.ragflow_dataset_id, ragflow_doc_id)
+        except asyncio.CancelledError:
+            # 进程关闭：放回队列，下次启动继续
+            task.status = models.EmbeddingTaskStatus.queued
+            task.message = "服务重启，任务已重新排队"
+            await session.commit()
+            raise
+        except Exception as exc:
+            message = str(exc.detail) if isinstance(exc, HTTPException) else (str(exc) or exc.__class__.__name__)
+            if _is_transient_error(exc) and task.attempts < settings.embedding_max_attempts:
+                delay = settings.embedding_retry_backoff * (2 ** (task.attempts - 1))
+                task.status = models.EmbeddingTaskStatus.queued
+                task.next_run_at = datetime.utcnow() + timedelta(seconds=delay)
+                task.message = f"第 {task.attempts} 次执行失败，{delay:.0f} 秒后重试: {message}"
+            else:
+                task.status = models.EmbeddingTaskStatus.failed
+                task.finished_at = datetime.utcnow()
+                task.message = message
+            await session.commit()
+
+
+async def _embedding_worker() -> None:
+    """后台 worker：循环领取并执行嵌入任务，空闲时等待唤醒或定时轮询。"""
+    while True:
+        try:
+            async with AsyncSessionLocal() as session:
+                task_id = await _claim_embedding_task(session)
+            if task_id is None:
+                _embedding_wakeup.clear()
+                try:
+                    await asyncio.wait_for(
+                        _embedding_wakeup.wait(), timeout=settings.embedding_poll_interval
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await _process_embedding_task(task_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("嵌入 worker 执行异常")
+            await asyncio.sleep(settings.embedding_poll_interval)
+
+
+_embedding_batches: Set[asyncio.Task] = set()
+
+
+async def _submit_embedding_batch(task_ids: List[int]) -> None:
+    """批量提交：并发上传缺失文档到 RAGFlow，再按 dataset 各发一次解析请求。
+
+    提交完成（或单个文档失败）后任务回到 queued，由 worker 跟踪解析进度；
+    解析已在进行中的文档 worker 不会重复提交。
+    """
+    semaphore = asyncio.Semaphore(settings.embedding_batch_concurrency)
+    kb_bucket = settings.minio_bucket_kb
+
+    async with AsyncSessionLocal() as session:
+
+        async def _upload(doc: models.Document, kb: models.KnowledgeBase) -> Optional[str]:
+            if doc.ragflow_document_id:
+                return doc.ragflow_document_id
+            async with semaphore:
+                try:
+                    data = await _read_minio_object(kb_bucket, doc.storage_path)
+                    return await _ragflow_upload_document(
+                        kb.ragflow_dataset_id,
+                        doc.original_name or doc.filename,
+                        data,
+                        doc.mime_type or "application/octet-stream",
+                    )
+                except Exception as exc:
+                    logger.warning("批量嵌入上传失败 document_id=%s: %s", doc.id, exc)
+                    return None
+
+        try:
+            rows = (
+                await session.execute(
+                    select(models.EmbeddingTask, models.Document, models.KnowledgeBase)
+                    .join(models.Document, models.EmbeddingTask.document_id == models.Document.id)
+                    .join(models.KnowledgeBase, models.Document.kb_id == models.KnowledgeBase.id)
+                    .where(models.EmbeddingTask.id.in_(task_ids))
+                )
+            ).all()
+            await _ensure_bucket(kb_bucket)
+            uploaded = await asyncio.gather(*(_upload(doc, kb) for _, doc, kb in rows))
+
+            by_dataset: Dict[str, List[Tuple[models.EmbeddingTask, str]]] = {}
+            for (task, doc, kb), ragflow_doc_id in zip(rows, uploaded):
+                if ragflow_doc_id:
+                    doc.ragflow_document_id = ragflow_doc_id
+                    task.ragflow_task_id = ragflow_doc_id
+                    by_dataset.setdefault(kb.ragflow_dataset_id, []).append((task, ragflow_doc_id))
+                else:
+                    task.message = "批量上传失败，转为单独执行"
+            await session.commit()
+
+            for dataset_id, items in by_dataset.items():
+                try:
+                    await _ragflow_parse_documents(dataset_id, [rid for _, rid in items])
+                    message = "已提交解析"
+                except Exception as exc:
+                    logger.warning("批量嵌入解析提交失败 dataset=%s: %s", dataset_id, exc)
+                    message = "批量解析提交失败，转为单独执行"
+                for task, _ in items:
+                    task.message = message
+        finally:
+            # 无论成败（包括关闭时被取消）都交给 worker：跟踪进度，或按单文档流程重试
+            requeue = (
+                update(models.EmbeddingTask)
+                .where(
+                    models.EmbeddingTask.id.in_(task_ids),
+                    models.EmbeddingTask.status == models.EmbeddingTaskStatus.running,
+                )
+                .values(status=models.EmbeddingTaskStatus.queued)
+            )
+            try:
+                await session.execute(requeue)
+                await session.commit()
+            except Exception:
+                # 取消发生在提交过程中时会话可能已失效：回滚后只做放回队列
+                logger.warning("批量嵌入任务状态提交失败，重新放回队列", exc_info=True)
+                await session.rollback()
+                await session.execute(requeue)
+                await session.commit()
+            _embedding_wakeup.set()
+
+
+@app.on_event("startup")
+async def _start_embedding_workers() -> None:
+    """启动嵌入 worker；超时仍为 running 的任务视为上次进程遗留，重新排队。"""
+    stale_before = datetime.utcnow() - timedelta(seconds=settings.embedding_parse_timeout)
+    try:
+        async with AsyncSessionLocal() as session:
+            await session.execute(
+                update(models.EmbeddingTask)
+                .where(
+                    models.EmbeddingTask.status == models.EmbeddingTaskStatus.running,
+                    models.EmbeddingTask.started_at < stale_before,
+                )
+                .values(status=models.EmbeddingTaskStatus.queued, next_run_at=None)
+            )
+            await session.commit()
+    except Exception as exc:
+        logger.warning("恢复遗留嵌入任务失败: %s", exc)
+
+    for _ in range(settings.embedding_worker_count):
+        _embedding_workers.append(asyncio.create_task(_embedding_worker()))
+
+
+async def _stop_embedding_workers() -> None:
+    """停止嵌入 worker（执行中的任务会被放回队列）。"""
+    for worker in _embedding_workers:
+        worker.cancel()
+    await asyncio.gather(*_embedding_workers, return_exceptions=True)
+    _embedding_workers.clear()
+
+
 # ------------------------------
 # 嵌入管理（RAGFlow 文件上传 + 解析）
 # ------------------------------
@@ -3068,14 +3947,8 @@ async def run_embedding(
     payload: EmbeddingRunRequest,
     session: AsyncSession = Depends(get_session),
 ):
-    """将已审核文件上传到 RAGFlow 并解析。"""
-    teacher = (
-        await session.execute(
-            select(models.Teacher).where(models.Teacher.id == payload.teacher_id)
-        )
-    ).scalar_one_or_none()
-    if not teacher or teacher.status != 1:
-        raise HTTPException(status_code=403, detail="教师不存在或已停用")
+    """提交嵌入任务（入队后立即返回，由后台 worker 上传 RAGFlow 并跟踪解析进度）。"""
+    teacher = await _get_active_principal(session, "teacher", payload.teacher_id)
 
     doc = (
         await session.execute(
@@ -3095,60 +3968,177 @@ async def run_embedding(
     if not kb or not kb.ragflow_dataset_id:
         raise HTTPException(status_code=400, detail="知识库未绑定 RAGFlow dataset")
 
-    task = models.EmbeddingTask(
-        document_id=doc.id,
-        triggered_by_teacher_id=teacher.id,
-        chunk_method=payload.chunk_method or "table",
-        status=models.EmbeddingTaskStatus.running,
-        started_at=datetime.utcnow(),
+    # 同一文档已有排队/执行中的任务时直接返回，避免重复提交
+    task = (
+        await session.execute(
+            select(models.EmbeddingTask)
+            .where(
+                models.EmbeddingTask.document_id == doc.id,
+                models.EmbeddingTask.status.in_(
+                    [models.EmbeddingTaskStatus.queued, models.EmbeddingTaskStatus.running]
+                ),
+            )
+            .order_by(models.EmbeddingTask.id.desc())
+            .limit(1)
+        )
+    ).scalar_one_or_none()
+    if not task:
+        task = models.EmbeddingTask(
+            document_id=doc.id,
+            triggered_by_teacher_id=teacher.user_id,
+            chunk_method=payload.chunk_method or "table",
+            status=models.EmbeddingTaskStatus.queued,
+            attempts=0,
+        )
+        session.add(task)
+        await session.commit()
+        await session.refresh(task)
+        _embedding_wakeup.set()
+
+    return {
+        "task_id": task.id,
+        "document_id": doc.id,
+        "ragflow_document_id": doc.ragflow_document_id,
+        "status": task.status.value,
+    }
+
+
+@app.post("/embeddings/batch")
+async def run_embedding_batch(
+    payload: EmbeddingBatchRequest,
+    session: AsyncSession = Depends(get_session),
+):
+    """批量提交嵌入任务：每个文档一条任务，按 dataset 合并解析请求。"""
+    teacher = await _get_active_principal(session, "teacher", payload.teacher_id)
+
+    stmt = select(models.Document, models.KnowledgeBase).join(
+        models.KnowledgeBase, models.Document.kb_id == models.KnowledgeBase.id
     )
-    session.add(task)
-    await session.commit()
-    await session.refresh(task)
+    if payload.document_ids:
+        document_ids = list(dict.fromkeys(payload.document_ids))
+        stmt = stmt.where(models.Document.id.in_(document_ids))
+    else:
+        # 未指定文档时按班级/知识库选取全部已通过文件（含权限校验）
+        kb = await _resolve_kb_for_search(
+            session,
+            "teacher",
+            payload.teacher_id,
+            payload.kb_id,
+            payload.class_id,
+            payload.class_code,
+        )
+        document_ids = None
+        stmt = stmt.where(
+            models.Document.kb_id == kb.id,
+            models.Document.status == models.DocumentStatus.approved,
+        )
+    rows = (await session.execute(stmt.order_by(models.Document.id))).all()
 
-    try:
-        client = _get_minio_client()
-        kb_bucket = settings.minio_bucket_kb
-        _ensure_bucket(client, kb_bucket)
-        data = _read_minio_object(client, kb_bucket, doc.storage_path)
-        filename = doc.original_name or doc.filename
-        content_type = doc.mime_type or "application/octet-stream"
-
-        # 若已存在 ragflow_document_id，直接复用
-        ragflow_doc_id = doc.ragflow_document_id
-        if not ragflow_doc_id:
-            ragflow_doc_id = await _ragflow_upload_document(
-                kb.ragflow_dataset_id,
-                filename,
-                data,
-                content_type,
-            )
-            doc.ragflow_document_id = ragflow_doc_id
+    if len(rows) > settings.embedding_batch_max_documents:
+        raise HTTPException(
+            status_code=400,
+            detail=f"单次最多提交 {settings.embedding_batch_max_documents} 个文档",
+        )
+
+    # 已有排队/执行中任务的文档跳过
+    active_doc_ids = set()
+    if rows:
+        active_doc_ids = set(
+            (
+                await session.execute(
+                    select(models.EmbeddingTask.document_id).where(
+                        models.EmbeddingTask.document_id.in_([doc.id for doc, _ in rows]),
+                        models.EmbeddingTask.status.in_(
+                            [models.EmbeddingTaskStatus.queued, models.EmbeddingTaskStatus.running]
+                        ),
+                    )
+                )
+            ).scalars().all()
+        )
 
-        await _ragflow_parse_documents(kb.ragflow_dataset_id, [ragflow_doc_id])
+    skipped: List[Dict[str, Any]] = []
+    if document_ids is not None:
+        found = {doc.id for doc, _ in rows}
+        skipped.extend(
+            {"document_id": doc_id, "reason": "文档不存在"}
+            for doc_id in document_ids
+            if doc_id not in found
+        )
 
-        doc.status = models.DocumentStatus.embedded
-        task.status = models.EmbeddingTaskStatus.success
-        task.finished_at = datetime.utcnow()
-        await session.commit()
-    except HTTPException as exc:
-        task.status = models.EmbeddingTaskStatus.failed
-        task.message = str(exc.detail)
-        task.finished_at = datetime.utcnow()
-        await session.commit()
-        raise
-    except Exception as exc:
-        task.status = models.EmbeddingTaskStatus.failed
-        task.message = str(exc)
-        task.finished_at = datetime.utcnow()
+    tasks: List[models.EmbeddingTask] = []
+    now = datetime.utcnow()
+    for doc, kb in rows:
+        if doc.status != models.DocumentStatus.approved:
+            skipped.append({"document_id": doc.id, "reason": "文档未通过审核"})
+            continue
+        if not kb.ragflow_dataset_id:
+            skipped.append({"document_id": doc.id, "reason": "知识库未绑定 RAGFlow dataset"})
+            continue
+        if doc.id in active_doc_ids:
+            skipped.append({"document_id": doc.id, "reason": "已有进行中的嵌入任务"})
+            continue
+        # 由批量提交协程持有（running），提交完成后再交给 worker
+        task = models.EmbeddingTask(
+            document_id=doc.id,
+            triggered_by_teacher_id=teacher.user_id,
+            chunk_method=payload.chunk_method or "table",
+            status=models.EmbeddingTaskStatus.running,
+            attempts=1,
+            started_at=now,
+        )
+        session.add(task)
+        tasks.append(task)
+
+    if tasks:
         await session.commit()
-        raise HTTPException(status_code=500, detail="嵌入任务失败")
+        batch = asyncio.create_task(_submit_embedding_batch([task.id for task in tasks]))
+        _embedding_batches.add(batch)
+        batch.add_done_callback(_embedding_batches.discard)
+
+    return {
+        "submitted": len(tasks),
+        "tasks": [
+            {"task_id": task.id, "document_id": task.document_id, "status": task.status.value}
+            for task in tasks
+        ],
+        "skipped": skipped,
+    }
+
+
+@app.get("/embeddings/tasks/{task_id}")
+async def get_embedding_task(
+    task_id: int,
+    teacher_id: int,
+    session: AsyncSession = Depends(get_session),
+):
+    """查询嵌入任务状态（供前端轮询），仅限任务所属文档班级的教师。"""
+    teacher = await _get_active_principal(session, "teacher", teacher_id)
+
+    row = (
+        await session.execute(
+            select(models.EmbeddingTask, models.Class)
+            .join(models.Document, models.EmbeddingTask.document_id == models.Document.id)
+            .join(models.KnowledgeBase, models.Document.kb_id == models.KnowledgeBase.id)
+            .join(models.Class, models.KnowledgeBase.class_id == models.Class.id)
+            .where(models.EmbeddingTask.id == task_id)
+        )
+    ).first()
+    if not row:
+        raise HTTPException(status_code=404, detail="嵌入任务不存在")
+    task, cls = row
+    _check_document_permission(teacher, cls)
 
     return {
         "task_id": task.id,
-        "document_id": doc.id,
-        "ragflow_document_id": doc.ragflow_document_id,
+        "document_id": task.document_id,
         "status": task.status.value,
+        "chunk_method": task.chunk_method,
+        "ragflow_task_id": task.ragflow_task_id,
+        "attempts": task.attempts,
+        "next_run_at": task.next_run_at,
+        "started_at": task.started_at,
+        "finished_at": task.finished_at,
+        "message": task.message,
     }
 
 
@@ -3157,16 +4147,312 @@ async def run_embedding(
 # ------------------------------
 
 
+async def _resolve_kbs_for_search(
+    session: AsyncSession,
+    role: str,
+    user_id: int,
+    kb_ids: Optional[List[int]],
+    class_ids: Optional[List[int]],
+) -> List[models.KnowledgeBase]:
+    """多知识库检索的权限与范围解析（kb_ids/class_ids 均为空表示全部可访问）。
+
+    数量上限只约束显式传入的 kb_ids/class_ids；全部可访问模式由检索时按组合并 dataset 处理。
+    """
+    principal = await _get_active_principal(session, role, user_id)
+
+    allowed_class_ids: Optional[Set[int]] = None
+    if principal.role == "student":
+        allowed_class_ids = {principal.class_id} if principal.class_id else set()
+    elif principal.role == "teacher":
+        allowed_class_ids = set(principal.class_ids)
+
+    if allowed_class_ids is not None and class_ids and not set(class_ids) <= allowed_class_ids:
+        raise HTTPException(status_code=403, detail="无权访问该班级")
+
+    stmt = select(models.KnowledgeBase)
+    if allowed_class_ids is not None:
+        stmt = stmt.where(models.KnowledgeBase.class_id.in_(allowed_class_ids))
+    if class_ids:
+        stmt = stmt.where(models.KnowledgeBase.class_id.in_(class_ids))
+    if kb_ids:
+        stmt = stmt.where(models.KnowledgeBase.id.in_(kb_ids))
+    kbs = (await session.execute(stmt.order_by(models.KnowledgeBase.id))).scalars().all()
+
+    if kb_ids:
+        found = {kb.id for kb in kbs}
+        missing = set(kb_ids) - found
+        if missing:
+            exists = (
+                await session.execute(
+                    select(models.KnowledgeBase.id).where(models.KnowledgeBase.id.in_(missing))
+                )
+            ).scalars().all()
+            if exists:
+                raise HTTPException(status_code=403, detail="无权访问该知识库")
+            raise HTTPException(status_code=404, detail="知识库不存在")
+
+    kbs = [kb for kb in kbs if kb.ragflow_dataset_id]
+    if not kbs:
+        raise HTTPException(status_code=400, detail="没有可检索的知识库")
+    if (kb_ids or class_ids) and len(kbs) > settings.search_fanout_max_kbs:
+        raise HTTPException(
+            status_code=400,
+            detail=f"单次最多检索 {settings.search_fanout_max_kbs} 个知识库",
+        )
+    return kbs
+
+
+async def _build_search_doc_map(
+    session: AsyncSession,
+    raw_chunks: List[Dict[str, Any]],
+) -> Dict[str, Dict[str, Any]]:
+    """按 chunk 中的 RAGFlow 文档 id 关联本地文档信息，方便前端定位（可点击跳转）。"""
+    ragflow_ids = {rid for rid in map(_extract_ragflow_doc_id, raw_chunks) if rid}
+    return await doc_hydration.fetch(session, ragflow_ids)
+
+
+# 检索结果中与查询相关、不属于 chunk 本身的字段，写入预览缓存前去掉
+_RETRIEVAL_ONLY_FIELDS = {"highlight", "similarity", "vector_similarity", "term_similarity", "vector"}
+
+
+def _prefetch_chunks(
+    formatted: List[Dict[str, Any]],
+    raw_chunks: List[Dict[str, Any]],
+    dataset_ids: List[Optional[str]],
+    generations: Dict[str, int],
+    budget_bytes: Optional[int],
+) -> Dict[str, Any]:
+    """预取案例内容：完整 chunk 写入预览缓存，并在字节预算内随检索结果内联返回。
+
+    formatted / raw_chunks / dataset_ids 按位置一一对应；超出预算的结果 prefetched=false，
+    前端仍可调用 /cases/preview（此时通常命中缓存，无需再访问 RAGFlow）。
+    generations 为检索前取得的各 dataset 检索缓存代数：文档重新嵌入/删除时检索缓存与预览缓存同时失效，
+    代数变化说明本次检索结果可能已过期，不再写入预览缓存（仍正常内联返回）。
+    """
+    budget = settings.search_prefetch_budget_bytes if budget_bytes is None else budget_bytes
+    budget = max(0, min(budget, settings.search_prefetch_max_budget_bytes))
+    used = 0
+    inlined = 0
+    seeded = 0
+    for result, item, dataset_id in zip(formatted, raw_chunks, dataset_ids):
+        chunk = {key: value for key, value in item.items() if key not in _RETRIEVAL_ONLY_FIELDS}
+        ragflow_doc_id = result["ragflow_document_id"]
+        chunk_id = result["chunk_id"]
+        if (
+            dataset_id
+            and ragflow_doc_id
+            and chunk_id
+            and generations.get(dataset_id) == retrieval_cache.generation(dataset_id)
+        ):
+            seeded += chunk_cache.put(dataset_id, ragflow_doc_id, chunk_id, chunk)
+        size = len(json.dumps(chunk, ensure_ascii=False, default=str).encode("utf-8"))
+        if used + size <= budget:
+            used += size
+            inlined += 1
+            result["positions"] = chunk.get("positions")
+            result["raw_chunk"] = chunk
+            result["prefetched"] = True
+        else:
+            result["prefetched"] = False
+    return {"inlined": inlined, "bytes": used, "budget_bytes": budget, "cache_seeded": seeded}
+
+
+def _chunk_score(item: Dict[str, Any]) -> float:
+    """检索结果的相似度分数（缺失时视为 0）。"""
+    try:
+        return float(item.get("similarity") or item.get("score") or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _merge_chunks(chunk_lists: List[List[Dict[str, Any]]], top_k: int) -> List[Dict[str, Any]]:
+    """合并多个知识库的检索结果：按分数降序，按 chunk_id 去重，截取 top_k。"""
+    merged: List[Dict[str, Any]] = []
+    seen: Set[str] = set()
+    candidates = [item for chunks in chunk_lists for item in chunks if isinstance(item, dict)]
+    for item in sorted(candidates, key=_chunk_score, reverse=True):
+        chunk_id = item.get("id") or item.get("chunk_id")
+        if chunk_id:
+            if chunk_id in seen:
+                continue
+            seen.add(chunk_id)
+        merged.append(item)
+        if len(merged) >= top_k:
+            break
+    return merged
+
+
+async def _fanout_retrieve(
+    kbs: List[models.KnowledgeBase],
+    question: str,
+    top_k: int,
+    similarity_threshold: Optional[float],
+    highlight: bool,
+) -> List[Dict[str, Any]]:
+    """并发检索多个知识库（并发数受限，单库超时/失败不影响其他库）。
+
+    知识库数不超过 search_fanout_max_kbs 时逐库检索（可命中检索缓存）；
+    超过时（全部可访问模式）每 search_fanout_datasets_per_call 个 dataset 合并为一次 RAGFlow 检索，
+    结果按 chunk 所属 dataset 拆回各知识库。合并检索的 top_k 按组内知识库数放大（top_k × 组大小），
+    使每个知识库仍有 top_k 个候选参与最终合并，与逐库检索的召回口径一致。
+    返回每个知识库的 {kb, chunks, status, cache}，status 为 ok / timeout / error。
+    """
+    semaphore = asyncio.Semaphore(max(1, settings.search_fanout_concurrency))
+
+    async def _retrieve(group: List[models.KnowledgeBase]) -> Tuple[List[Dict[str, Any]], Optional[bool]]:
+        if len(group) == 1:
+            return await _cached_retrieve(
+                group[0].ragflow_dataset_id, question, top_k, similarity_threshold, highlight
+            )
+        chunks = await _ragflow_retrieve(
+            [kb.ragflow_dataset_id for kb in group],
+            question,
+            top_k * len(group),
+            similarity_threshold,
+            highlight,
+        )
+        return chunks, None
+
+    async def _one(group: List[models.KnowledgeBase]) -> List[Dict[str, Any]]:
+        async with semaphore:
+            try:
+                chunks, hit = await asyncio.wait_for(
+                    _retrieve(group), timeout=settings.search_fanout_kb_timeout
+                )
+            except asyncio.TimeoutError:
+                return [{"kb": kb, "chunks": [], "status": "timeout", "cache": None} for kb in group]
+            except (HTTPException, httpx.HTTPError) as exc:
+                detail = exc.detail if isinstance(exc, HTTPException) else str(exc)
+                logger.warning("知识库 %s 检索失败: %s", [kb.id for kb in group], detail)
+                return [
+                    {"kb": kb, "chunks": [], "status": "error", "cache": None, "error": detail}
+                    for kb in group
+                ]
+        cache = None if hit is None else ("hit" if hit else "miss")
+        by_dataset: Dict[str, List[Dict[str, Any]]] = {kb.ragflow_dataset_id: [] for kb in group}
+        for item in chunks:
+            dataset_id = _chunk_dataset_id(item) if isinstance(item, dict) else None
+            # 无法识别所属 dataset 的 chunk 归到组内第一个知识库
+            by_dataset.get(dataset_id, by_dataset[group[0].ragflow_dataset_id]).append(item)
+        return [
+            {"kb": kb, "chunks": by_dataset[kb.ragflow_dataset_id], "status": "ok", "cache": cache}
+            for kb in group
+        ]
+
+    group_size = 1
+    if len(kbs) > settings.search_fanout_max_kbs:
+        group_size = max(1, settings.search_fanout_datasets_per_call)
+    groups = [kbs[i : i + group_size] for i in range(0, len(kbs), group_size)]
+    return [result for results in await asyncio.gather(*map(_one, groups)) for result in results]
+
+
+def _chunk_dataset_id(item: Dict[str, Any]) -> Optional[str]:
+    """检索结果 chunk 所属的 RAGFlow dataset id。"""
+    return item.get("dataset_id") or item.get("kb_id")
+
+
+async def _search_multiple_kbs(
+    session: AsyncSession,
+    role: str,
+    payload: SearchRequest,
+) -> Dict[str, Any]:
+    """多知识库检索：并发检索后按分数合并、chunk_id 去重。
+
+    搜索日志：显式 kb_ids/class_ids 时按成功的知识库各记一条，all_accessible 时整次请求只记一条。
+    """
+    kbs = await _resolve_kbs_for_search(
+        session,
+        role,
+        payload.user_id,
+        None if payload.all_accessible else payload.kb_ids,
+        None if payload.all_accessible else payload.class_ids,
+    )
+    # 检索前记录各 dataset 的检索缓存代数，供预取时判断结果是否已过期
+    generations = {
+        kb.ragflow_dataset_id: retrieval_cache.generation(kb.ragflow_dataset_id) for kb in kbs
+    }
+    results = await _fanout_retrieve(
+        kbs,
+        payload.query,
+        payload.top_k,
+        payload.similarity_threshold,
+        payload.highlight,
+    )
+    if all(result["status"] != "ok" for result in results):
+        raise HTTPException(status_code=502, detail="RAGFlow 检索失败: 所有知识库均未返回结果")
+
+    raw_chunks = _merge_chunks([result["chunks"] for result in results], payload.top_k)
+    doc_map = await _build_search_doc_map(session, raw_chunks)
+    formatted = _format_search_chunks(raw_chunks, doc_map)
+    # 合并结果中的 chunk -> 所属知识库（按对象 id 反查）
+    kb_of = {id(item): result["kb"] for result in results for item in result["chunks"]}
+    prefetch = None
+    if payload.prefetch:
+        prefetch = _prefetch_chunks(
+            formatted,
+            [item for item in raw_chunks if isinstance(item, dict)],
+            [
+                kb_of[id(item)].ragflow_dataset_id if id(item) in kb_of else None
+                for item in raw_chunks
+                if isinstance(item, dict)
+            ],
+            generations,
+            payload.prefetch_budget_bytes,
+        )
+
+    # 搜索日志口径：显式指定 kb_ids/class_ids 时每个成功检索的知识库各记一条；
+    # all_accessible 模式一次请求只记一条（归到首条命中所在的知识库，无命中时归到首个成功的知识库），
+    # 避免可访问知识库越多、搜索次数统计被放大
+    ok_results = [result for result in results if result["status"] == "ok"]
+    if payload.all_accessible:
+        top_kb = kb_of.get(id(raw_chunks[0])) if raw_chunks else None
+        log_entries = [(top_kb or ok_results[0]["kb"], len(formatted))]
+    else:
+        log_entries = [(result["kb"], len(result["chunks"])) for result in ok_results]
+    for log_kb, result_count in log_entries:
+        search_log_writer.add(
+            kb_id=log_kb.id,
+            query=payload.query,
+            result_count=result_count,
+            user_teacher_id=payload.user_id if role == "teacher" else None,
+            user_student_id=payload.user_id if role == "student" else None,
+        )
+
+    return {
+        "kb_ids": [kb.id for kb in kbs],
+        "knowledge_bases": [
+            {
+                "kb_id": result["kb"].id,
+                "ragflow_dataset_id": result["kb"].ragflow_dataset_id,
+                "status": result["status"],
+                "result_count": len(result["chunks"]),
+                "cache": result["cache"],
+            }
+            for result in results
+        ],
+        "result_count": len(formatted),
+        "prefetch": prefetch,
+        "chunks": formatted,
+    }
+
+
 @app.post("/search")
 async def search_cases(
     payload: SearchRequest,
     session: AsyncSession = Depends(get_session),
 ):
-    """基于 RAGFlow 的检索接口。"""
+    """基于 RAGFlow 的检索接口。
+
+    传 kb_ids / class_ids 或 all_accessible=true 时进入多知识库检索模式
+    （搜索日志记录口径见 _search_multiple_kbs）。
+    """
     role = payload.role.lower().strip()
     if role not in {"student", "teacher", "admin"}:
         raise HTTPException(status_code=400, detail="role 参数不合法")
 
+    if payload.kb_ids or payload.class_ids or payload.all_accessible:
+        return await _search_multiple_kbs(session, role, payload)
+
     kb = await _resolve_kb_for_search(
         session,
         role,
@@ -3179,72 +4465,190 @@ async def search_cases(
     if not kb.ragflow_dataset_id:
         raise HTTPException(status_code=400, detail="知识库未绑定 RAGFlow dataset")
 
-    base_url = str(settings.ragflow_base_url).rstrip("/")
-    headers = _ragflow_headers()
-    body = {
-        "question": payload.query,
-        "dataset_ids": [kb.ragflow_dataset_id],
-        "top_k": payload.top_k,
-        "highlight": payload.highlight,
-    }
-    if payload.similarity_threshold is not None:
-        body["similarity_threshold"] = payload.similarity_threshold
-
-    async with httpx.AsyncClient(timeout=60) as client:
-        resp = await client.post(f"{base_url}/api/v1/retrieval", json=body, headers=headers)
-
-    if resp.status_code >= 400:
-        raise HTTPException(status_code=502, detail=f"RAGFlow 检索失败: HTTP {resp.status_code}")
-
-    data = resp.json()
-    if data.get("code") != 0:
-        message = data.get("message", "未知错误")
-        raise HTTPException(status_code=502, detail=f"RAGFlow 检索失败: {message}")
-
-    raw_chunks = data.get("data", {}).get("chunks", [])
-
-    # 关联本地文档信息，方便前端定位（可点击跳转）
-    ragflow_ids = list({rid for rid in map(_extract_ragflow_doc_id, raw_chunks) if rid})
-    doc_map: Dict[str, Dict[str, Any]] = {}
-    if ragflow_ids:
-        rows = (
-            await session.execute(
-                select(models.Document, models.KnowledgeBase, models.Class)
-                .join(models.KnowledgeBase, models.Document.kb_id == models.KnowledgeBase.id)
-                .join(models.Class, models.KnowledgeBase.class_id == models.Class.id)
-                .where(models.Document.ragflow_document_id.in_(ragflow_ids))
-            )
-        ).all()
-        for doc, kb_row, cls in rows:
-            doc_map[doc.ragflow_document_id] = {
-                "document_id": doc.id,
-                "document_name": doc.original_name,
-                "kb_id": kb_row.id,
-                "class_id": cls.id,
-                "class_code": cls.class_code,
-                "class_name": cls.class_name,
-            }
+    generation = retrieval_cache.generation(kb.ragflow_dataset_id)
+    raw_chunks, cache_hit = await _cached_retrieve(
+        kb.ragflow_dataset_id,
+        payload.query,
+        payload.top_k,
+        payload.similarity_threshold,
+        payload.highlight,
+    )
 
+    doc_map = await _build_search_doc_map(session, raw_chunks)
     formatted = _format_search_chunks(raw_chunks, doc_map)
+    prefetch = None
+    if payload.prefetch:
+        valid_chunks = [item for item in raw_chunks if isinstance(item, dict)]
+        prefetch = _prefetch_chunks(
+            formatted,
+            valid_chunks,
+            [kb.ragflow_dataset_id] * len(valid_chunks),
+            {kb.ragflow_dataset_id: generation},
+            payload.prefetch_budget_bytes,
+        )
 
-    # 写入搜索日志
-    log = models.SearchLog(
-        user_teacher_id=payload.user_id if role == "teacher" else None,
-        user_student_id=payload.user_id if role == "student" else None,
+    # 写入搜索日志（异步批量落库，不阻塞响应）
+    search_log_writer.add(
         kb_id=kb.id,
         query=payload.query,
         result_count=len(formatted),
-        created_at=datetime.utcnow(),
+        user_teacher_id=payload.user_id if role == "teacher" else None,
+        user_student_id=payload.user_id if role == "student" else None,
     )
-    session.add(log)
-    await session.commit()
 
-    return {
+    return {
+        "kb_id": kb.id,
+        "ragflow_dataset_id": kb.ragflow_dataset_id,
+        "result_count": len(formatted),
+        "cache": "hit" if cache_hit else "miss",
+        "prefetch": prefetch,
+        "chunks": formatted,
+    }
+
+
+async def _batch_search_stream(
+    kb: models.KnowledgeBase,
+    role: str,
+    payload: BatchSearchRequest,
+) -> AsyncIterator[bytes]:
+    """批量检索的 NDJSON 输出：每完成一条查询输出一行，最后输出汇总行。
+
+    单条查询的任何异常只影响该条（输出 status=error 的行），不会中断整个批次。
+    """
+    semaphore = asyncio.Semaphore(max(1, settings.search_batch_concurrency))
+
+    async def _one(index: int, query: str) -> Tuple[int, str, Optional[List[Dict[str, Any]]], Any]:
+        async with semaphore:
+            try:
+                chunks, hit = await _cached_retrieve(
+                    kb.ragflow_dataset_id,
+                    query,
+                    payload.top_k,
+                    payload.similarity_threshold,
+                    payload.highlight,
+                )
+            except (HTTPException, httpx.HTTPError) as exc:
+                return index, query, None, exc.detail if isinstance(exc, HTTPException) else str(exc)
+            except Exception:
+                logger.exception("批量检索第 %s 条查询异常", index)
+                return index, query, None, "检索异常"
+            return index, query, chunks, hit
+
+    # 整个批次共用一份文档映射：每个 RAGFlow 文档 id 只解析一次
+    doc_map: Dict[str, Dict[str, Any]] = {}
+    looked_up: Set[str] = set()
+    log_rows: List[Dict[str, Any]] = []
+
+    async def _result_line(
+        session: AsyncSession, index: int, query: str, chunks: List[Dict[str, Any]], hit: bool
+    ) -> Dict[str, Any]:
+        new_ids = [
+            rid
+            for rid in {_extract_ragflow_doc_id(item) for item in chunks}
+            if rid and rid not in looked_up
+        ]
+        if new_ids:
+            doc_map.update(await doc_hydration.fetch(session, new_ids))
+            looked_up.update(new_ids)
+        formatted = _format_search_chunks(chunks, doc_map)
+        log_rows.append(
+            search_log_writer.make_row(
+                kb_id=kb.id,
+                query=query,
+                result_count=len(formatted),
+                user_teacher_id=payload.user_id if role == "teacher" else None,
+                user_student_id=payload.user_id if role == "student" else None,
+            )
+        )
+        return {
+            "type": "result",
+            "status": "ok",
+            "index": index,
+            "query": query,
+            "result_count": len(formatted),
+            "cache": "hit" if hit else "miss",
+            "chunks": formatted,
+        }
+
+    tasks = [asyncio.create_task(_one(index, query)) for index, query in enumerate(payload.queries)]
+    failed = 0
+    try:
+        async with AsyncSessionLocal() as session:
+            for future in asyncio.as_completed(tasks):
+                index, query, chunks, extra = await future
+                if chunks is not None:
+                    try:
+                        line = await _result_line(session, index, query, chunks, extra)
+                    except Exception:
+                        logger.exception("批量检索第 %s 条结果处理异常", index)
+                        await session.rollback()
+                        chunks, extra = None, "结果处理异常"
+                if chunks is None:
+                    failed += 1
+                    line = {
+                        "type": "error",
+                        "status": "error",
+                        "index": index,
+                        "query": query,
+                        "detail": extra,
+                    }
+                yield (json.dumps(line, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+    finally:
+        for task in tasks:
+            task.cancel()
+        # 整批日志一次多行 INSERT 写入
+        await search_log_writer.write(log_rows)
+
+    summary = {
+        "type": "summary",
         "kb_id": kb.id,
         "ragflow_dataset_id": kb.ragflow_dataset_id,
-        "result_count": len(formatted),
-        "chunks": formatted,
+        "total": len(payload.queries),
+        "succeeded": len(payload.queries) - failed,
+        "failed": failed,
     }
+    yield (json.dumps(summary, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+@app.post("/search/batch")
+async def search_cases_batch(
+    payload: BatchSearchRequest,
+    session: AsyncSession = Depends(get_session),
+):
+    """批量检索（教师/管理员评估题库检索效果）。
+
+    知识库与权限只解析一次，查询并发执行，结果以 NDJSON 按完成顺序逐行返回。
+    """
+    role = payload.role.lower().strip()
+    if role not in {"teacher", "admin"}:
+        raise HTTPException(status_code=403, detail="仅教师或管理员可批量检索")
+
+    queries = [query.strip() for query in payload.queries]
+    if not queries or any(not query for query in queries):
+        raise HTTPException(status_code=400, detail="queries 不能为空")
+    if len(queries) > settings.search_batch_max_queries:
+        raise HTTPException(
+            status_code=400,
+            detail=f"单次最多 {settings.search_batch_max_queries} 条查询",
+        )
+    payload.queries = queries
+
+    kb = await _resolve_kb_for_search(
+        session,
+        role,
+        payload.user_id,
+        payload.kb_id,
+        payload.class_id,
+        payload.class_code,
+    )
+    if not kb.ragflow_dataset_id:
+        raise HTTPException(status_code=400, detail="知识库未绑定 RAGFlow dataset")
+
+    return StreamingResponse(
+        _batch_search_stream(kb, role, payload),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 # ------------------------------
@@ -3349,15 +4753,15 @@ async def list_conversations(
     include_last_message: bool = False,
     page: int = 1,
     page_size: int = 20,
+    pagination: str = "page",
+    cursor: Optional[str] = None,
+    count: Optional[str] = None,
     session: AsyncSession = Depends(get_session),
 ):
     """对话列表（支持班级筛选/关键词搜索）。"""
     role = role.lower().strip()
     if role not in {"teacher", "student"}:
         raise HTTPException(status_code=403, detail="仅教师或学生可查看对话")
-    if page < 1 or page_size < 1 or page_size > 100:
-        raise HTTPException(status_code=400, detail="分页参数不合法")
-
     class_id = await _resolve_class_id(session, class_id, class_code)
 
     stmt = (
@@ -3379,36 +4783,28 @@ async def list_conversations(
         # 关键词搜索仅针对对话名称
         stmt = stmt.where(models.Conversation.name.like(f"%{keyword.strip()}%"))
 
-    total_stmt = select(func.count()).select_from(stmt.subquery())
-    total = (await session.execute(total_stmt)).scalar_one()
-
-    rows = (
-        await session.execute(
-            stmt
-            .order_by(models.Conversation.updated_at.desc())
-            .offset((page - 1) * page_size)
-            .limit(page_size)
-        )
-    ).all()
+    rows, page_info = await _paginate(
+        session,
+        stmt,
+        models.Conversation.updated_at,
+        models.Conversation.id,
+        page,
+        page_size,
+        pagination,
+        cursor,
+        count,
+    )
 
-    # 可选：补充每个对话的最后一条消息（用于列表预览）
-    last_message_map: Dict[int, Dict[str, Any]] = {}
-    if include_last_message and rows:
-        conv_ids = [conv.id for conv, _, _ in rows]
-        msg_rows = (
-            await session.execute(
-                select(models.Message)
-                .where(models.Message.conversation_id.in_(conv_ids))
-                .order_by(models.Message.conversation_id, models.Message.created_at.desc())
-            )
-        ).scalars().all()
-        for msg in msg_rows:
-            if msg.conversation_id not in last_message_map:
-                last_message_map[msg.conversation_id] = {
-                    "role": msg.sender_role.value,
-                    "content": msg.content,
-                    "created_at": msg.created_at,
-                }
+    # 可选：补充每个对话的最后一条消息（读取对话上的冗余字段，无需查询消息表）
+    def _last_message(conv: models.Conversation) -> Optional[Dict[str, Any]]:
+        if not include_last_message or conv.last_message_id is None:
+            return None
+        return {
+            "id": conv.last_message_id,
+            "role": conv.last_message_role.value if conv.last_message_role else None,
+            "content": conv.last_message_preview,
+            "created_at": conv.last_message_at,
+        }
 
     items = [
         {
@@ -3424,15 +4820,13 @@ async def list_conversations(
             "show_citations": conv.show_citations,
             "created_at": conv.created_at,
             "updated_at": conv.updated_at,
-            "last_message": last_message_map.get(conv.id),
+            "last_message": _last_message(conv),
         }
         for conv, kb_row, cls in rows
     ]
 
     return {
-        "page": page,
-        "page_size": page_size,
-        "total": total,
+        **page_info,
         "items": items,
     }
 
@@ -3442,12 +4836,22 @@ async def get_conversation_detail(
     conversation_id: int,
     role: str,
     user_id: int,
+    limit: int = 50,
+    before_id: Optional[int] = None,
+    include_reference: bool = False,
     session: AsyncSession = Depends(get_session),
 ):
-    """对话详情（含消息列表）。"""
+    """对话详情（含消息列表，按 (created_at, id) 游标分页）。
+
+    - 默认返回最近 limit 条消息（按时间正序排列）
+    - before_id：加载该消息之前的更早消息，取上一页返回的 next_before_id
+    - include_reference：是否附带引用数据；默认不返回，需要时按消息单独获取
+    """
     role = role.lower().strip()
     if role not in {"teacher", "student"}:
         raise HTTPException(status_code=403, detail="仅教师或学生可查看对话")
+    if limit < 1 or limit > 200:
+        raise HTTPException(status_code=400, detail="limit 参数不合法")
 
     row = (
         await session.execute(
@@ -3466,24 +4870,51 @@ async def get_conversation_detail(
     if role == "student" and conv.owner_student_id != user_id:
         raise HTTPException(status_code=403, detail="无权查看该对话")
 
+    columns = [
+        models.Message.id,
+        models.Message.sender_role,
+        models.Message.content,
+        models.Message.created_at,
+    ]
+    if include_reference:
+        columns.append(models.Message.reference)
+    stmt = select(*columns).where(models.Message.conversation_id == conv.id)
+    if before_id is not None:
+        anchor = (
+            await session.execute(
+                select(models.Message.created_at).where(
+                    models.Message.id == before_id,
+                    models.Message.conversation_id == conv.id,
+                )
+            )
+        ).scalar_one_or_none()
+        if anchor is None:
+            raise HTTPException(status_code=400, detail="before_id 参数不合法")
+        stmt = stmt.where(
+            or_(
+                models.Message.created_at < anchor,
+                and_(models.Message.created_at == anchor, models.Message.id < before_id),
+            )
+        )
     msg_rows = (
         await session.execute(
-            select(models.Message)
-            .where(models.Message.conversation_id == conv.id)
-            .order_by(models.Message.created_at.asc())
+            stmt.order_by(models.Message.created_at.desc(), models.Message.id.desc()).limit(limit + 1)
         )
-    ).scalars().all()
+    ).all()
+    has_more = len(msg_rows) > limit
+    msg_rows = list(reversed(msg_rows[:limit]))
 
-    messages = [
-        {
+    messages = []
+    for m in msg_rows:
+        item = {
             "id": m.id,
             "role": m.sender_role.value,
             "content": m.content,
-            "reference": m.reference,
             "created_at": m.created_at,
         }
-        for m in msg_rows
-    ]
+        if include_reference:
+            item["reference"] = m.reference
+        messages.append(item)
 
     return {
         "conversation_id": conv.id,
@@ -3499,17 +4930,145 @@ async def get_conversation_detail(
         "system_prompt": conv.system_prompt,
         "created_at": conv.created_at,
         "updated_at": conv.updated_at,
+        "has_more": has_more,
+        "next_before_id": msg_rows[0].id if has_more and msg_rows else None,
         "messages": messages,
     }
 
 
+@app.get("/conversations/{conversation_id}/messages/{message_id}/reference")
+async def get_message_reference(
+    conversation_id: int,
+    message_id: int,
+    role: str,
+    user_id: int,
+    session: AsyncSession = Depends(get_session),
+):
+    """按需获取单条消息的引用数据（对话详情默认不返回）。"""
+    conv = await _get_conversation_for_owner(session, conversation_id, role, user_id)
+    reference = (
+        await session.execute(
+            select(models.Message.reference).where(
+                models.Message.id == message_id,
+                models.Message.conversation_id == conv.id,
+            )
+        )
+    ).first()
+    if reference is None:
+        raise HTTPException(status_code=404, detail="消息不存在")
+    return {"message_id": message_id, "reference": reference[0]}
+
+
+def _sse_event(payload: Dict[str, Any]) -> str:
+    """序列化为一条 SSE 事件。"""
+    return f"data: {json.dumps(payload, ensure_ascii=False, default=str)}\n\n"
+
+
+async def _save_streamed_answer(
+    conversation_id: int,
+    answer: str,
+    reference: Optional[Any],
+    ragflow_session_id: Optional[str],
+) -> models.Message:
+    """流式对话结束后保存助手消息（请求会话此时可能已关闭，单独开会话）。"""
+    async with AsyncSessionLocal() as session:
+        conv = await session.get(models.Conversation, conversation_id)
+        if conv and ragflow_session_id:
+            conv.ragflow_session_id = ragflow_session_id
+        if conv:
+            conv.updated_at = datetime.utcnow()
+        assistant_msg = models.Message(
+            conversation_id=conversation_id,
+            sender_role=models.SenderRole.assistant,
+            content=answer or "",
+            reference=reference,
+            created_at=datetime.utcnow(),
+        )
+        session.add(assistant_msg)
+        if conv:
+            await session.flush()
+            _set_last_message(conv, assistant_msg)
+        await session.commit()
+        await session.refresh(assistant_msg)
+        return assistant_msg
+
+
+# 客户端断开后在后台保存部分回答的任务（持有强引用，避免任务被回收；关闭时等待完成）
+_pending_answer_saves: Set[asyncio.Task] = set()
+
+
+def _on_answer_saved(task: asyncio.Task) -> None:
+    _pending_answer_saves.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("保存中断的对话回答失败", exc_info=task.exception())
+
+
+async def _relay_completion_stream(
+    conversation_id: int,
+    user_message_id: int,
+    first_event: Optional[Dict[str, Any]],
+    events: AsyncIterator[Dict[str, Any]],
+) -> AsyncIterator[str]:
+    """转发 RAGFlow SSE 事件，并在结束时保存完整回答与引用。"""
+    answer = ""
+    reference = None
+    ragflow_session_id = None
+
+    async def _all_events() -> AsyncIterator[Dict[str, Any]]:
+        if first_event is not None:
+            yield first_event
+        async for event in events:
+            yield event
+
+    try:
+        async for event in _all_events():
+            data = event.get("data") or {}
+            # answer 为累计文本，reference 仅部分事件携带
+            answer = _extract_completion_answer(data) or answer
+            reference = _extract_completion_reference(data) or reference
+            ragflow_session_id = data.get("session_id") or ragflow_session_id
+            yield _sse_event(event)
+    except HTTPException as exc:
+        yield _sse_event({"code": exc.status_code, "message": str(exc.detail)})
+    except httpx.HTTPError as exc:
+        yield _sse_event({"code": 502, "message": f"RAGFlow 对话中断: {exc.__class__.__name__}"})
+    except (asyncio.CancelledError, GeneratorExit):
+        # 客户端中途断开：后台保存已生成的部分回答
+        save = asyncio.ensure_future(
+            _save_streamed_answer(conversation_id, answer, reference, ragflow_session_id)
+        )
+        _pending_answer_saves.add(save)
+        save.add_done_callback(_on_answer_saved)
+        raise
+    finally:
+        # 归还上游连接
+        await events.aclose()
+
+    assistant_msg = await _save_streamed_answer(
+        conversation_id, answer, reference, ragflow_session_id
+    )
+    yield _sse_event(
+        {
+            "code": 0,
+            "data": {
+                "done": True,
+                "conversation_id": conversation_id,
+                "user_message_id": user_message_id,
+                "assistant_message_id": assistant_msg.id,
+                "assistant_answer": assistant_msg.content,
+                "reference": assistant_msg.reference,
+            },
+        }
+    )
+
+
 @app.post("/conversations/{conversation_id}/messages")
 async def send_conversation_message(
     conversation_id: int,
     payload: SendMessageRequest,
     session: AsyncSession = Depends(get_session),
 ):
-    """发送消息并调用 RAGFlow 生成回复。"""
+    """发送消息并调用 RAGFlow 生成回复（stream=true 时以 SSE 逐段返回）。"""
     role = payload.role.lower().strip()
     if role not in {"teacher", "student"}:
         raise HTTPException(status_code=403, detail="仅教师或学生可发送消息")
@@ -3540,6 +5099,8 @@ async def send_conversation_message(
         created_at=datetime.utcnow(),
     )
     session.add(user_msg)
+    await session.flush()
+    _set_last_message(conv, user_msg)
     await session.commit()
     await session.refresh(user_msg)
 
@@ -3569,6 +5130,27 @@ async def send_conversation_message(
             user_id=str(payload.user_id),
         )
 
+    if payload.stream:
+        # 流式：先保存补建的 chat/session，再逐条转发 RAGFlow SSE，结束后落库
+        await session.commit()
+        events = _ragflow_chat_completion_stream(
+            chat_id=conv.ragflow_chat_id,
+            question=content,
+            session_id=conv.ragflow_session_id,
+            user_id=str(payload.user_id),
+            metadata_condition=payload.metadata_condition,
+        )
+        # 预取首条事件：连接/鉴权错误仍以普通 HTTP 错误返回
+        try:
+            first_event = await events.__anext__()
+        except StopAsyncIteration:
+            first_event = None
+        return StreamingResponse(
+            _relay_completion_stream(conv.id, user_msg.id, first_event, events),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
     ragflow_result = await _ragflow_chat_completion(
         chat_id=conv.ragflow_chat_id,
         question=content,
@@ -3583,29 +5165,8 @@ async def send_conversation_message(
     if ragflow_session_id:
         conv.ragflow_session_id = ragflow_session_id
 
-    # 尽量提取回答文本
-    answer = ""
-    if isinstance(data, dict):
-        for key in ("answer", "content", "result", "response", "text"):
-            if data.get(key):
-                answer = data.get(key)
-                break
-        if not answer and isinstance(data.get("choices"), list):
-            choice = data["choices"][0] if data["choices"] else None
-            if isinstance(choice, dict):
-                msg = choice.get("message") or choice.get("delta") or {}
-                if isinstance(msg, dict) and msg.get("content"):
-                    answer = msg.get("content")
-
-    reference = None
-    if isinstance(data, dict):
-        if data.get("reference") or data.get("references"):
-            reference = data.get("reference") or data.get("references")
-        elif data.get("chunks") or data.get("doc_aggs"):
-            reference = {
-                "chunks": data.get("chunks"),
-                "doc_aggs": data.get("doc_aggs"),
-            }
+    answer = _extract_completion_answer(data)
+    reference = _extract_completion_reference(data)
 
     assistant_msg = models.Message(
         conversation_id=conv.id,
@@ -3615,6 +5176,8 @@ async def send_conversation_message(
         created_at=datetime.utcnow(),
     )
     session.add(assistant_msg)
+    await session.flush()
+    _set_last_message(conv, assistant_msg)
     conv.updated_at = datetime.utcnow()
     await session.commit()
     await session.refresh(assistant_msg)
@@ -3740,6 +5303,7 @@ async def clear_conversation(
     await session.execute(
         delete(models.Message).where(models.Message.conversation_id == conv.id)
     )
+    _clear_last_message(conv)
 
     new_session_id = None
     if payload.reset_session:
@@ -3807,41 +5371,14 @@ async def list_search_logs(
     date_to: Optional[str] = None,
     page: int = 1,
     page_size: int = 20,
+    pagination: str = "page",
+    cursor: Optional[str] = None,
+    count: Optional[str] = None,
+    principal: Principal = Depends(get_principal),
     session: AsyncSession = Depends(get_session),
 ):
     """搜索日志列表（管理员可看全量，教师/学生仅看自己的）。"""
-    role = role.lower().strip()
-    if role not in {"student", "teacher", "admin"}:
-        raise HTTPException(status_code=400, detail="role 参数不合法")
-    if page < 1 or page_size < 1 or page_size > 100:
-        raise HTTPException(status_code=400, detail="分页参数不合法")
-
-    # 权限校验
-    if role == "admin":
-        admin = (
-            await session.execute(
-                select(models.Admin).where(models.Admin.id == user_id)
-            )
-        ).scalar_one_or_none()
-        if not admin or admin.status != 1:
-            raise HTTPException(status_code=403, detail="管理员不存在或已停用")
-    elif role == "teacher":
-        teacher = (
-            await session.execute(
-                select(models.Teacher).where(models.Teacher.id == user_id)
-            )
-        ).scalar_one_or_none()
-        if not teacher or teacher.status != 1:
-            raise HTTPException(status_code=403, detail="教师不存在或已停用")
-    else:
-        student = (
-            await session.execute(
-                select(models.Student).where(models.Student.id == user_id)
-            )
-        ).scalar_one_or_none()
-        if not student or student.status != 1:
-            raise HTTPException(status_code=403, detail="学生不存在或已停用")
-
+    role = principal.role
     class_id = await _resolve_class_id(session, class_id, class_code)
     dt_from = _parse_date(date_from, "date_from")
     dt_to = _parse_date(date_to, "date_to")
@@ -3862,7 +5399,7 @@ async def list_search_logs(
     if role == "student":
         filters.append(models.SearchLog.user_student_id == user_id)
     if query:
-        filters.append(models.SearchLog.query.like(f"%{query.strip()}%"))
+        filters.append(_text_contains(models.SearchLog.query, query.strip()))
     if dt_from:
         filters.append(models.SearchLog.created_at >= dt_from)
     if dt_to:
@@ -3875,17 +5412,17 @@ async def list_search_logs(
     if filters:
         base_stmt = base_stmt.where(*filters)
 
-    total_stmt = select(func.count()).select_from(base_stmt.subquery())
-    total = (await session.execute(total_stmt)).scalar_one()
-
-    rows = (
-        await session.execute(
-            base_stmt
-            .order_by(models.SearchLog.created_at.desc())
-            .offset((page - 1) * page_size)
-            .limit(page_size)
-        )
-    ).all()
+    rows, page_info = await _paginate(
+        session,
+        base_stmt,
+        models.SearchLog.created_at,
+        models.SearchLog.id,
+        page,
+        page_size,
+        pagination,
+        cursor,
+        count,
+    )
 
     items = []
     for log, kb_row, cls in rows:
@@ -3907,9 +5444,7 @@ async def list_search_logs(
         )
 
     return {
-        "page": page,
-        "page_size": page_size,
-        "total": total,
+        **page_info,
         "items": items,
     }
 
@@ -3925,40 +5460,22 @@ async def search_stats(
     date_to: Optional[str] = None,
     days: int = 30,
     top_n: int = 10,
+    mode: str = "exact",
+    principal: Principal = Depends(get_principal),
     session: AsyncSession = Depends(get_session),
 ):
-    """搜索统计（管理员可看全量，教师/学生仅看自己的）。"""
-    role = role.lower().strip()
-    if role not in {"student", "teacher", "admin"}:
-        raise HTTPException(status_code=400, detail="role 参数不合法")
+    """搜索统计（管理员可看全量，教师/学生仅看自己的）。
+
+    mode=approx（仅管理员）：独立用户数与热门搜索词改由按天概率摘要合并估算，
+    适合跨全部班级/长时间范围的看板；教师/学生的个人统计始终精确计算。
+    """
+    role = principal.role
     if top_n < 1 or top_n > 50:
         raise HTTPException(status_code=400, detail="top_n 参数不合法")
-
-    # 权限校验
-    if role == "admin":
-        admin = (
-            await session.execute(
-                select(models.Admin).where(models.Admin.id == user_id)
-            )
-        ).scalar_one_or_none()
-        if not admin or admin.status != 1:
-            raise HTTPException(status_code=403, detail="管理员不存在或已停用")
-    elif role == "teacher":
-        teacher = (
-            await session.execute(
-                select(models.Teacher).where(models.Teacher.id == user_id)
-            )
-        ).scalar_one_or_none()
-        if not teacher or teacher.status != 1:
-            raise HTTPException(status_code=403, detail="教师不存在或已停用")
-    else:
-        student = (
-            await session.execute(
-                select(models.Student).where(models.Student.id == user_id)
-            )
-        ).scalar_one_or_none()
-        if not student or student.status != 1:
-            raise HTTPException(status_code=403, detail="学生不存在或已停用")
+    if mode not in {"exact", "approx"}:
+        raise HTTPException(status_code=400, detail="mode 参数不合法")
+    if role != "admin":
+        mode = "exact"
 
     class_id = await _resolve_class_id(session, class_id, class_code)
     dt_from = _parse_date(date_from, "date_from")
@@ -3967,76 +5484,135 @@ async def search_stats(
     if not dt_from and not dt_to and days:
         dt_from = datetime.utcnow() - timedelta(days=days)
 
-    filters = []
+    # 总数/独立用户/按天趋势读取按天汇总表（粒度为 UTC 日期）
+    rollup = models.SearchStatsDailyUser
+    rollup_filters = []
     if kb_id is not None:
-        filters.append(models.SearchLog.kb_id == kb_id)
+        rollup_filters.append(rollup.kb_id == kb_id)
     if class_id is not None:
-        filters.append(models.SearchLog.kb_id.in_(
+        rollup_filters.append(rollup.kb_id.in_(
             select(models.KnowledgeBase.id).where(models.KnowledgeBase.class_id == class_id)
         ))
-    if role == "teacher":
-        filters.append(models.SearchLog.user_teacher_id == user_id)
-    if role == "student":
-        filters.append(models.SearchLog.user_student_id == user_id)
+    if role in {"teacher", "student"}:
+        rollup_filters.append(rollup.user_role == role)
+        rollup_filters.append(rollup.user_id == user_id)
     if dt_from:
-        filters.append(models.SearchLog.created_at >= dt_from)
+        rollup_filters.append(rollup.day >= dt_from.date())
     if dt_to:
-        if "T" not in date_to and len(date_to) <= 10:
-            filters.append(models.SearchLog.created_at < dt_to + timedelta(days=1))
-        else:
-            filters.append(models.SearchLog.created_at <= dt_to)
+        rollup_filters.append(rollup.day <= dt_to.date())
 
     # 总搜索次数
-    total_stmt = select(func.count()).select_from(models.SearchLog)
-    if filters:
-        total_stmt = total_stmt.where(*filters)
-    total = (await session.execute(total_stmt)).scalar_one()
+    total = (
+        await session.execute(
+            select(func.coalesce(func.sum(rollup.search_count), 0)).where(*rollup_filters)
+        )
+    ).scalar_one()
 
-    # 独立教师/学生数
-    teacher_count_stmt = select(func.count(func.distinct(models.SearchLog.user_teacher_id))).where(
-        models.SearchLog.user_teacher_id.isnot(None)
-    )
-    student_count_stmt = select(func.count(func.distinct(models.SearchLog.user_student_id))).where(
-        models.SearchLog.user_student_id.isnot(None)
-    )
-    if filters:
-        teacher_count_stmt = teacher_count_stmt.where(*filters)
-        student_count_stmt = student_count_stmt.where(*filters)
-    unique_teacher_count = (await session.execute(teacher_count_stmt)).scalar_one()
-    unique_student_count = (await session.execute(student_count_stmt)).scalar_one()
-
-    # Top 查询关键词
-    top_stmt = (
-        select(models.SearchLog.query, func.count().label("cnt"))
-        .group_by(models.SearchLog.query)
-        .order_by(func.count().desc())
-        .limit(top_n)
-    )
-    if filters:
-        top_stmt = top_stmt.where(*filters)
-    top_rows = (await session.execute(top_stmt)).all()
-    top_queries = [{"query": q, "count": c} for q, c in top_rows]
+    if mode == "approx":
+        kb_ids = None
+        if kb_id is not None:
+            kb_ids = [kb_id]
+        elif class_id is not None:
+            kb_ids = select(models.KnowledgeBase.id).where(models.KnowledgeBase.class_id == class_id)
+        approx = await approximate_stats(
+            session,
+            kb_ids,
+            dt_from.date() if dt_from else None,
+            dt_to.date() if dt_to else None,
+            top_n,
+        )
+        unique_teacher_count = approx["unique_teacher_count"]
+        unique_student_count = approx["unique_student_count"]
+        top_queries = approx["top_queries"]
+    else:
+        # 独立教师/学生数
+        unique_teacher_count = (
+            await session.execute(
+                select(func.count(func.distinct(rollup.user_id))).where(
+                    *rollup_filters, rollup.user_role == "teacher"
+                )
+            )
+        ).scalar_one()
+        unique_student_count = (
+            await session.execute(
+                select(func.count(func.distinct(rollup.user_id))).where(
+                    *rollup_filters, rollup.user_role == "student"
+                )
+            )
+        ).scalar_one()
+
+        # Top 查询关键词
+        if role == "admin":
+            query_rollup = models.SearchStatsDailyQuery
+            query_filters = []
+            if kb_id is not None:
+                query_filters.append(query_rollup.kb_id == kb_id)
+            if class_id is not None:
+                query_filters.append(query_rollup.kb_id.in_(
+                    select(models.KnowledgeBase.id).where(models.KnowledgeBase.class_id == class_id)
+                ))
+            if dt_from:
+                query_filters.append(query_rollup.day >= dt_from.date())
+            if dt_to:
+                query_filters.append(query_rollup.day <= dt_to.date())
+            cnt = func.sum(query_rollup.search_count)
+            top_stmt = (
+                select(func.max(query_rollup.query), cnt.label("cnt"))
+                .where(*query_filters)
+                .group_by(query_rollup.query_hash)
+                .order_by(cnt.desc())
+                .limit(top_n)
+            )
+        else:
+            # 教师/学生只看自己的日志，走 (user_id, created_at) 索引直接聚合
+            user_column = (
+                models.SearchLog.user_teacher_id if role == "teacher" else models.SearchLog.user_student_id
+            )
+            filters = [user_column == user_id]
+            if kb_id is not None:
+                filters.append(models.SearchLog.kb_id == kb_id)
+            if class_id is not None:
+                filters.append(models.SearchLog.kb_id.in_(
+                    select(models.KnowledgeBase.id).where(models.KnowledgeBase.class_id == class_id)
+                ))
+            # 与汇总表保持同样的按天粒度
+            if dt_from:
+                day_start = datetime.combine(dt_from.date(), datetime.min.time())
+                filters.append(models.SearchLog.created_at >= day_start)
+            if dt_to:
+                day_end = datetime.combine(dt_to.date(), datetime.min.time()) + timedelta(days=1)
+                filters.append(models.SearchLog.created_at < day_end)
+            top_stmt = (
+                select(models.SearchLog.query, func.count().label("cnt"))
+                .where(*filters)
+                .group_by(models.SearchLog.query)
+                .order_by(func.count().desc())
+                .limit(top_n)
+            )
+        top_rows = (await session.execute(top_stmt)).all()
+        top_queries = [{"query": q, "count": c} for q, c in top_rows]
 
     # 按天统计（UTC 日期）
-    daily_stmt = (
-        select(func.date(models.SearchLog.created_at), func.count().label("cnt"))
-        .group_by(func.date(models.SearchLog.created_at))
-        .order_by(func.date(models.SearchLog.created_at))
-    )
-    if filters:
-        daily_stmt = daily_stmt.where(*filters)
-    daily_rows = (await session.execute(daily_stmt)).all()
+    daily_rows = (
+        await session.execute(
+            select(rollup.day, func.sum(rollup.search_count))
+            .where(*rollup_filters)
+            .group_by(rollup.day)
+            .order_by(rollup.day)
+        )
+    ).all()
     daily = [
-        {"date": d.isoformat() if d else None, "count": c}
+        {"date": d.isoformat() if d else None, "count": int(c)}
         for d, c in daily_rows
     ]
 
     return {
-        "total_searches": total,
+        "total_searches": int(total),
         "unique_teacher_count": unique_teacher_count,
         "unique_student_count": unique_student_count,
         "top_queries": top_queries,
         "daily": daily,
+        "mode": mode,
     }
 
 
@@ -4070,24 +5646,27 @@ async def preview_case(
         class_code,
     )
 
-    doc = (
-        await session.execute(
-            select(models.Document).where(
-                models.Document.kb_id == kb.id,
-                models.Document.ragflow_document_id == ragflow_document_id,
-            )
-        )
-    ).scalar_one_or_none()
-    if not doc:
+    doc_info = (await doc_hydration.fetch(session, [ragflow_document_id])).get(ragflow_document_id)
+    if not doc_info or doc_info["kb_id"] != kb.id:
         raise HTTPException(status_code=404, detail="未找到对应文档")
 
-    chunk = await _ragflow_get_chunk(kb.ragflow_dataset_id, ragflow_document_id, chunk_id)
+    chunk, cache_hit = await _cached_get_chunk(kb.ragflow_dataset_id, ragflow_document_id, chunk_id)
+    return _format_case_preview(kb, doc_info, ragflow_document_id, chunk_id, chunk, cache_hit)
 
+
+def _format_case_preview(
+    kb: models.KnowledgeBase,
+    doc_info: Dict[str, Any],
+    ragflow_document_id: str,
+    chunk_id: str,
+    chunk: Dict[str, Any],
+    cache_hit: bool,
+) -> Dict[str, Any]:
     return {
         "kb_id": kb.id,
         "class_id": kb.class_id,
-        "document_id": doc.id,
-        "document_name": doc.original_name,
+        "document_id": doc_info["document_id"],
+        "document_name": doc_info["document_name"],
         "ragflow_document_id": ragflow_document_id,
         "chunk_id": chunk_id,
         "content": chunk.get("content"),
@@ -4095,4 +5674,65 @@ async def preview_case(
         "location": chunk.get("location") or chunk.get("from_page"),
         "positions": chunk.get("positions"),
         "raw_chunk": chunk,
+        "cache": "hit" if cache_hit else "miss",
     }
+
+
+@app.post("/cases/preview/batch")
+async def preview_cases_batch(
+    payload: CasePreviewBatchRequest,
+    session: AsyncSession = Depends(get_session),
+):
+    """批量获取案例内容（前端预取当前页全部检索结果），单条失败不影响其他条目。"""
+    role = payload.role.lower().strip()
+    if role not in {"student", "teacher", "admin"}:
+        raise HTTPException(status_code=400, detail="role 参数不合法")
+    if not payload.items:
+        raise HTTPException(status_code=400, detail="items 不能为空")
+    if len(payload.items) > settings.chunk_preview_batch_max_items:
+        raise HTTPException(
+            status_code=400,
+            detail=f"单次最多预览 {settings.chunk_preview_batch_max_items} 条",
+        )
+
+    kb = await _resolve_kb_for_search(
+        session,
+        role,
+        payload.user_id,
+        payload.kb_id,
+        payload.class_id,
+        payload.class_code,
+    )
+    if not kb.ragflow_dataset_id:
+        raise HTTPException(status_code=400, detail="知识库未绑定 RAGFlow dataset")
+
+    doc_map = await doc_hydration.fetch(
+        session, {item.ragflow_document_id for item in payload.items}
+    )
+    semaphore = asyncio.Semaphore(max(1, settings.chunk_preview_batch_concurrency))
+
+    async def _one(item: CasePreviewItem) -> Dict[str, Any]:
+        doc_info = doc_map.get(item.ragflow_document_id)
+        if not doc_info or doc_info["kb_id"] != kb.id:
+            return {
+                "ragflow_document_id": item.ragflow_document_id,
+                "chunk_id": item.chunk_id,
+                "error": "未找到对应文档",
+            }
+        async with semaphore:
+            try:
+                chunk, cache_hit = await _cached_get_chunk(
+                    kb.ragflow_dataset_id, item.ragflow_document_id, item.chunk_id
+                )
+            except (HTTPException, httpx.HTTPError) as exc:
+                return {
+                    "ragflow_document_id": item.ragflow_document_id,
+                    "chunk_id": item.chunk_id,
+                    "error": exc.detail if isinstance(exc, HTTPException) else str(exc),
+                }
+        return _format_case_preview(
+            kb, doc_info, item.ragflow_document_id, item.chunk_id, chunk, cache_hit
+        )
+
+    items = await asyncio.gather(*(_one(item) for item in payload.items))
+    return {"kb_id": kb.id, "count": len(items), "items": items}
@@ -6,7 +6,7 @@ from __future__ import annotations
 """
 
 import enum
-from datetime import datetime
+from datetime import date, datetime
 from typing import Optional, List
 
 from sqlalchemy import (
@@ -15,9 +15,11 @@ from sqlalchemy import (
     String,
     Text,
     Boolean,
+    Date,
     DateTime,
     Numeric,
     JSON,
+    LargeBinary,
     ForeignKey,
     UniqueConstraint,
     Index,
@@ -166,6 +168,16 @@ class Document(Base):
     __table_args__ = (
         Index("ix_documents_kb_id_filename", "kb_id", "filename"),
         Index("ix_documents_kb_id_content_hash", "kb_id", "content_hash"),
+        # 待审核队列的游标分页（status + uploaded_at, id 有序扫描）
+        Index("ix_documents_status_uploaded_at_id", "status", "uploaded_at", "id"),
+        Index("ix_documents_kb_id_uploaded_at_id", "kb_id", "uploaded_at", "id"),
+        # 文件名关键字搜索（MySQL ngram 全文索引，支持中文）
+        Index(
+            "ft_documents_original_name",
+            "original_name",
+            mysql_prefix="FULLTEXT",
+            mysql_with_parser="ngram",
+        ),
         UniqueConstraint("kb_id", "original_name", name="uq_documents_kb_original_name"),
     )
 
@@ -210,7 +222,10 @@ class Document(Base):
 
 class DocumentAudit(Base):
     __tablename__ = "document_audits"
-    __table_args__ = (Index("ix_document_audits_document_id", "document_id"),)
+    __table_args__ = (
+        Index("ix_document_audits_document_id", "document_id"),
+        Index("ix_document_audits_decided_at_id", "decided_at", "id"),
+    )
 
     id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
     document_id: Mapped[int] = mapped_column(
@@ -250,6 +265,7 @@ class EmbeddingTask(Base):
     __table_args__ = (
         Index("ix_embeddings_tasks_document_id", "document_id"),
         Index("ix_embeddings_tasks_status", "status"),
+        Index("ix_embeddings_tasks_status_next_run_at", "status", "next_run_at"),
     )
 
     id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
@@ -267,6 +283,8 @@ class EmbeddingTask(Base):
     started_at: Mapped[Optional[datetime]] = mapped_column(DateTime)
     finished_at: Mapped[Optional[datetime]] = mapped_column(DateTime)
     message: Mapped[Optional[str]] = mapped_column(Text)
+    attempts: Mapped[int] = mapped_column(Integer, default=0)  # 已执行次数（含重试）
+    next_run_at: Mapped[Optional[datetime]] = mapped_column(DateTime)  # 重试退避：早于该时间不领取
 
     document: Mapped[Document] = relationship(back_populates="embedding_tasks")
     triggered_by_teacher: Mapped[Teacher] = relationship()
@@ -279,6 +297,8 @@ class Conversation(Base):
         Index("ix_conversations_owner_teacher_id", "owner_teacher_id"),
         Index("ix_conversations_owner_student_id", "owner_student_id"),
         Index("ix_conversations_kb_id", "kb_id"),
+        Index("ix_conversations_owner_teacher_id_updated_at", "owner_teacher_id", "updated_at", "id"),
+        Index("ix_conversations_owner_student_id_updated_at", "owner_student_id", "updated_at", "id"),
     )
 
     id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
@@ -299,6 +319,11 @@ class Conversation(Base):
     similarity_threshold: Mapped[float] = mapped_column(Numeric(4, 3), default=0.2)
     show_citations: Mapped[bool] = mapped_column(Boolean, default=True)
     system_prompt: Mapped[Optional[str]] = mapped_column(Text)
+    # 最后一条消息（冗余字段，写消息时维护，供对话列表预览）
+    last_message_id: Mapped[Optional[int]] = mapped_column(BigInteger)
+    last_message_role: Mapped[Optional[SenderRole]] = mapped_column(SAEnum(SenderRole))
+    last_message_preview: Mapped[Optional[str]] = mapped_column(String(255))
+    last_message_at: Mapped[Optional[datetime]] = mapped_column()
     created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
     updated_at: Mapped[datetime] = mapped_column(
         default=datetime.utcnow, onupdate=datetime.utcnow
@@ -312,7 +337,10 @@ class Conversation(Base):
 
 class Message(Base):
     __tablename__ = "messages"
-    __table_args__ = (Index("ix_messages_conversation_id", "conversation_id"),)
+    __table_args__ = (
+        Index("ix_messages_conversation_id", "conversation_id"),
+        Index("ix_messages_conversation_id_created_at_id", "conversation_id", "created_at", "id"),
+    )
 
     id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
     conversation_id: Mapped[int] = mapped_column(
@@ -335,6 +363,11 @@ class SearchLog(Base):
         Index("ix_search_logs_user_teacher_id", "user_teacher_id"),
         Index("ix_search_logs_user_student_id", "user_student_id"),
         Index("ix_search_logs_kb_id_created_at", "kb_id", "created_at"),
+        Index("ix_search_logs_created_at_id", "created_at", "id"),
+        Index("ix_search_logs_user_teacher_id_created_at", "user_teacher_id", "created_at", "id"),
+        Index("ix_search_logs_user_student_id_created_at", "user_student_id", "created_at", "id"),
+        # 搜索词关键字过滤（MySQL ngram 全文索引）
+        Index("ft_search_logs_query", "query", mysql_prefix="FULLTEXT", mysql_with_parser="ngram"),
     )
 
     id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
@@ -356,6 +389,61 @@ class SearchLog(Base):
     kb: Mapped[KnowledgeBase] = relationship()
 
 
+# --- 搜索统计汇总（按天预聚合，供 /search/stats 读取）---
+class SearchStatsDailyUser(Base):
+    __tablename__ = "search_stats_daily_users"
+    __table_args__ = (
+        Index("ix_search_stats_daily_users_kb_id_day", "kb_id", "day"),
+        Index("ix_search_stats_daily_users_user_day", "user_role", "user_id", "day"),
+    )
+
+    # 每天 × 知识库 × 用户的搜索次数；无用户的日志记为 user_role="other", user_id=0
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    kb_id: Mapped[int] = mapped_column(
+        BigInteger, ForeignKey("knowledge_bases.id"), primary_key=True
+    )
+    user_role: Mapped[str] = mapped_column(String(16), primary_key=True)
+    user_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    search_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+
+class SearchStatsDailyQuery(Base):
+    __tablename__ = "search_stats_daily_queries"
+    __table_args__ = (Index("ix_search_stats_daily_queries_kb_id_day", "kb_id", "day"),)
+
+    # 每天 × 知识库 × 搜索词的次数（query_hash 为 query 的 SHA256，避免长文本做主键）
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    kb_id: Mapped[int] = mapped_column(
+        BigInteger, ForeignKey("knowledge_bases.id"), primary_key=True
+    )
+    query_hash: Mapped[str] = mapped_column(String(64), primary_key=True)
+    query: Mapped[str] = mapped_column(String(512), nullable=False)
+    search_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+
+class SearchStatsDailySketch(Base):
+    __tablename__ = "search_stats_daily_sketches"
+
+    # 每天 × 知识库的概率摘要，可跨任意日期区间合并（见 app/sketches.py）
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    kb_id: Mapped[int] = mapped_column(
+        BigInteger, ForeignKey("knowledge_bases.id"), primary_key=True
+    )
+    teacher_hll: Mapped[Optional[bytes]] = mapped_column(LargeBinary)  # 独立教师 HyperLogLog 寄存器
+    student_hll: Mapped[Optional[bytes]] = mapped_column(LargeBinary)  # 独立学生 HyperLogLog 寄存器
+    top_queries: Mapped[Optional[list]] = mapped_column(JSON)  # Space-Saving 计数器 [[query, count, error], ...]
+
+
+class SearchStatsDailySketchTotal(Base):
+    __tablename__ = "search_stats_daily_sketch_totals"
+
+    # 每天全部知识库合并后的概率摘要，全站统计时每天只需合并一行
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    teacher_hll: Mapped[Optional[bytes]] = mapped_column(LargeBinary)
+    student_hll: Mapped[Optional[bytes]] = mapped_column(LargeBinary)
+    top_queries: Mapped[Optional[list]] = mapped_column(JSON)
+
+
 # --- RAGFlow 用户配置 ---
 class RagflowSetting(Base):
     __tablename__ = "ragflow_settings"
@@ -0,0 +1,132 @@
+"""调用者身份解析与短期缓存。
+
+几乎每个接口都要按 (role, user_id) 查一次账号，确认 status 与班级归属。
+这里把结果缓存在进程内（TTL 较短），管理员修改/删除账号或调整班级时主动失效。
+"""
+
+import time
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import models
+from app.config import get_settings
+
+settings = get_settings()
+
+
+@dataclass(frozen=True)
+class Principal:
+    """已解析的调用者：学生带所属班级，教师带所授班级集合。"""
+
+    role: str
+    user_id: int
+    status: int
+    class_id: Optional[int] = None
+    class_ids: FrozenSet[int] = frozenset()
+
+    @property
+    def active(self) -> bool:
+        return self.status == 1
+
+
+class PrincipalCache:
+    """(role, user_id) -> Principal 的 TTL 缓存。"""
+
+    def __init__(self, ttl: float, max_entries: int) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: Dict[Tuple[str, int], Tuple[float, Principal]] = {}
+
+    def get(self, role: str, user_id: int) -> Optional[Principal]:
+        entry = self._entries.get((role, user_id))
+        if entry is None:
+            return None
+        expires_at, principal = entry
+        if expires_at < time.monotonic():
+            self._entries.pop((role, user_id), None)
+            return None
+        return principal
+
+    def put(self, principal: Principal) -> None:
+        if self.ttl <= 0:
+            return
+        if len(self._entries) >= self.max_entries:
+            # 简单淘汰：先清理过期项，仍然超限则整体清空
+            now = time.monotonic()
+            self._entries = {k: v for k, v in self._entries.items() if v[0] >= now}
+            if len(self._entries) >= self.max_entries:
+                self._entries.clear()
+        self._entries[(principal.role, principal.user_id)] = (
+            time.monotonic() + self.ttl,
+            principal,
+        )
+
+    def invalidate(self, role: str, user_id: Optional[int]) -> None:
+        if user_id is not None:
+            self._entries.pop((role, user_id), None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+principal_cache = PrincipalCache(settings.principal_cache_ttl, settings.principal_cache_max_entries)
+
+
+async def _load_principal(session: AsyncSession, role: str, user_id: int) -> Optional[Principal]:
+    if role == "student":
+        row = (
+            await session.execute(
+                select(models.Student.status, models.Student.class_id).where(
+                    models.Student.id == user_id
+                )
+            )
+        ).first()
+        if not row:
+            return None
+        return Principal(role, user_id, row.status, class_id=row.class_id)
+
+    if role == "teacher":
+        status = (
+            await session.execute(
+                select(models.Teacher.status).where(models.Teacher.id == user_id)
+            )
+        ).scalar_one_or_none()
+        if status is None:
+            return None
+        class_ids = (
+            await session.execute(
+                select(models.Class.id).where(models.Class.teacher_id == user_id)
+            )
+        ).scalars().all()
+        return Principal(role, user_id, status, class_ids=frozenset(class_ids))
+
+    if role == "admin":
+        status = (
+            await session.execute(
+                select(models.Admin.status).where(models.Admin.id == user_id)
+            )
+        ).scalar_one_or_none()
+        if status is None:
+            return None
+        return Principal(role, user_id, status)
+
+    return None
+
+
+async def resolve_principal(session: AsyncSession, role: str, user_id: int) -> Optional[Principal]:
+    """按 (role, user_id) 解析调用者，命中缓存时不访问数据库；不存在返回 None。"""
+    principal = principal_cache.get(role, user_id)
+    if principal is not None:
+        return principal
+    principal = await _load_principal(session, role, user_id)
+    if principal is not None:
+        principal_cache.put(principal)
+    return principal
+
+
+def invalidate_principal(role: str, user_id: Optional[int]) -> None:
+    """账号状态/班级归属变化后调用，使缓存立即失效。"""
+    principal_cache.invalidate(role, user_id)
@@ -0,0 +1,163 @@
+"""RAGFlow HTTP 客户端（应用级连接池）。
+
+整个进程共用一个 httpx.AsyncClient：启动时创建、关闭时释放，
+复用 keep-alive 连接（可用时启用 HTTP/2），按接口类型设置超时，
+并记录连接池占用情况供 /metrics/ragflow 查看。
+"""
+
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional
+
+import httpx
+
+from app.config import get_settings
+
+settings = get_settings()
+
+try:  # HTTP/2 依赖 h2 包（httpx[http2]），未安装时回退到 HTTP/1.1
+    import h2  # noqa: F401
+
+    _HTTP2_AVAILABLE = True
+except ImportError:
+    _HTTP2_AVAILABLE = False
+
+
+def _endpoint_timeouts() -> Dict[str, float]:
+    """各类接口的读超时（秒），未列出的接口使用 default。"""
+    return {
+        "default": settings.ragflow_timeout_default,
+        "upload": settings.ragflow_timeout_upload,
+        "parse": settings.ragflow_timeout_parse,
+        "completion": settings.ragflow_timeout_completion,
+        "retrieval": settings.ragflow_timeout_retrieval,
+    }
+
+
+class RagflowClient:
+    """对 httpx.AsyncClient 的薄封装：统一 base_url/鉴权头/超时与指标。"""
+
+    def __init__(self) -> None:
+        self._client: Optional[httpx.AsyncClient] = None
+        self._timeouts = _endpoint_timeouts()
+        self.max_connections = settings.ragflow_max_connections
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.total_requests = 0
+        self.total_errors = 0
+        self.total_seconds = 0.0
+
+    async def start(self) -> None:
+        """创建连接池（重复调用无副作用）。"""
+        if self._client is not None:
+            return
+        headers = {"Authorization": f"Bearer {settings.ragflow_api_key}"}
+        if settings.ragflow_host_header:
+            headers["Host"] = settings.ragflow_host_header
+        self._client = httpx.AsyncClient(
+            base_url=str(settings.ragflow_base_url).rstrip("/"),
+            headers=headers,
+            http2=settings.ragflow_http2 and _HTTP2_AVAILABLE,
+            limits=httpx.Limits(
+                max_connections=settings.ragflow_max_connections,
+                max_keepalive_connections=settings.ragflow_max_keepalive_connections,
+                keepalive_expiry=settings.ragflow_keepalive_expiry,
+            ),
+            timeout=self._timeout("default"),
+        )
+
+    async def close(self) -> None:
+        """关闭连接池。"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _timeout(self, endpoint: str) -> httpx.Timeout:
+        read = self._timeouts.get(endpoint, self._timeouts["default"])
+        return httpx.Timeout(
+            read,
+            connect=settings.ragflow_connect_timeout,
+            pool=settings.ragflow_pool_timeout,
+        )
+
+    async def _ensure_client(self) -> httpx.AsyncClient:
+        # 兜底：未经过 startup（如脚本直接调用）时按需创建
+        if self._client is None:
+            await self.start()
+        return self._client
+
+    def _enter(self) -> float:
+        self.in_flight += 1
+        self.total_requests += 1
+        if self.in_flight > self.peak_in_flight:
+            self.peak_in_flight = self.in_flight
+        return time.monotonic()
+
+    def _leave(self, started: float, failed: bool) -> None:
+        self.in_flight -= 1
+        self.total_seconds += time.monotonic() - started
+        if failed:
+            self.total_errors += 1
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        endpoint: str = "default",
+        **kwargs: Any,
+    ) -> httpx.Response:
+        """发送请求，path 为相对 base_url 的路径（如 /api/v1/datasets）。"""
+        client = await self._ensure_client()
+        started = self._enter()
+        failed = True
+        try:
+            resp = await client.request(method, path, timeout=self._timeout(endpoint), **kwargs)
+            failed = resp.status_code >= 500
+            return resp
+        finally:
+            self._leave(started, failed)
+
+    @asynccontextmanager
+    async def stream(
+        self,
+        method: str,
+        path: str,
+        endpoint: str = "default",
+        **kwargs: Any,
+    ) -> AsyncIterator[httpx.Response]:
+        """流式请求（SSE 等），连接在上下文退出时归还连接池。"""
+        client = await self._ensure_client()
+        started = self._enter()
+        failed = True
+        try:
+            async with client.stream(
+                method, path, timeout=self._timeout(endpoint), **kwargs
+            ) as resp:
+                failed = resp.status_code >= 500
+                yield resp
+        finally:
+            self._leave(started, failed)
+
+    def metrics(self) -> Dict[str, Any]:
+        """连接池指标：saturation = 在途请求 / 最大连接数。"""
+        waiting = max(0, self.in_flight - self.max_connections)
+        return {
+            "http2": bool(self._client is not None and settings.ragflow_http2 and _HTTP2_AVAILABLE),
+            "max_connections": self.max_connections,
+            "max_keepalive_connections": settings.ragflow_max_keepalive_connections,
+            "in_flight": self.in_flight,
+            "waiting": waiting,
+            "peak_in_flight": self.peak_in_flight,
+            "saturation": round(self.in_flight / self.max_connections, 4) if self.max_connections else None,
+            "total_requests": self.total_requests,
+            "total_errors": self.total_errors,
+            "avg_latency_ms": (
+                round(self.total_seconds * 1000 / self.total_requests, 2)
+                if self.total_requests
+                else None
+            ),
+            "timeouts": dict(self._timeouts),
+        }
+
+
+ragflow_client = RagflowClient()
@@ -0,0 +1,134 @@
+"""RAGFlow 检索结果缓存。
+
+同一班级的学生常在几分钟内搜索相同的问题，这里按
+(dataset_id, 规范化后的 query, top_k, similarity_threshold, highlight)
+缓存 /api/v1/retrieval 返回的原始 chunks：LRU + TTL 淘汰，并限制总内存占用。
+知识库内文档嵌入/重命名/删除时按 dataset 整体失效。
+"""
+
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from app.config import get_settings
+
+settings = get_settings()
+
+CacheKey = Tuple[str, str, int, Optional[float], bool]
+
+
+def normalize_query(query: str) -> str:
+    """规范化检索词：去首尾空白、合并连续空白、统一大小写。"""
+    return " ".join((query or "").split()).casefold()
+
+
+def make_key(
+    dataset_id: str,
+    query: str,
+    top_k: int,
+    similarity_threshold: Optional[float],
+    highlight: bool,
+) -> CacheKey:
+    return (dataset_id, normalize_query(query), top_k, similarity_threshold, bool(highlight))
+
+
+class RetrievalCache:
+    """进程内 LRU + TTL 缓存，按条目估算字节数控制内存上限。"""
+
+    def __init__(self, ttl: float, max_entries: int, max_bytes: int) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # key -> (过期时间, 估算字节数, chunks)
+        self._entries: "OrderedDict[CacheKey, Tuple[float, int, List[Dict[str, Any]]]]" = OrderedDict()
+        self._by_dataset: Dict[str, Set[CacheKey]] = {}
+        # dataset 失效代数：检索开始后若发生失效，结果不再写入缓存
+        self._generations: Dict[str, int] = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0 and self.max_bytes > 0
+
+    def generation(self, dataset_id: str) -> int:
+        return self._generations.get(dataset_id, 0)
+
+    def get(self, key: CacheKey) -> Optional[List[Dict[str, Any]]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, _, chunks = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return chunks
+
+    def put(self, key: CacheKey, chunks: List[Dict[str, Any]], generation: int) -> None:
+        if not self.enabled or generation != self.generation(key[0]):
+            return
+        size = len(json.dumps(chunks, ensure_ascii=False, default=str).encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, size, chunks)
+        self._by_dataset.setdefault(key[0], set()).add(key)
+        self.total_bytes += size
+        while len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def invalidate_dataset(self, dataset_id: Optional[str]) -> None:
+        """知识库内容变化：清除该 dataset 的全部缓存。"""
+        if not dataset_id:
+            return
+        self._generations[dataset_id] = self.generation(dataset_id) + 1
+        for key in list(self._by_dataset.get(dataset_id, ())):
+            self._remove(key)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._by_dataset.clear()
+        self.total_bytes = 0
+
+    def _remove(self, key: CacheKey) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.total_bytes -= entry[1]
+        keys = self._by_dataset.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                self._by_dataset.pop(key[0], None)
+
+    def metrics(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+        }
+
+
+retrieval_cache = RetrievalCache(
+    settings.retrieval_cache_ttl,
+    settings.retrieval_cache_max_entries,
+    settings.retrieval_cache_max_bytes,
+)
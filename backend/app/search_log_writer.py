@@ -0,0 +1,176 @@
+"""搜索日志异步批量写入。
+
+检索接口只把日志放进进程内缓冲区，由后台协程按条数/时间阈值
+合并成一条多行 INSERT 写入 search_logs（并累加按天汇总表），避免每次搜索都同步 INSERT+COMMIT。
+缓冲区满时丢弃新日志并计数，保证日志量不会拖慢检索；进程关闭时写完剩余日志。
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import insert
+
+from app import models
+from app.config import get_settings
+from app.db import AsyncSessionLocal
+from app.search_stats import apply_rollups
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+# 与 SearchLog.query 列长度一致，超长检索词截断，避免整批 INSERT 被拒绝
+_QUERY_MAX_LENGTH = 512
+
+
+class SearchLogWriter:
+    """缓冲 SearchLog 行并批量写入。"""
+
+    def __init__(self, batch_size: int, flush_interval: float, max_pending: int) -> None:
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._buffer: List[Dict[str, Any]] = []
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self._flush_lock = asyncio.Lock()
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.flushes = 0
+        self._last_drop_warning = 0.0
+
+    @staticmethod
+    def make_row(
+        kb_id: int,
+        query: str,
+        result_count: int,
+        user_teacher_id: Optional[int] = None,
+        user_student_id: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        return {
+            "user_teacher_id": user_teacher_id,
+            "user_student_id": user_student_id,
+            "kb_id": kb_id,
+            "query": (query or "")[:_QUERY_MAX_LENGTH],
+            "result_count": result_count,
+            "created_at": datetime.utcnow(),
+        }
+
+    def add(
+        self,
+        kb_id: int,
+        query: str,
+        result_count: int,
+        user_teacher_id: Optional[int] = None,
+        user_student_id: Optional[int] = None,
+    ) -> None:
+        """登记一条搜索日志（不等待写库）。"""
+        if len(self._buffer) >= self.max_pending:
+            self.dropped += 1
+            now = time.monotonic()
+            if now - self._last_drop_warning > 60:
+                self._last_drop_warning = now
+                logger.warning("搜索日志缓冲区已满，丢弃新日志（累计 %s 条）", self.dropped)
+            return
+        self._buffer.append(
+            self.make_row(kb_id, query, result_count, user_teacher_id, user_student_id)
+        )
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    async def write(self, rows: List[Dict[str, Any]]) -> None:
+        """直接写入一批日志（批量检索等场景，一条多行 INSERT，不经过缓冲区）。"""
+        if rows:
+            await self._write(rows)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """停止后台协程并写完缓冲区剩余日志。
+
+        不取消协程：正在写入的批次已从缓冲区取出，取消会丢失该批；
+        改为置停止标记并唤醒，等当前写入完成后协程自行退出。
+        """
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        while self._buffer:
+            await self.flush()
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            while self._buffer:
+                await self.flush()
+                if len(self._buffer) < self.batch_size:
+                    break
+
+    async def flush(self) -> None:
+        """取出一批日志，用一条多行 INSERT 写入；整批失败时逐行重试。"""
+        async with self._flush_lock:
+            if not self._buffer:
+                return
+            rows = self._buffer[: self.batch_size]
+            del self._buffer[: self.batch_size]
+            await self._write(rows)
+
+    async def _insert(self, rows: List[Dict[str, Any]]) -> None:
+        async with AsyncSessionLocal() as session:
+            await session.execute(insert(models.SearchLog).values(rows))
+            # 同一事务内累加按天汇总，保证汇总与原始日志一致
+            await apply_rollups(session, rows)
+            await session.commit()
+
+    async def _write(self, rows: List[Dict[str, Any]]) -> None:
+        """整批写入；失败时逐行重试，只丢弃写不进去的行。"""
+        try:
+            await self._insert(rows)
+            self.written += len(rows)
+            self.flushes += 1
+            return
+        except Exception:
+            if len(rows) == 1:
+                self.failed += 1
+                logger.exception("搜索日志写入失败，丢弃 1 条")
+                return
+            logger.warning("搜索日志批量写入失败，改为逐行写入 %s 条", len(rows), exc_info=True)
+        for row in rows:
+            try:
+                await self._insert([row])
+                self.written += 1
+            except Exception:
+                self.failed += 1
+                logger.exception("搜索日志写入失败，丢弃 1 条")
+        self.flushes += 1
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "pending": len(self._buffer),
+            "max_pending": self.max_pending,
+            "batch_size": self.batch_size,
+            "flush_interval": self.flush_interval,
+            "written": self.written,
+            "flushes": self.flushes,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+
+search_log_writer = SearchLogWriter(
+    settings.search_log_batch_size,
+    settings.search_log_flush_interval,
+    settings.search_log_max_pending,
+)
@@ -0,0 +1,397 @@
+"""搜索统计按天汇总（rollup）。
+
+/search/stats 原先每次都对 search_logs 原始日志做多次聚合，日志越多越慢。
+这里维护两张按天预聚合的表：
+- search_stats_daily_users：每天 × 知识库 × 用户的搜索次数（总数、独立用户数、按天趋势）
+- search_stats_daily_queries：每天 × 知识库 × 搜索词的次数（热门搜索词）
+以及 search_stats_daily_sketches：每天 × 知识库的 HyperLogLog / Space-Saving 摘要，
+供 mode=approx 跨大范围快速估算独立用户数与热门搜索词（误差有界）；
+search_stats_daily_sketch_totals 为每天全部知识库合并后的摘要，全站统计每天只合并一行。
+
+统计口径以 search_logs 为准：单知识库检索与批量检索每条查询记一条日志；
+多知识库检索显式传 kb_ids/class_ids 时每个成功检索的知识库各记一条（按知识库统计各自计数），
+all_accessible 模式每次请求只记一条（归到首条命中所在的知识库），不按可访问知识库数放大。
+
+日志批量写入时在同一事务内增量累加（见 search_log_writer），
+历史日志或异常后的修复使用回填命令：
+
+    python -m app.search_stats backfill --from 2026-01-01 [--to 2026-01-31]
+"""
+
+import argparse
+import asyncio
+import hashlib
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import LargeBinary, cast, delete, func, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import models
+from app.config import get_settings
+from app.db import AsyncSessionLocal
+from app.sketches import HyperLogLog, SpaceSaving
+
+settings = get_settings()
+
+UserKey = Tuple[date, int, str, int]
+QueryKey = Tuple[date, int, str]
+
+
+def query_hash(query: str) -> str:
+    return hashlib.sha256(query.encode("utf-8")).hexdigest()
+
+
+def user_of(user_teacher_id: Optional[int], user_student_id: Optional[int]) -> Tuple[str, int]:
+    """日志对应的 (user_role, user_id)；没有用户的日志归为 ("other", 0)。"""
+    if user_teacher_id:
+        return "teacher", user_teacher_id
+    if user_student_id:
+        return "student", user_student_id
+    return "other", 0
+
+
+def aggregate(
+    rows: Iterable[Dict[str, Any]],
+) -> Tuple[Dict[UserKey, int], Dict[QueryKey, Tuple[str, int]]]:
+    """把一批日志行聚合为两张汇总表的增量。"""
+    users: Dict[UserKey, int] = {}
+    queries: Dict[QueryKey, Tuple[str, int]] = {}
+    for row in rows:
+        day = row["created_at"].date()
+        role, user_id = user_of(row.get("user_teacher_id"), row.get("user_student_id"))
+        user_key = (day, row["kb_id"], role, user_id)
+        users[user_key] = users.get(user_key, 0) + 1
+        query_key = (day, row["kb_id"], query_hash(row["query"]))
+        previous = queries.get(query_key)
+        queries[query_key] = (row["query"], (previous[1] if previous else 0) + 1)
+    return users, queries
+
+
+async def _upsert_counts(
+    session: AsyncSession,
+    model: Any,
+    key_columns: List[str],
+    values: List[Dict[str, Any]],
+) -> None:
+    """按主键累加 search_count（MySQL/SQLite 使用原生 upsert，其他数据库逐行更新）。"""
+    if not values:
+        return
+    table = model.__table__
+    dialect = session.bind.dialect.name
+    if dialect == "mysql":
+        from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+        stmt = mysql_insert(table).values(values)
+        stmt = stmt.on_duplicate_key_update(
+            search_count=table.c.search_count + stmt.inserted.search_count
+        )
+        await session.execute(stmt)
+        return
+    if dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+        stmt = sqlite_insert(table).values(values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=key_columns,
+            set_={"search_count": table.c.search_count + stmt.excluded.search_count},
+        )
+        await session.execute(stmt)
+        return
+
+    for value in values:
+        result = await session.execute(
+            update(table)
+            .where(*(table.c[col] == value[col] for col in key_columns))
+            .values(search_count=table.c.search_count + value["search_count"])
+        )
+        if result.rowcount == 0:
+            await session.execute(insert(table).values(value))
+
+
+async def apply_rollups(session: AsyncSession, rows: List[Dict[str, Any]]) -> None:
+    """把一批新写入的日志累加到汇总表（调用方负责提交事务）。"""
+    users, queries = aggregate(rows)
+    await _upsert_counts(
+        session,
+        models.SearchStatsDailyUser,
+        ["day", "kb_id", "user_role", "user_id"],
+        [
+            {"day": day, "kb_id": kb_id, "user_role": role, "user_id": user_id, "search_count": count}
+            for (day, kb_id, role, user_id), count in users.items()
+        ],
+    )
+    await _upsert_counts(
+        session,
+        models.SearchStatsDailyQuery,
+        ["day", "kb_id", "query_hash"],
+        [
+            {"day": day, "kb_id": kb_id, "query_hash": digest, "query": query, "search_count": count}
+            for (day, kb_id, digest), (query, count) in queries.items()
+        ],
+    )
+    await apply_sketches(session, rows)
+
+
+def _new_hll(registers: Optional[bytes] = None) -> HyperLogLog:
+    return HyperLogLog(settings.search_sketch_hll_precision, registers)
+
+
+def _new_topk(counters: Optional[List[List]] = None) -> SpaceSaving:
+    return SpaceSaving(settings.search_sketch_topk_capacity, counters)
+
+
+async def _lock_sketch(session: AsyncSession, model: Any, **key: Any) -> Any:
+    """取出（必要时先创建）某天（某知识库）的摘要行并加行锁，避免多进程并发覆盖。"""
+    prefix = {"mysql": "IGNORE", "sqlite": "OR IGNORE"}.get(session.bind.dialect.name)
+    if prefix:
+        await session.execute(insert(model).prefix_with(prefix).values(**key))
+    sketch = (
+        await session.execute(
+            select(model)
+            .where(*(getattr(model, name) == value for name, value in key.items()))
+            .with_for_update()
+        )
+    ).scalar_one_or_none()
+    if sketch is None:
+        sketch = model(**key)
+        session.add(sketch)
+    return sketch
+
+
+def _update_sketch(sketch: Any, teachers: set, students: set, queries: Dict[str, int]) -> None:
+    teacher_hll = _new_hll(sketch.teacher_hll)
+    for user_id in teachers:
+        teacher_hll.add(str(user_id))
+    student_hll = _new_hll(sketch.student_hll)
+    for user_id in students:
+        student_hll.add(str(user_id))
+    topk = _new_topk(sketch.top_queries)
+    for query, count in queries.items():
+        topk.add(query, count)
+    sketch.teacher_hll = teacher_hll.to_bytes()
+    sketch.student_hll = student_hll.to_bytes()
+    sketch.top_queries = topk.to_list()
+
+
+async def apply_sketches(session: AsyncSession, rows: List[Dict[str, Any]]) -> None:
+    """把一批日志合并进对应 (day, kb) 的概率摘要，以及当天全部知识库的合并摘要。"""
+    groups: Dict[Tuple[date, int], Tuple[set, set, Dict[str, int]]] = {}
+    totals: Dict[date, Tuple[set, set, Dict[str, int]]] = {}
+    for row in rows:
+        day = row["created_at"].date()
+        role, user_id = user_of(row.get("user_teacher_id"), row.get("user_student_id"))
+        for teachers, students, queries in (
+            groups.setdefault((day, row["kb_id"]), (set(), set(), {})),
+            totals.setdefault(day, (set(), set(), {})),
+        ):
+            if role == "teacher":
+                teachers.add(user_id)
+            elif role == "student":
+                students.add(user_id)
+            queries[row["query"]] = queries.get(row["query"], 0) + 1
+
+    # 固定加锁顺序（先按知识库，再按天合并行），避免并发写入死锁
+    for (day, kb_id) in sorted(groups):
+        sketch = await _lock_sketch(session, models.SearchStatsDailySketch, day=day, kb_id=kb_id)
+        _update_sketch(sketch, *groups[(day, kb_id)])
+    for day in sorted(totals):
+        sketch = await _lock_sketch(session, models.SearchStatsDailySketchTotal, day=day)
+        _update_sketch(sketch, *totals[day])
+
+
+async def approximate_stats(
+    session: AsyncSession,
+    kb_ids: Optional[Any],
+    day_from: Optional[date],
+    day_to: Optional[date],
+    top_n: int,
+) -> Dict[str, Any]:
+    """合并日期区间内的摘要，估算独立教师/学生数与热门搜索词。
+
+    kb_ids 为知识库 id 列表或子查询，None 表示全部知识库（读取按天合并表，每天一行）。
+    """
+    if kb_ids is None:
+        model = models.SearchStatsDailySketchTotal
+        filters = []
+    else:
+        model = models.SearchStatsDailySketch
+        filters = [model.kb_id.in_(kb_ids)]
+    if day_from:
+        filters.append(model.day >= day_from)
+    if day_to:
+        filters.append(model.day <= day_to)
+
+    sketches = (
+        await session.execute(
+            select(model.teacher_hll, model.student_hll, model.top_queries).where(*filters)
+        )
+    ).all()
+    precision = settings.search_sketch_hll_precision
+    teacher_hll = HyperLogLog.union(precision, (row.teacher_hll for row in sketches))
+    student_hll = HyperLogLog.union(precision, (row.student_hll for row in sketches))
+    topk = _new_topk()
+    for row in sketches:
+        if row.top_queries:
+            topk.merge(_new_topk(row.top_queries))
+
+    return {
+        "unique_teacher_count": teacher_hll.count(),
+        "unique_student_count": student_hll.count(),
+        "top_queries": [
+            {"query": query, "count": count, "error": error}
+            for query, count, error in topk.top(top_n)
+        ],
+    }
+
+
+async def backfill_day(session: AsyncSession, day: date) -> int:
+    """按原始日志重建某一天的汇总，返回当天日志条数。"""
+    start = datetime.combine(day, datetime.min.time())
+    end = start + timedelta(days=1)
+    in_day = (models.SearchLog.created_at >= start, models.SearchLog.created_at < end)
+
+    await session.execute(
+        delete(models.SearchStatsDailyUser).where(models.SearchStatsDailyUser.day == day)
+    )
+    await session.execute(
+        delete(models.SearchStatsDailyQuery).where(models.SearchStatsDailyQuery.day == day)
+    )
+    await session.execute(
+        delete(models.SearchStatsDailySketch).where(models.SearchStatsDailySketch.day == day)
+    )
+    await session.execute(
+        delete(models.SearchStatsDailySketchTotal).where(
+            models.SearchStatsDailySketchTotal.day == day
+        )
+    )
+
+    user_rows = (
+        await session.execute(
+            select(
+                models.SearchLog.kb_id,
+                models.SearchLog.user_teacher_id,
+                models.SearchLog.user_student_id,
+                func.count(),
+            )
+            .where(*in_day)
+            .group_by(
+                models.SearchLog.kb_id,
+                models.SearchLog.user_teacher_id,
+                models.SearchLog.user_student_id,
+            )
+        )
+    ).all()
+    users: Dict[Tuple[int, str, int], int] = {}
+    for kb_id, teacher_id, student_id, count in user_rows:
+        role, user_id = user_of(teacher_id, student_id)
+        users[(kb_id, role, user_id)] = users.get((kb_id, role, user_id), 0) + count
+    if users:
+        await session.execute(
+            insert(models.SearchStatsDailyUser).values(
+                [
+                    {"day": day, "kb_id": kb_id, "user_role": role, "user_id": user_id, "search_count": count}
+                    for (kb_id, role, user_id), count in users.items()
+                ]
+            )
+        )
+
+    # 按原文逐字节分组，与增量写入的 query_hash 口径一致：
+    # MySQL 默认排序规则会把大小写/重音不同的词归为一组（且忽略尾部空格），分组后无法再拆开
+    query_column = models.SearchLog.query
+    if session.bind.dialect.name == "mysql":
+        query_column = cast(models.SearchLog.query, LargeBinary)
+    query_rows = (
+        await session.execute(
+            select(models.SearchLog.kb_id, query_column, func.count())
+            .where(*in_day)
+            .group_by(models.SearchLog.kb_id, query_column)
+        )
+    ).all()
+    queries: Dict[Tuple[int, str], Tuple[str, int]] = {}
+    for kb_id, query, count in query_rows:
+        if isinstance(query, bytes):
+            query = query.decode("utf-8")
+        key = (kb_id, query_hash(query))
+        previous = queries.get(key)
+        queries[key] = (query, (previous[1] if previous else 0) + count)
+    values = [
+        {"day": day, "kb_id": kb_id, "query_hash": digest, "query": query, "search_count": count}
+        for (kb_id, digest), (query, count) in queries.items()
+    ]
+    for i in range(0, len(values), 1000):
+        await session.execute(insert(models.SearchStatsDailyQuery).values(values[i : i + 1000]))
+
+    # 摘要：按原始日志精确构建（top-k 直接取当天计数最高的 capacity 个词，误差为 0）
+    sketches: Dict[int, Tuple[HyperLogLog, HyperLogLog, List[List]]] = {}
+    for kb_id, role, user_id in users:
+        teacher_hll, student_hll, _ = sketches.setdefault(kb_id, (_new_hll(), _new_hll(), []))
+        if role == "teacher":
+            teacher_hll.add(str(user_id))
+        elif role == "student":
+            student_hll.add(str(user_id))
+    for (kb_id, _), (query, count) in queries.items():
+        sketches.setdefault(kb_id, (_new_hll(), _new_hll(), []))[2].append([query, count, 0])
+    for kb_id, (teacher_hll, student_hll, counters) in sketches.items():
+        counters.sort(key=lambda item: item[1], reverse=True)
+        session.add(
+            models.SearchStatsDailySketch(
+                day=day,
+                kb_id=kb_id,
+                teacher_hll=teacher_hll.to_bytes(),
+                student_hll=student_hll.to_bytes(),
+                top_queries=counters[: settings.search_sketch_topk_capacity],
+            )
+        )
+
+    # 当天全部知识库的合并摘要：同一搜索词跨知识库累加
+    if sketches:
+        total_teachers = HyperLogLog.union(
+            settings.search_sketch_hll_precision, (item[0].to_bytes() for item in sketches.values())
+        )
+        total_students = HyperLogLog.union(
+            settings.search_sketch_hll_precision, (item[1].to_bytes() for item in sketches.values())
+        )
+        total_queries: Dict[str, List] = {}
+        for (_, digest), (query, count) in queries.items():
+            total_queries.setdefault(digest, [query, 0, 0])[1] += count
+        counters = sorted(total_queries.values(), key=lambda item: item[1], reverse=True)
+        session.add(
+            models.SearchStatsDailySketchTotal(
+                day=day,
+                teacher_hll=total_teachers.to_bytes(),
+                student_hll=total_students.to_bytes(),
+                top_queries=counters[: settings.search_sketch_topk_capacity],
+            )
+        )
+    await session.flush()
+
+    return sum(users.values())
+
+
+async def backfill(date_from: date, date_to: date) -> None:
+    """逐天重建 [date_from, date_to] 的汇总，每天一个事务。建议在低峰期执行。"""
+    day = date_from
+    async with AsyncSessionLocal() as session:
+        while day <= date_to:
+            count = await backfill_day(session, day)
+            await session.commit()
+            print(f"{day.isoformat()}: {count} 条日志")
+            day += timedelta(days=1)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="搜索统计汇总表维护")
+    sub = parser.add_subparsers(dest="command", required=True)
+    fill = sub.add_parser("backfill", help="按原始日志重建指定日期区间的汇总")
+    fill.add_argument("--from", dest="date_from", required=True, help="起始日期 YYYY-MM-DD（UTC）")
+    fill.add_argument("--to", dest="date_to", help="结束日期 YYYY-MM-DD（含），默认今天")
+    args = parser.parse_args()
+
+    date_from = date.fromisoformat(args.date_from)
+    date_to = date.fromisoformat(args.date_to) if args.date_to else datetime.utcnow().date()
+    asyncio.run(backfill(date_from, date_to))
+
+
+if __name__ == "__main__":
+    main()
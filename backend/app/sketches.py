@@ -0,0 +1,117 @@
+"""搜索统计用的概率数据结构（可序列化、可跨日期合并）。
+
+- HyperLogLog：估算独立用户数，固定 2^p 字节，标准误差约 1.04 / sqrt(2^p)
+- SpaceSaving：保留计数最高的 k 个搜索词，每项带最大高估误差
+"""
+
+import hashlib
+import math
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+def _hash64(value: str) -> int:
+    return int.from_bytes(hashlib.sha1(value.encode("utf-8")).digest()[:8], "big")
+
+
+class HyperLogLog:
+    """HyperLogLog 基数估计。"""
+
+    def __init__(self, precision: int, registers: Optional[bytes] = None) -> None:
+        self.precision = precision
+        self.m = 1 << precision
+        if registers is not None and len(registers) == self.m:
+            self.registers = bytearray(registers)
+        else:
+            self.registers = bytearray(self.m)
+
+    def add(self, value: str) -> None:
+        x = _hash64(value)
+        index = x >> (64 - self.precision)
+        rest = (x << self.precision) & ((1 << 64) - 1)
+        # rank = 剩余位中第一个 1 的位置（从 1 开始）
+        rank = 1
+        while rank <= 64 - self.precision and not (rest & (1 << 63)):
+            rank += 1
+            rest <<= 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog") -> None:
+        if other.m != self.m:
+            raise ValueError("HyperLogLog 精度不一致，无法合并")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    @classmethod
+    def union(cls, precision: int, registers: Iterable[Optional[bytes]], chunk: int = 256) -> "HyperLogLog":
+        """一次合并多个序列化的寄存器数组（逐位取最大值在 C 层完成，分组避免参数过多）。"""
+        merged = cls(precision)
+        pending: List[bytes] = [merged.to_bytes()]
+        for value in registers:
+            if value and len(value) == merged.m:
+                pending.append(value)
+                if len(pending) >= chunk:
+                    pending = [bytes(map(max, *pending))]
+        if len(pending) > 1:
+            pending = [bytes(map(max, *pending))]
+        merged.registers = bytearray(pending[0])
+        return merged
+
+    def count(self) -> int:
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        # 小基数使用线性计数修正
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self) -> bytes:
+        return bytes(self.registers)
+
+
+class SpaceSaving:
+    """Space-Saving top-k：counters 为 {item: (count, error)}，count - error 为真实次数下界。"""
+
+    def __init__(self, capacity: int, counters: Optional[Iterable[List]] = None) -> None:
+        self.capacity = capacity
+        self.counters: Dict[str, Tuple[int, int]] = {}
+        for item, count, error in counters or []:
+            self.counters[item] = (int(count), int(error))
+
+    def _min_count(self) -> int:
+        if len(self.counters) < self.capacity:
+            return 0
+        return min(count for count, _ in self.counters.values())
+
+    def add(self, item: str, count: int = 1) -> None:
+        if item in self.counters:
+            current, error = self.counters[item]
+            self.counters[item] = (current + count, error)
+            return
+        if len(self.counters) < self.capacity:
+            self.counters[item] = (count, 0)
+            return
+        # 替换当前计数最小的项，继承其计数作为误差
+        victim = min(self.counters, key=lambda key: self.counters[key][0])
+        floor = self.counters.pop(victim)[0]
+        self.counters[item] = (floor + count, floor)
+
+    def merge(self, other: "SpaceSaving") -> None:
+        """合并两个摘要：一侧缺失的项按该侧最小计数补齐（仍满足误差上界）。"""
+        own_floor = self._min_count()
+        other_floor = other._min_count()
+        merged: Dict[str, Tuple[int, int]] = {}
+        for item in set(self.counters) | set(other.counters):
+            c1, e1 = self.counters.get(item, (own_floor, own_floor))
+            c2, e2 = other.counters.get(item, (other_floor, other_floor))
+            merged[item] = (c1 + c2, e1 + e2)
+        top = sorted(merged.items(), key=lambda kv: kv[1][0], reverse=True)[: self.capacity]
+        self.counters = dict(top)
+
+    def top(self, n: int) -> List[Tuple[str, int, int]]:
+        items = sorted(self.counters.items(), key=lambda kv: kv[1][0], reverse=True)[:n]
+        return [(item, count, error) for item, (count, error) in items]
+
+    def to_list(self) -> List[List]:
+        return [[item, count, error] for item, (count, error) in self.counters.items()]
@@ -0,0 +1,162 @@
+"""MinIO 对象存储的异步封装。
+
+minio SDK 为同步阻塞调用，直接在 async 接口中使用会卡住整个事件循环。
+这里持有进程内唯一的 Minio 客户端，并把所有 SDK 调用放到有界线程池执行，
+接口层只需 await 对应方法。
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, AsyncIterator, Callable, Iterable, Optional, Set
+from urllib.parse import urlparse
+
+from minio import Minio
+from minio.commonconfig import CopySource
+from minio.error import S3Error
+
+from app.config import get_settings
+
+settings = get_settings()
+
+
+def _build_minio_client() -> Minio:
+    """根据配置创建 MinIO 客户端。"""
+    endpoint = str(settings.minio_endpoint)
+    parsed = urlparse(endpoint)
+    if parsed.scheme:
+        host = parsed.netloc
+        secure = parsed.scheme == "https"
+    else:
+        host = endpoint
+        secure = False
+
+    return Minio(
+        host,
+        access_key=settings.minio_access_key,
+        secret_key=settings.minio_secret_key,
+        secure=secure,
+    )
+
+
+class ObjectStorage:
+    """单例 Minio 客户端 + 有界线程池。"""
+
+    def __init__(self) -> None:
+        self._client: Optional[Minio] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # 已确认存在的桶（进程级缓存），遇到 NoSuchBucket 时失效
+        self._known_buckets: Set[str] = set()
+        self._bucket_lock = asyncio.Lock()
+
+    @property
+    def client(self) -> Minio:
+        if self._client is None:
+            self._client = _build_minio_client()
+        return self._client
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=settings.minio_max_workers,
+                thread_name_prefix="minio",
+            )
+        return self._executor
+
+    async def run(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """在存储线程池中执行阻塞调用。"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_executor(), partial(func, *args, **kwargs))
+
+    def close(self) -> None:
+        """关闭线程池（等待进行中的调用结束）。"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    async def _run_in_bucket(
+        self, buckets: Iterable[str], func: Callable[..., Any], *args: Any, **kwargs: Any
+    ) -> Any:
+        """执行桶内操作；桶被外部删除（NoSuchBucket）时清除缓存，下次重新创建。"""
+        try:
+            return await self.run(func, *args, **kwargs)
+        except S3Error as exc:
+            if exc.code == "NoSuchBucket":
+                self._known_buckets.difference_update(buckets)
+            raise
+
+    async def bucket_exists(self, bucket: str) -> bool:
+        return await self.run(self.client.bucket_exists, bucket)
+
+    async def make_bucket(self, bucket: str) -> None:
+        await self.run(self.client.make_bucket, bucket)
+
+    async def ensure_bucket(self, bucket: str) -> None:
+        """确保桶存在：每个桶只在首次（或失效后）访问 MinIO。"""
+        if bucket in self._known_buckets:
+            return
+        async with self._bucket_lock:
+            if bucket in self._known_buckets:
+                return
+            if not await self.bucket_exists(bucket):
+                try:
+                    await self.make_bucket(bucket)
+                except S3Error as exc:
+                    # 并发进程可能已抢先创建
+                    if exc.code not in {"BucketAlreadyOwnedByYou", "BucketAlreadyExists"}:
+                        raise
+            self._known_buckets.add(bucket)
+
+    async def put_object(self, bucket: str, object_name: str, data: Any, **kwargs: Any) -> Any:
+        return await self._run_in_bucket(
+            [bucket], self.client.put_object, bucket, object_name, data, **kwargs
+        )
+
+    async def get_object(self, bucket: str, object_name: str, **kwargs: Any) -> Any:
+        """返回 urllib3 响应对象，调用方负责 close/release_conn（或使用 iter_object）。"""
+        return await self._run_in_bucket(
+            [bucket], self.client.get_object, bucket, object_name, **kwargs
+        )
+
+    async def read_object(self, bucket: str, object_name: str) -> bytes:
+        """读取完整对象内容。"""
+
+        def _read() -> bytes:
+            obj = self.client.get_object(bucket, object_name)
+            try:
+                return obj.read()
+            finally:
+                obj.close()
+                obj.release_conn()
+
+        return await self._run_in_bucket([bucket], _read)
+
+    async def iter_object(self, obj: Any, chunk_size: int = 64 * 1024) -> AsyncIterator[bytes]:
+        """分块读取 get_object 的响应，结束后归还连接。"""
+        try:
+            while True:
+                chunk = await self.run(obj.read, chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            obj.close()
+            obj.release_conn()
+
+    async def stat_object(self, bucket: str, object_name: str) -> Any:
+        return await self._run_in_bucket([bucket], self.client.stat_object, bucket, object_name)
+
+    async def copy_object(self, bucket: str, object_name: str, source_bucket: str, source_name: str) -> Any:
+        return await self._run_in_bucket(
+            [bucket, source_bucket],
+            self.client.copy_object,
+            bucket,
+            object_name,
+            CopySource(source_bucket, source_name),
+        )
+
+    async def remove_object(self, bucket: str, object_name: str) -> None:
+        await self._run_in_bucket([bucket], self.client.remove_object, bucket, object_name)
+
+
+storage = ObjectStorage()